@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+  Script name: bench-overhead.py
+
+  Author: Michael Dello
+  Description:
+     Benchmark what CREATE itself costs on top of the commands it runs
+
+     Synthetic configs in the configs/guidance.json shape are generated at
+     each requested size, with a fixed mix of output sizes, failing commands
+     and flaky commands (failing on their first attempt only). Each config is
+     driven through:
+       - main      go-create.py main(), end to end (plan, graph, logging)
+       - command   BaseCommand.__executeCmd(), through BaseCommand.execute(),
+                   with one retry per command
+     and against a raw baseline spawning the same command attempts with
+     subprocess.run(). Every measurement runs in a fresh process and working
+     directory, and reports the framework overhead per command, the memory
+     high-water mark of that process and the end-to-end throughput.
+
+     Results are written as JSON, and can be compared to a previous result
+     file to spot regressions between commits.
+
+     Usage: bench/bench-overhead.py [--sizes N ...] [-n RUNS] [-o FILE]
+                                    [--compare FILE]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+DEFAULT_OUTPUT = "bench-overhead.json"
+
+DRIVERS = ["main", "command"]
+
+# Overhead increase, relative to the compared results, reported as regression
+DEFAULT_REGRESSION_THRESHOLD = 0.10
+
+CONFIG_NAME = "bench"
+
+STAGES = ["build", "test", "analyze"]
+STEPS = ["prep", "execute", "cleanup"]
+
+# One cycle of the command mix: (kind, output bytes)
+MIX = \
+    [("ok", 0)] * 12 + \
+    [("ok", 1024)] * 4 + \
+    [("ok", 64 * 1024), ("fail", 0), ("flaky", 0), ("ok", 16)]
+
+# Attempts the raw baseline makes per command kind, matching each driver
+ATTEMPTS = {
+    "main": {"ok": 1, "fail": 1, "flaky": 1},
+    "command": {"ok": 1, "fail": 2, "flaky": 2}
+}
+
+RESULT_FORMAT = 1
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def commandFor(index, kind, outputbytes):
+    if kind == "fail":
+        return f"echo failing {index}; exit 1"
+    if kind == "flaky":
+        # Fails until its marker exists, i.e. on its first attempt only
+        marker = f"flaky-{index}"
+        return f"test -e {marker} || {{ touch {marker}; exit 1; }}"
+    if outputbytes:
+        return f"head -c {outputbytes} /dev/zero | tr '\\0' x"
+    return f"echo command {index}"
+
+#------------------------------------------------------------------------------
+def generateCommands(size):
+    '''
+        Returns the (kind, cmd) list of a synthetic config of size commands
+    '''
+    commands = []
+    for index in range(size):
+        kind, outputbytes = MIX[index % len(MIX)]
+        commands.append((kind, commandFor(index, kind, outputbytes)))
+    return commands
+
+#------------------------------------------------------------------------------
+def generateConfig(commands):
+    '''
+        Spread the commands over every stage/step, in configs/guidance.json
+        shape
+    '''
+    stages = {stage: {step: [] for step in STEPS} for stage in STAGES}
+    slots = [(stage, step) for stage in STAGES for step in STEPS]
+    for index, (_, cmd) in enumerate(commands):
+        stage, step = slots[index * len(slots) // len(commands)]
+        stages[stage][step].append({"cmd": cmd})
+    return {"version": "basic", "stages": stages}
+
+#------------------------------------------------------------------------------
+def maxRssKb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, in kilobytes elsewhere
+    return maxrss // 1024 if sys.platform == "darwin" else maxrss
+
+#------------------------------------------------------------------------------
+def driveMain(workdir, args):
+    import importlib.util
+    spec = \
+        importlib.util.spec_from_file_location(
+            "gocreate", os.path.join(ROOT, "go-create.py"))
+    gocreate = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(gocreate)
+    cliargs = \
+        argparse.Namespace(
+            config=CONFIG_NAME,
+            clear_logs=False,
+            jobs=args.jobs,
+            no_cache=False,
+            stream=False,
+            queued_logging=False,
+            shell_pool=0)
+    start = time.perf_counter()
+    gocreate.main(cliargs)
+    return time.perf_counter() - start
+
+#------------------------------------------------------------------------------
+def driveCommand(workdir, args):
+    sys.path.append(os.path.join(ROOT, "modules"))
+    import commands
+    with open(os.path.join(workdir, "commands.json")) as f:
+        cmds = json.load(f)
+    command = commands.BaseCommand()
+    start = time.perf_counter()
+    for _, cmd in cmds:
+        command.execute(cmd, retries=1, delay=0)
+    return time.perf_counter() - start
+
+#------------------------------------------------------------------------------
+def driveBaseline(workdir, args):
+    with open(os.path.join(workdir, "commands.json")) as f:
+        cmds = json.load(f)
+    start = time.perf_counter()
+    for kind, cmd in cmds:
+        for _ in range(ATTEMPTS[args.attempts][kind]):
+            subprocess.run(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                shell=True,
+                check=False)
+    return time.perf_counter() - start
+
+#------------------------------------------------------------------------------
+def child(args):
+    '''
+        Run a single measurement in this (fresh) process, from its own
+        working directory, and write the result file
+    '''
+    drivers = {
+        "main": driveMain,
+        "command": driveCommand,
+        "baseline": driveBaseline
+    }
+    workdir = os.getcwd()
+    elapsed = drivers[args.child](workdir, args)
+    with open(args.child_result, "w") as f:
+        json.dump({"seconds": elapsed, "maxrss_kb": maxRssKb()}, f)
+    return 0
+
+#------------------------------------------------------------------------------
+def measure(driver, commands, args, attempts=None):
+    '''
+        Run one measurement in a fresh process and working directory
+
+        Returns its {"seconds", "maxrss_kb"} result
+    '''
+    workdir = tempfile.mkdtemp(prefix="create-bench-")
+    try:
+        os.mkdir(os.path.join(workdir, "configs"))
+        with open(
+                os.path.join(workdir, "configs", f"{CONFIG_NAME}.json"),
+                "w") as f:
+            json.dump(generateConfig(commands), f)
+        with open(os.path.join(workdir, "commands.json"), "w") as f:
+            json.dump(commands, f)
+        resultpath = os.path.join(workdir, "result.json")
+        cmd = [
+            sys.executable,
+            os.path.realpath(__file__),
+            "--child", driver,
+            "--child-result", resultpath,
+            "--jobs", str(args.jobs),
+            "--attempts", attempts or driver]
+        subprocess.run(
+            cmd,
+            cwd=workdir,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True)
+        with open(resultpath) as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+#------------------------------------------------------------------------------
+def median(samples, key):
+    values = [s[key] for s in samples if s[key] is not None]
+    return statistics.median(values) if values else None
+
+#------------------------------------------------------------------------------
+def runCase(size, driver, args):
+    commands = generateCommands(size)
+    timed = [measure(driver, commands, args) for _ in range(args.runs)]
+    raw = \
+        [measure("baseline", commands, args, attempts=driver)
+            for _ in range(args.runs)]
+    seconds = median(timed, "seconds")
+    rawseconds = median(raw, "seconds")
+    return {
+        "driver": driver,
+        "commands": size,
+        "seconds": seconds,
+        "baseline_seconds": rawseconds,
+        "overhead_us_per_cmd": (seconds - rawseconds) / size * 1e6,
+        "throughput_cmds_per_sec": size / seconds,
+        "maxrss_kb": median(timed, "maxrss_kb"),
+        "baseline_maxrss_kb": median(raw, "maxrss_kb")
+    }
+
+#------------------------------------------------------------------------------
+def gitRevision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            encoding="utf-8",
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#------------------------------------------------------------------------------
+def compare(results, previouspath, threshold):
+    '''
+        Print the overhead change of every case against a previous result
+        file
+
+        Returns True if any case regressed by more than threshold
+    '''
+    with open(previouspath) as f:
+        previous = json.load(f)
+    before = {
+        (r["driver"], r["commands"]): r for r in previous.get("results", [])}
+    regressed = False
+    print(f"compared to {previous.get('revision')} ({previouspath}):")
+    for result in results:
+        old = before.get((result["driver"], result["commands"]))
+        if not old:
+            continue
+        # Relative to the whole per command cost, overhead alone is too noisy
+        oldcost = old["seconds"] / old["commands"]
+        newcost = result["seconds"] / result["commands"]
+        change = (newcost - oldcost) / oldcost
+        flag = ""
+        if change > threshold:
+            regressed = True
+            flag = "  REGRESSION"
+        print("{:<8} {:>6} cmds  overhead {:>9.1f} -> {:>9.1f} us/cmd  "
+              "cost {:>+6.1%}{}".format(
+                  result["driver"],
+                  result["commands"],
+                  old["overhead_us_per_cmd"],
+                  result["overhead_us_per_cmd"],
+                  change,
+                  flag))
+    return regressed
+
+#------------------------------------------------------------------------------
+def main(args):
+    if args.child:
+        return child(args)
+    results = []
+    print("{:<8} {:>6} {:>10} {:>12} {:>14} {:>12}".format(
+        "driver", "cmds", "wall (s)", "overhead/cmd", "throughput/s",
+        "maxrss (MB)"))
+    for size in args.sizes:
+        for driver in args.drivers:
+            result = runCase(size, driver, args)
+            results.append(result)
+            print("{:<8} {:>6} {:>10.3f} {:>9.1f} us {:>14.1f} {:>12}".format(
+                driver,
+                size,
+                result["seconds"],
+                result["overhead_us_per_cmd"],
+                result["throughput_cmds_per_sec"],
+                "{:.1f}".format(result["maxrss_kb"] / 1024)
+                    if result["maxrss_kb"] else "n/a"))
+    report = {
+        "format": RESULT_FORMAT,
+        "revision": gitRevision(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "runs": args.runs,
+        "jobs": args.jobs,
+        "results": results
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"results written to {args.output}")
+    if args.compare and compare(results, args.compare, args.threshold):
+        return 1
+    return 0
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="Number of commands of each synthetic config")
+    parser.add_argument("--drivers", nargs="+", choices=DRIVERS,
+                        default=DRIVERS,
+                        help="Code paths to drive the configs through")
+    parser.add_argument("-n", "--runs", type=int, default=1,
+                        help="Runs per case, the median is reported")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="go-create.py --jobs for the main driver (the "
+                             "baseline is always serial)")
+    parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT,
+                        help="Machine readable (JSON) result file")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="Previous result file to compare against; exits "
+                             "non-zero on a regression")
+    parser.add_argument("--threshold", type=float,
+                        default=DEFAULT_REGRESSION_THRESHOLD,
+                        help="Per command cost increase reported as a "
+                             "regression")
+    # Internal, a single measurement run in a fresh process
+    parser.add_argument("--child", choices=DRIVERS + ["baseline"],
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--child-result", help=argparse.SUPPRESS)
+    parser.add_argument("--attempts", choices=DRIVERS, default="main",
+                        help=argparse.SUPPRESS)
+    exit(main(parser.parse_args()))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+  Script name: bench-shellpool.py
+
+  Author: Michael Dello
+  Description:
+     Benchmark the per-command overhead of running tiny shell commands through
+     the warm shell worker pool, against spawning a shell per command the way
+     go-create.py does by default (subprocess.run with shell=True)
+
+     Usage: bench/bench-shellpool.py [-n COMMANDS] [-w WORKERS]
+"""
+import argparse
+import concurrent.futures
+import os
+import subprocess
+import sys
+import time
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+        "modules"))
+
+import shellpool
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+# Representative of the tiny commands that dominate large configs
+COMMANDS = [
+    "echo hello",
+    "test -f /etc/hostname || true",
+    "echo hello world | grep -c world"
+]
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def runSpawned(cmd):
+    return subprocess.run(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        shell=True,
+        check=False,
+        encoding="utf-8")
+
+#------------------------------------------------------------------------------
+def measure(label, runner, count, workers):
+    cmds = [COMMANDS[i % len(COMMANDS)] for i in range(count)]
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex:
+        results = list(ex.map(runner, cmds))
+    elapsed = time.perf_counter() - start
+    failed = sum(1 for r in results if r.returncode)
+    print("{:<10} {:>6} cmds  {:>8.3f} s  {:>8.1f} us/cmd  ({} failed)".format(
+        label, count, elapsed, elapsed / count * 1e6, failed))
+    return elapsed
+
+#------------------------------------------------------------------------------
+def main(args):
+    if not shellpool.isSupported():
+        print("Shell pool is not supported on this host")
+        return 1
+    spawned = measure("spawned", runSpawned, args.count, args.workers)
+    pool = shellpool.ShellPool(args.workers)
+    try:
+        # Warm the workers up, as a long run would
+        pool.run("true")
+        pooled = \
+            measure(
+                "pooled",
+                lambda cmd: pool.run(cmd, check=False),
+                args.count,
+                args.workers)
+    finally:
+        pool.close()
+    print(f"speedup    {spawned / pooled:.2f}x")
+    return 0
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", type=int, default=500,
+                        help="Number of commands to run per mode")
+    parser.add_argument("-w", "--workers", type=int,
+                        default=shellpool.DEFAULT_POOL_SIZE,
+                        help="Concurrent commands (and pool size)")
+    exit(main(parser.parse_args()))
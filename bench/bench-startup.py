@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+  Script name: bench-startup.py
+
+  Author: Michael Dello
+  Description:
+     Cold-start benchmark for go-create.py, holding startup to a budget
+
+     go-create.py is run from editor and git hooks many times an hour, so the
+     time spent before the first command runs is user visible. This runs
+     go-create.py under "python -X importtime", for its CLI and for a real
+     run of a one command config, and reports the import time CREATE adds
+     on top of a bare interpreter, alongside the wall time of each case.
+     Exits non-zero when the median CREATE import time of any case exceeds
+     the budget.
+
+     The run happens in a scratch folder, with its plan cached by a first
+     run as it is in everyday use. Its command marks where it starts in the
+     import log (through /proc), so only the imports made before the first
+     command count; without /proc, every import of the run counts. CREATE's
+     modules are byte-compiled first: a run normally loads them from their
+     cached bytecode, which PYTHONDONTWRITEBYTECODE or a stale cache would
+     otherwise turn into compiling every module on every run.
+
+     Usage: bench/bench-startup.py [-n RUNS] [--budget-ms MS]
+"""
+import argparse
+import compileall
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Cumulative import time CREATE may add to a bare interpreter
+DEFAULT_BUDGET_MS = 40
+
+GOCREATE = os.path.join(ROOT, "go-create.py")
+
+# Written into go-create.py's import log by the run's first command
+FIRST_COMMAND_MARK = "import time: first command"
+
+# Config of the run path case, in the scratch folder's configs/
+RUN_CONFIG = "bench-startup"
+RUN_CONFIG_CONTENT = {
+    "version": "basic",
+    "stage_order": ["run"],
+    "stages": {
+        "run": {
+            "prep": [],
+            "execute": [
+                {"cmd": f"echo '{FIRST_COMMAND_MARK}' > /proc/$PPID/fd/2 "
+                        "2>/dev/null || true"}
+            ],
+            "cleanup": []
+        }
+    }
+}
+
+CASES = [
+    ("baseline", ["-c", "pass"]),
+    ("cli --version", [GOCREATE, "--version"]),
+    ("run path", [GOCREATE, "-c", RUN_CONFIG, "--no-log-file"])
+]
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def importTimeUs(stderr):
+    '''
+        Sum the cumulative time of top-level imports from -X importtime,
+        up to the first command of a run
+    '''
+    total = 0
+    for line in stderr.splitlines():
+        if line == FIRST_COMMAND_MARK:
+            break
+        if not line.startswith("import time:"):
+            continue
+        fields = line.split("|")
+        # Nested imports are indented and already counted by their parent
+        if len(fields) != 3 or fields[2].startswith("  ") or \
+                not fields[1].strip().isdigit():
+            continue
+        total += int(fields[1])
+    return total
+
+#------------------------------------------------------------------------------
+def measure(args, cwd):
+    start = time.perf_counter()
+    cc = subprocess.run(
+        [sys.executable, "-X", "importtime"] + args,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        encoding="utf-8")
+    wall = time.perf_counter() - start
+    return importTimeUs(cc.stderr), wall
+
+#------------------------------------------------------------------------------
+def main(args):
+    results = {}
+    compileall.compile_dir(os.path.join(ROOT, "modules"), quiet=1)
+    scratch = tempfile.mkdtemp(prefix="bench-startup-")
+    try:
+        os.mkdir(os.path.join(scratch, "configs"))
+        with open(os.path.join(
+                scratch, "configs", f"{RUN_CONFIG}.json"), "w") as f:
+            json.dump(RUN_CONFIG_CONTENT, f)
+        # Cache the plan, like any run after the config last changed
+        measure(CASES[-1][1], scratch)
+        for name, caseargs in CASES:
+            samples = [measure(caseargs, scratch) for _ in range(args.runs)]
+            results[name] = (
+                statistics.median(s[0] for s in samples) / 1000,
+                statistics.median(s[1] for s in samples) * 1000)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    baseline = results["baseline"][0]
+    overbudget = False
+    print("{:<16} {:>12} {:>14} {:>10}".format(
+        "case", "imports (ms)", "create (ms)", "wall (ms)"))
+    for name, (imports, wall) in results.items():
+        added = imports - baseline
+        flag = ""
+        if name != "baseline" and added > args.budget_ms:
+            overbudget = True
+            flag = "  OVER BUDGET"
+        print("{:<16} {:>12.1f} {:>14.1f} {:>10.1f}{}".format(
+            name, imports, added, wall, flag))
+    print(f"budget: {args.budget_ms} ms of CREATE import time per case")
+    return 1 if overbudget else 0
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--runs", type=int, default=11,
+                        help="Runs per case, the median is reported")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS,
+                        help="Maximum CREATE import time per case")
+    exit(main(parser.parse_args()))
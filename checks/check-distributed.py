@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+  Script name: check-distributed.py
+
+  Author: Michael Dello
+  Description:
+     End-to-end functional check of distributed execution on this host
+
+     Each case starts a coordinator and workers on a Unix socket, in a
+     scratch folder, and runs a config through them:
+       - "happy path": two workers, along with a worker holding the wrong
+         token. The run succeeds, both workers run commands, "shell": false
+         is honored on the workers, the worker with the wrong token is turned
+         away, and every worker exits once the coordinator is done.
+       - "lost worker": a worker is killed (SIGKILL) while it runs a command.
+         The command is rescheduled on the other worker, and the run still
+         succeeds with every command finished.
+     Exits non-zero if any check fails.
+
+     Usage: checks/check-distributed.py [-n COMMANDS]
+"""
+import argparse
+import json
+import os
+import re
+import secrets
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+GOCREATE = os.path.join(ROOT, "go-create.py")
+
+TOKEN_ENV = "CREATE_DISTRIBUTED_TOKEN"
+
+# Time the coordinator and the workers get to finish
+TIMEOUT_IN_SECS = 120
+
+# Lost worker case: commands record the PID of the worker running them (the
+# parent of their shell) in this file as they start
+RUNNING_FILE = "running"
+# Long enough for the worker to be killed while the command runs
+SLOW_COMMAND_IN_SECS = 3
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def writeConfig(scratch, name, execute):
+    config = {
+        "version": "basic",
+        "stage_order": ["distributed"],
+        "stages": {
+            "distributed": {"prep": [], "execute": execute, "cleanup": []}
+        }
+    }
+    os.makedirs(os.path.join(scratch, "configs"), exist_ok=True)
+    with open(os.path.join(scratch, "configs", f"{name}.json"), "w") as f:
+        json.dump(config, f)
+
+#------------------------------------------------------------------------------
+def startWorker(address, scratch, token, slots=2):
+    return subprocess.Popen(
+        [sys.executable, GOCREATE, "--worker", address, "--slots",
+         str(slots)],
+        cwd=scratch,
+        env=dict(os.environ, **{TOKEN_ENV: token}),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        encoding="utf-8")
+
+#------------------------------------------------------------------------------
+def startCoordinator(address, scratch, token, config, jobs):
+    return subprocess.Popen(
+        [sys.executable, GOCREATE, "-c", config,
+         "--coordinator", address, "--min-workers", "2",
+         "-j", str(jobs), "--no-log-file", "--no-history"],
+        cwd=scratch,
+        env=dict(os.environ, **{TOKEN_ENV: token}),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        encoding="utf-8")
+
+#------------------------------------------------------------------------------
+def finishedOn(output):
+    '''
+        Returns the worker names of the "Finished cmd" lines of a run
+    '''
+    return re.findall(r"Finished cmd\t: .* \(on (\S+)\)", output)
+
+#------------------------------------------------------------------------------
+def happyPath(scratch, commands, processes):
+    '''
+        Returns [(check, passed)] and the output of the run
+    '''
+    address = f"unix:{os.path.join(scratch, 'happy.sock')}"
+    token = secrets.token_hex(16)
+    execute = [
+        {"cmd": f"sleep 0.2; echo command {i}"} for i in range(commands)]
+    # Run directly, the variable reaches echo unexpanded
+    execute.append({"cmd": "echo $HOME", "shell": False})
+    writeConfig(scratch, "happy", execute)
+    workers = [startWorker(address, scratch, token) for _ in range(2)]
+    intruder = startWorker(address, scratch, secrets.token_hex(16))
+    processes.extend(workers + [intruder])
+    coordinator = \
+        startCoordinator(address, scratch, token, "happy", len(execute))
+    processes.append(coordinator)
+    output, _ = coordinator.communicate(timeout=TIMEOUT_IN_SECS)
+    ranon = finishedOn(output)
+    return [
+        ("run succeeded", coordinator.returncode == 0),
+        (f"all {len(execute)} commands finished",
+            len(ranon) == len(execute)),
+        ("both workers ran commands", len(set(ranon)) == 2),
+        ("shell: false honored", "(stdout): $HOME" in output),
+        ("wrong token rejected",
+            "Rejected worker" in output and
+                intruder.wait(TIMEOUT_IN_SECS) != 0),
+        ("workers exited",
+            all(w.wait(TIMEOUT_IN_SECS) == 0 for w in workers))], output
+
+#------------------------------------------------------------------------------
+def lostWorker(scratch, commands, processes):
+    '''
+        Returns [(check, passed)] and the output of the run
+    '''
+    address = f"unix:{os.path.join(scratch, 'lost.sock')}"
+    token = secrets.token_hex(16)
+    running = os.path.join(scratch, RUNNING_FILE)
+    execute = [
+        {"cmd": f"echo $PPID >> {RUNNING_FILE}; "
+                f"sleep {SLOW_COMMAND_IN_SECS}; echo command {i}"}
+        for i in range(commands)]
+    writeConfig(scratch, "lost", execute)
+    workers = {}
+    for _ in range(2):
+        worker = startWorker(address, scratch, token, slots=1)
+        workers[worker.pid] = worker
+    processes.extend(workers.values())
+    coordinator = \
+        startCoordinator(address, scratch, token, "lost", len(execute))
+    processes.append(coordinator)
+    # Kill the worker running the first command to start
+    victim = None
+    deadline = time.monotonic() + TIMEOUT_IN_SECS
+    while victim is None and time.monotonic() < deadline and \
+            coordinator.poll() is None:
+        try:
+            with open(running) as f:
+                pids = [int(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            pids = []
+        victim = next((workers[pid] for pid in pids if pid in workers), None)
+        if victim is None:
+            time.sleep(0.05)
+    if victim:
+        victim.send_signal(signal.SIGKILL)
+    output, _ = coordinator.communicate(timeout=TIMEOUT_IN_SECS)
+    ranon = finishedOn(output)
+    lost = f"{socket.gethostname()}-{victim.pid}" if victim else None
+    survivors = [w for w in workers.values() if w is not victim]
+    return [
+        ("worker killed while running a command", victim is not None),
+        ("command rescheduled",
+            f"lost worker {lost}" in output),
+        ("run succeeded", coordinator.returncode == 0),
+        (f"all {len(execute)} commands finished",
+            len(ranon) == len(execute)),
+        ("remaining worker exited",
+            all(w.wait(TIMEOUT_IN_SECS) == 0 for w in survivors))], output
+
+#------------------------------------------------------------------------------
+def main(args):
+    scratch = tempfile.mkdtemp(prefix="check-distributed-")
+    processes = []
+    failed = False
+    try:
+        for name, case in (("happy path", happyPath),
+                           ("lost worker", lostWorker)):
+            checks, output = case(scratch, args.commands, processes)
+            for check, passed in checks:
+                print(f"{'PASS' if passed else 'FAIL'}  {name}: {check}")
+            if not all(passed for _, passed in checks):
+                failed = True
+                print(output)
+        return 1 if failed else 0
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            if process.stdout:
+                process.stdout.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--commands", type=int, default=4,
+                        help="Commands of each case's config")
+    exit(main(parser.parse_args()))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+  Script name: create-client.py
+
+  Author: Michael Dello
+  Description:
+     Thin client of create-daemon.py
+
+     Takes the same arguments as go-create.py, has the daemon run them in
+     this working directory and environment, streams the run's output back
+     and exits with its return code. Interrupting the client cancels the
+     run. Without a daemon listening, go-create.py is run directly instead.
+
+     Only what is needed to talk to the daemon is imported, keep it so.
+"""
+import json
+import os
+import socket
+import sys
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+
+sys.path.append(os.path.join(ROOT, "modules"))
+
+import createif
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def runDirectly(argv):
+    os.execv(
+        sys.executable,
+        [sys.executable, os.path.join(ROOT, "go-create.py")] + argv)
+
+#------------------------------------------------------------------------------
+def relay(sock, marker):
+    '''
+        Copy the run's output to stdout, returning the return code that
+        ends it (None if the connection dropped before the run ended)
+    '''
+    out = sys.stdout.buffer
+    pending = b""
+    while True:
+        data = sock.recv(64 * 1024)
+        if not data:
+            break
+        pending += data
+        # Hold back what may be the start of the exit marker
+        hold = pending.rfind(b"\0")
+        if hold < 0 or len(pending) - hold > len(marker) + 16:
+            hold = len(pending)
+        out.write(pending[:hold])
+        out.flush()
+        pending = pending[hold:]
+    index = pending.rfind(marker)
+    if index < 0:
+        out.write(pending)
+        out.flush()
+        return None
+    out.write(pending[:index])
+    out.flush()
+    try:
+        return int(pending[index + len(marker):].split()[0])
+    except (IndexError, ValueError):
+        return None
+
+#------------------------------------------------------------------------------
+# Main
+#------------------------------------------------------------------------------
+def main(argv):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(createif.daemonSocketPath())
+    except OSError:
+        sock.close()
+        runDirectly(argv)
+    nonce = os.urandom(8).hex()
+    request = {
+        "argv": argv, "cwd": os.getcwd(), "env": dict(os.environ),
+        "nonce": nonce}
+    try:
+        sock.sendall((json.dumps(request) + "\n").encode())
+        rc = relay(sock, createif.EXIT_MARKER + nonce.encode() + b" ")
+    except KeyboardInterrupt:
+        # Closing the connection cancels the run
+        return createif.RC_CANCELLED
+    except OSError:
+        rc = None
+    finally:
+        sock.close()
+    if rc is None:
+        sys.stderr.write("Lost the connection to the CREATE daemon\n")
+        return createif.RC_FAILEXC
+    return rc
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    exit(main(sys.argv[1:]))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+  Script name: create-daemon.py
+
+  Author: Michael Dello
+  Description:
+     Resident CREATE daemon, serving go-create.py runs for create-client.py
+
+     Keeps the interpreter, CREATE's modules, logging and the loaded
+     execution plans resident, so runs requested through create-client.py
+     skip interpreter startup, imports and config parsing. See daemon.py.
+
+     Usage: create-daemon.py [--socket PATH] [--stop]
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+
+sys.path.append(os.path.join(ROOT, "modules"))
+
+import createif
+import createutils
+
+#------------------------------------------------------------------------------
+# Logging
+#------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+#------------------------------------------------------------------------------
+def loadGoCreate():
+    """
+    Import go-create.py, for its CLI parser and entry points
+    """
+    import importlib.util
+    spec = \
+        importlib.util.spec_from_file_location(
+            "gocreate", os.path.join(ROOT, "go-create.py"))
+    gocreate = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(gocreate)
+    return gocreate
+
+#------------------------------------------------------------------------------
+# Main
+#------------------------------------------------------------------------------
+def main(args):
+    import daemon
+    retcode = createif.RC_SUCCESS
+    # The daemon logs to the console until runs start logging themselves
+    createutils.consoleHandler()
+    try:
+        if args.stop:
+            daemon.stop(args.socket)
+        else:
+            daemon.Daemon(args.socket, loadGoCreate()).serve()
+    except Exception as e:
+        log.error(f"Daemon failed on exception: {str(e)}")
+        retcode = createif.RC_FAILEXC
+    createutils.flushconsole()
+    return retcode
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--socket", action="store", default=createif.daemonSocketPath(),
+        help="Unix socket to listen on (default: %(default)s)")
+    parser.add_argument(
+        "--stop", action="store_true",
+        help="Stop the daemon listening on the socket")
+    exit(main(parser.parse_args()))
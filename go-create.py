@@ -13,13 +13,12 @@
 
      Interface can be obtained using the -h/--help CLI option, or analyzing the
      __main__ program in this file.
+
+     Startup latency matters (CREATE is run from editor and git hooks), so
+     only the modules needed to parse the CLI are imported up front; the rest
+     are imported by the code paths that need them.
 """
-import argparse
-import json
-import glob
-import logging
 import os
-import subprocess
 import sys
 
 sys.path.append(
@@ -50,14 +49,662 @@ log = createutils.logger.getChild(__name__)
 #------------------------------------------------------------------------------
 def clearLogs():
     log.info(f"Clearing {createutils.OUTPUTDIR}/...")
-    files = \
-        glob.glob(
-            os.path.join(
-                createutils.OUTPUTDIR, createutils.LOGFILENAME.format("*")))
-    for file in files:
-        if createutils.loggingIsStarted() and \
-                (createutils.THISLOGFILE not in file):
-            os.remove(file)
+    if not createutils.loggingIsStarted():
+        return
+    logprefix, logsuffix = createutils.LOGFILENAME.split("{}")
+    spoolprefix, _, spoolsuffix = createutils.SPOOLFILENAME.split("{}")
+    thisspool = createutils.SPOOLFILENAME.format(createutils.RUNSTAMP, "")
+    # Log files, and spooled command output from previous runs
+    for folder, prefix, suffix, keep in (
+            (createutils.OUTPUTDIR, logprefix, logsuffix,
+                createutils.THISLOGFILE),
+            (createutils.SPOOLDIR, spoolprefix, spoolsuffix, thisspool)):
+        try:
+            entries = list(os.scandir(folder))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.name.startswith(prefix) and \
+                    entry.name.endswith(suffix) and \
+                    not entry.name.startswith(keep) and entry.is_file():
+                os.remove(entry.path)
+
+#------------------------------------------------------------------------------
+def recordAttempt(
+        node, started, duration, returncode, failed, output=None,
+        cached=False):
+    """
+    Keep an attempt of a command node for the run history, which is written
+    out once the run is done
+    """
+    node.attempts.append((
+        node.retries, started, duration, returncode, int(failed), int(cached),
+        createutils.compressOutput(output, createif.HISTORY_OUTPUT_BYTES)))
+
+#------------------------------------------------------------------------------
+def executeCmdEntry(
+        node, resultcache=None, stream=False, shellpool=None, recorder=None,
+        history=False, artifactstore=None):
+    """
+    Execute a single command entry from the execution graph, replaying the
+    recorded result instead when the result cache has a hit
+
+    With an artifact store, a command declaring artifacts has its output
+    directories restored from a snapshot instead of running, when it has
+    one, and snapshotted once it succeeds otherwise
+
+    In streaming mode, output is forwarded to the log line by line as it
+    arrives and spooled to disk, keeping only its tail in memory
+
+    With a shell pool, shell commands run in one of its warm shell workers
+    instead of a freshly spawned shell, unless the entry asks to be isolated
+
+    With a usage recorder, the command's process tree is sampled for its CPU,
+    memory and I/O usage while it runs
+
+    With history set, the attempt is kept on the node for the run history
+
+    A failed command with a retry policy isn't retried in place, the delay
+    before its next attempt is handed back to the scheduler instead
+
+    Returns the command return code, the log block describing execution, and
+    the delay before retrying the command (None when it is done)
+    """
+    import processes
+    import subprocess
+    import time
+    retcode = createif.RC_SUCCESS
+    block = createutils.LogBlock(log)
+    cmdentry = node.cmdentry
+    # Get the command if one is specified
+    cmd = cmdentry.get("cmd", "")
+    # Use shell by default, unless specified otherwise
+    executeinshell = cmdentry.get("shell", True)
+    block.info(OUTPUT_SEPARATOR)
+    block.info(
+        "Executing: [stage = %s] - [step = %s] - [cmd = %s]",
+        node.stage,
+        node.step,
+        cmd if cmd else '(No cmd specified)')
+    if node.heldback:
+        block.info(
+            "\tQueue wait\t: %s (waited for resources)",
+            createutils.formatDuration(node.queuewait))
+    cc = None
+    cachekey = None
+    cachehit = False
+    failedrc = None
+    failedoutput = None
+    usage = recorder.begin(node) if recorder else None
+    started = time.time()
+    artifacts = None
+    if cmd and (resultcache or artifactstore):
+        import cache
+        if cache.isCacheable(cmdentry):
+            cachekey = cache.computeKey(cmdentry)
+            if artifactstore and cmdentry.get(cache.CAK_ARTIFACTS):
+                # The snapshot records the result, along with the outputs
+                artifacts = artifactstore
+                cached = artifacts.restore(cachekey, cmdentry)
+                if cached:
+                    counts = cached["counts"]
+                    block.info(
+                        "\tArtifacts\t: restored %s linked, %s copied, %s "
+                        "unchanged, %s removed",
+                        counts["linked"], counts["copied"],
+                        counts["unchanged"], counts["removed"])
+            else:
+                cached = \
+                    resultcache.lookup(cachekey, cmdentry) if resultcache \
+                    else None
+            if cached:
+                block.info("\tCache hit\t: %s", cachekey)
+                cachehit = True
+                if usage:
+                    usage.cached = True
+                cc = \
+                    subprocess.CompletedProcess(
+                        cmd, cached["returncode"], stdout=cached["output"])
+    if cmd and not cc:
+        env = cmdentry.get("env", None)
+        runargs = {
+            "shell": executeinshell,
+            "cwd": cmdentry.get("cwd", None),
+            "env": dict(os.environ, **env) if env else None,
+            "timeout": cmdentry.get("timeout", None),
+            "check": cmdentry.get("check", True),
+            "encoding": cmdentry.get("encoding", "utf-8")
+        }
+        usepool = \
+            shellpool and executeinshell and \
+            not cmdentry.get("isolated", False)
+        if usage:
+            # Pooled commands run in a subshell of a long-lived worker
+            runargs["onstart"] = usage.trackSubtree if usepool else usage.track
+        try:
+            if cmdentry.get("stream", stream):
+                import capture
+                cc = \
+                    capture.run(
+                        cmd if executeinshell else cmd.split(),
+                        name=node.name,
+                        online=lambda line:
+                            createutils.logLine(
+                                log, "\t[%s] %s", node.name, line),
+                        tailbytes=cmdentry.get(
+                            "tail_bytes", capture.DEFAULT_TAIL_BYTES),
+                        **runargs)
+            elif usepool:
+                cc = \
+                    shellpool.run(
+                        cmd,
+                        cwd=runargs["cwd"],
+                        env=env,
+                        timeout=runargs["timeout"],
+                        check=runargs["check"],
+                        encoding=runargs["encoding"],
+                        onstart=runargs.get("onstart"))
+            else:
+                cc = \
+                    processes.run(
+                        cmd if executeinshell else cmd.split(), **runargs)
+        except Exception as e:
+            block.error("Exception on cmd=[%s]: %s", cmd, e)
+            retcode = createif.RC_FAILEXC
+            failedrc = getattr(e, "returncode", None)
+            failedoutput = getattr(e, "output", None)
+            if isinstance(failedoutput, bytes):
+                failedoutput = \
+                    failedoutput.decode(
+                        runargs["encoding"], errors="backslashreplace")
+            if usage:
+                usage.attemptDone(failedrc)
+        if cc and artifacts:
+            # Only successful outputs are worth restoring
+            if cc.returncode == 0:
+                try:
+                    artifacts.store(
+                        cachekey, cmdentry, cc.returncode, cc.stdout)
+                except OSError as e:
+                    block.warning("\tArtifacts not stored: %s", e)
+        elif cc and cachekey and resultcache:
+            resultcache.store(cachekey, cmdentry, cc.returncode, cc.stdout)
+    if cc:
+        block.info("\tFinished cmd\t: %s", cmd)
+        block.info("\tReturn code \t: %s", cc.returncode)
+        block.info(
+            "\tCaptured Output\t: %s",
+            cc.stdout.replace('\\n', '\n'))
+    if usage:
+        recorder.finish(usage, cc.returncode if cc else None)
+        block.info("\tResources\t: %s", usage.describe())
+    node.cached = cachehit
+    if history and cmd:
+        recordAttempt(
+            node,
+            started,
+            time.time() - started,
+            cc.returncode if cc else failedrc,
+            retcode != createif.RC_SUCCESS,
+            cc.stdout if cc else failedoutput,
+            cached=cachehit)
+    retryafter = None
+    if retcode != createif.RC_SUCCESS and node.retry:
+        retryafter = \
+            node.retry.nextDelay(
+                node.retries,
+                failedrc,
+                failedoutput,
+                time.monotonic() - (node.firststart or time.monotonic()))
+        if retryafter is not None:
+            block.warning(
+                "\tRetrying in %.1fs (retry %s of %s)",
+                retryafter,
+                node.retries + 1,
+                node.retry.retries)
+    return retcode, block, retryafter
+
+#------------------------------------------------------------------------------
+def executeRemoteCmdEntry(node, coordinator, history=False):
+    """
+    Execute a single command entry from the execution graph on a worker of
+    the coordinator, which streams its output back to the log as it arrives
+
+    Retries are handled by the worker, as part of running the command, and
+    are recorded in the run history as a single attempt
+
+    Returns the command return code, the log block describing execution, and
+    None as the command is never re-queued
+    """
+    import time
+    retcode = createif.RC_SUCCESS
+    block = createutils.LogBlock(log)
+    cmdentry = node.cmdentry
+    cmd = cmdentry.get("cmd", "")
+    block.info(OUTPUT_SEPARATOR)
+    block.info(
+        "Executing: [stage = %s] - [step = %s] - [cmd = %s]",
+        node.stage,
+        node.step,
+        cmd if cmd else '(No cmd specified)')
+    if not cmd:
+        return retcode, block, None
+    started = time.time()
+    try:
+        result, worker = \
+            coordinator.run(
+                node.name,
+                cmdentry,
+                online=lambda line, worker:
+                    createutils.logLine(
+                        log, "\t[%s@%s] %s", node.name, worker, line))
+    except Exception as e:
+        block.error("Exception on cmd=[%s]: %s", cmd, e)
+        if history:
+            recordAttempt(node, started, time.time() - started, None, True)
+        return createif.RC_FAILEXC, block, None
+    block.info("\tFinished cmd\t: %s (on %s)", cmd, worker)
+    block.info("\tReturn code \t: %s", result.get("returncode"))
+    block.info("\tCaptured Output\t: %s", result.get("output", ""))
+    if not result.get("success") and cmdentry.get("check", True):
+        block.error("Failed cmd=[%s] on worker %s", cmd, worker)
+        retcode = createif.RC_FAILEXC
+    if history:
+        recordAttempt(
+            node,
+            started,
+            time.time() - started,
+            result.get("returncode"),
+            retcode != createif.RC_SUCCESS,
+            result.get("output"))
+    return retcode, block, None
+
+#------------------------------------------------------------------------------
+def runWorker(args):
+    """
+    Serve as a distributed worker until the coordinator goes away
+    """
+    import distributed
+    retcode = createif.RC_SUCCESS
+    try:
+        createutils.startLogging(queued=getattr(args, "queued_logging", False))
+        distributed.serve(args.worker, slots=args.slots)
+    except Exception as e:
+        log.error(f"Worker failed on exception: {str(e)}")
+        retcode = createif.RC_FAILEXC
+    createutils.flushconsole()
+    return retcode
+
+#------------------------------------------------------------------------------
+def logEstimate(nodes, model, jobs, critical=None):
+    """
+    Log the predicted run time of the graph on 'jobs' workers, and the
+    predicted critical path length, if known
+
+    Returns the predicted run time
+    """
+    import scheduler
+    estimate = scheduler.simulate(nodes, model.estimate, jobs)
+    commands = [
+        node for node in nodes
+        if not node.isBarrier() and node.cmdentry.get("cmd")]
+    unknown = sum(1 for node in commands if not model.known(node))
+    log.info(OUTPUT_SEPARATOR)
+    log.info(
+        "Estimated run time: %s with %s job(s)%s",
+        createutils.formatDuration(estimate),
+        jobs,
+        f" (critical path: {createutils.formatDuration(critical)})"
+            if critical is not None else "")
+    if unknown:
+        log.info(
+            "%s of %s command(s) have no recorded duration yet%s",
+            unknown,
+            len(commands),
+            f", assumed {createutils.formatDuration(model.default)} each"
+                if model.default else "")
+    return estimate
+
+#------------------------------------------------------------------------------
+def logStates(nodes):
+    """
+    Log how many commands ran, were skipped or were cancelled, and the final
+    state of each command unless every one of them ran and succeeded
+    """
+    import scheduler
+    counts = scheduler.stateCounts(nodes)
+    if not counts:
+        return
+    states = (
+        scheduler.STATE_RAN, scheduler.STATE_SKIPPED, scheduler.STATE_CANCELLED)
+    log.info(
+        "Commands: %s",
+        ", ".join(f"{counts.get(state, 0)} {state}" for state in states))
+    if all(node.retcode == createif.RC_SUCCESS
+           for node in nodes if node.state):
+        return
+    for node in nodes:
+        if node.isBarrier() or not node.state:
+            continue
+        log.info(
+            "  %-9s %s%s",
+            node.state,
+            node.name,
+            f" (return code = {node.retcode})"
+                if node.state == scheduler.STATE_RAN and
+                node.retcode != createif.RC_SUCCESS else "")
+
+#------------------------------------------------------------------------------
+def writeHistory(args, nodes, started, duration, retcode):
+    """
+    Record a finished run, and the attempts kept on its command nodes, in
+    the run history
+    """
+    # Deferred until the run is done, SQLite isn't needed to run commands
+    import history
+    try:
+        runhistory = history.RunHistory()
+    except Exception as e:
+        log.warning(f"Run history unavailable: {str(e)}")
+        return
+    try:
+        runhistory.recordRun(
+            args.config, sys.argv[1:], started, duration, retcode, nodes)
+    finally:
+        runhistory.close()
+
+#------------------------------------------------------------------------------
+def executeGraph(args, nodes, cancel=None):
+    """
+    Run the execution graph with the runner the CLI options select, then log
+    the run's summaries
+
+    Returns the aggregated return code
+    """
+    import functools
+    import time
+    import scheduler
+    jobs = getattr(args, "jobs", createif.DEFAULT_JOBS)
+    if jobs > 1:
+        log.info(f"Running with up to {jobs} concurrent jobs")
+    resultcache = None
+    if not getattr(args, "no_cache", False) and \
+            scheduler.usesKey(nodes, "inputs"):
+        # Only pay for the cache when some command can use it
+        import cache
+        resultcache = cache.ResultCache()
+    artifactstore = None
+    if not getattr(args, "no_cache", False) and \
+            scheduler.usesKey(nodes, "artifacts"):
+        import artifacts
+        artifactstore = artifacts.ArtifactStore()
+    history = not getattr(args, "no_history", False)
+    recorder = None
+    tracepath = getattr(args, "trace", None)
+    if getattr(args, "usage", False) or tracepath:
+        import accounting
+        recorder = accounting.UsageRecorder()
+    pool = None
+    coordinator = None
+    if getattr(args, "coordinator", None):
+        import distributed
+        coordinator = distributed.Coordinator(args.coordinator)
+        coordinator.start()
+        if not coordinator.waitForWorkers(args.min_workers):
+            coordinator.close()
+            raise Exception(
+                f"Fewer than {args.min_workers} worker(s) registered")
+        # Runner threads only wait on workers, keep all slots busy
+        jobs = max(jobs, coordinator.totalSlots())
+        runner = \
+            functools.partial(
+                executeRemoteCmdEntry,
+                coordinator=coordinator,
+                history=history)
+    else:
+        if getattr(args, "shell_pool", 0):
+            import shellpool
+            if shellpool.isSupported():
+                pool = shellpool.ShellPool(args.shell_pool)
+        runner = \
+            functools.partial(
+                executeCmdEntry,
+                resultcache=resultcache,
+                stream=getattr(args, "stream", False),
+                shellpool=pool,
+                recorder=recorder,
+                history=history,
+                artifactstore=artifactstore)
+    admission = None
+    if jobs > 1 and not coordinator and \
+            any(scheduler.usesKey(nodes, key)
+                for key in ("cpus", "memory_mb", "tokens")):
+        # Commands declaring resources only start once the host has room
+        import admission as hostadmission
+        admission = hostadmission.Admission()
+    # Learned command durations order concurrent work, longest critical
+    # path first, and predict the run time. Serial runs only update them,
+    # once the commands are done.
+    model = None
+    critical = None
+    estimate = None
+    if jobs > 1 or getattr(args, "estimate", False):
+        import durations
+        model = durations.DurationModel(args.config)
+        if jobs > 1:
+            critical = scheduler.prioritize(nodes, model.estimate)
+        if getattr(args, "estimate", False):
+            estimate = logEstimate(nodes, model, jobs, critical)
+    retcode = createif.RC_FAILEXC
+    runstarted = time.time()
+    started = time.monotonic()
+    try:
+        retcode = \
+            scheduler.runGraph(
+                nodes,
+                runner,
+                jobs=jobs,
+                cancel=cancel,
+                failfast=getattr(args, "fail_fast", False),
+                admission=admission)
+    finally:
+        if pool:
+            pool.close()
+        if coordinator:
+            coordinator.close()
+        if resultcache:
+            resultcache.close()
+        if artifactstore:
+            try:
+                artifactstore.close()
+            except OSError as e:
+                log.warning(f"Artifact store not collected: {str(e)}")
+        if history:
+            writeHistory(
+                args, nodes, runstarted, time.monotonic() - started, retcode)
+    if retcode != createif.RC_CANCELLED:
+        if model is None:
+            import durations
+            model = durations.DurationModel(args.config)
+        model.update(nodes)
+        model.save()
+    if estimate is not None:
+        log.info(
+            "Run time: %s (estimated %s)",
+            createutils.formatDuration(time.monotonic() - started),
+            createutils.formatDuration(estimate))
+    for group, results in scheduler.groupResults(nodes).items():
+        failed = [
+            name for name, rc in results if rc != createif.RC_SUCCESS]
+        log.info(
+            "Matrix %s: %s of %s instances succeeded%s",
+            group,
+            len(results) - len(failed),
+            len(results),
+            f", failed: {', '.join(failed)}" if failed else "")
+    logStates(nodes)
+    if admission:
+        admission.logSummary(nodes)
+    if recorder:
+        log.info(OUTPUT_SEPARATOR)
+        recorder.logSummary(log)
+        if tracepath:
+            recorder.writeTrace(tracepath)
+    return retcode
+
+#------------------------------------------------------------------------------
+def logResult(retcode):
+    log.info(OUTPUT_SEPARATOR)
+    if retcode == createif.RC_SUCCESS:
+        log.info(f"{os.path.basename(__file__)} SUCCEEDED")
+    else:
+        log.info(
+            "%s FAILED: return code = %s (%s) -- see %s",
+            os.path.basename(__file__),
+            retcode,
+            createif.rc2str(retcode),
+            createutils.LOGFILEPATH if createutils.logfilehandler
+                else f"{os.path.basename(__file__)} history")
+    log.info(OUTPUT_SEPARATOR)
+
+#------------------------------------------------------------------------------
+def showHistory(args):
+    """
+    Answer a query of the run history
+    """
+    import history
+    try:
+        return history.show(args)
+    except Exception as e:
+        sys.stderr.write(f"History query failed: {str(e)}\n")
+        return createif.RC_FAILEXC
+
+#------------------------------------------------------------------------------
+def manageArtifacts(args):
+    """
+    Report on, verify or garbage collect the artifact store
+    """
+    import artifacts
+    try:
+        return artifacts.show(args)
+    except Exception as e:
+        sys.stderr.write(f"Artifact store request failed: {str(e)}\n")
+        return createif.RC_FAILEXC
+
+#------------------------------------------------------------------------------
+def watchLoop(args):
+    """
+    Run the configuration, then keep re-running the commands affected by
+    changes to the source tree until interrupted. Changes arriving while a
+    run is in flight cancel it, and are folded into the next run.
+
+    Returns the return code of the last completed run
+    """
+    import threading
+    import plans
+    import processes
+    import scheduler
+    import watch
+    watcher = watch.newWatcher(".")
+    log.info(
+        "Watching for changes (%s), press Ctrl-C to stop",
+        type(watcher).__name__)
+    results = {"retcode": createif.RC_CANCELLED}
+
+    def configChanged(paths):
+        return any(
+            path == "." or path.startswith(plans.CONFIGDIR + os.sep)
+            for path in paths)
+
+    def nextChanges():
+        '''
+            Wait for changes that matter: to a config, or to the inputs of
+            a command. What the commands write themselves is left out, so a
+            run doesn't cancel itself.
+        '''
+        while True:
+            newchanges = watcher.changes()
+            if configChanged(newchanges):
+                return newchanges
+            try:
+                plan, _ = \
+                    plans.loadPlan(
+                        args.config,
+                        usecache=not getattr(args, "no_cache", False))
+                nodes = scheduler.buildGraph(plan, check=False)
+            except Exception:
+                # The next run reports what is wrong with the config
+                return newchanges
+            relevant = watch.relevantChanges(nodes, newchanges)
+            if relevant:
+                return relevant
+            log.debug(
+                f"Ignoring {len(newchanges)} change(s) no command depends on")
+
+    def runOnce(changed, cancel):
+        try:
+            plan, fromcache = \
+                plans.loadPlan(
+                    args.config,
+                    usecache=not getattr(args, "no_cache", False))
+            nodes = scheduler.buildGraph(plan, check=not fromcache)
+            if changed is not None:
+                names = watch.affectedCommands(nodes, changed)
+                names |= scheduler.dependentsOf(nodes, names)
+                if not names:
+                    log.info("No command affected by the changes")
+                    return
+                scheduler.selectNodes(nodes, names)
+            retcode = executeGraph(args, nodes, cancel)
+        except Exception as e:
+            log.error(f"Execution failed on exception: {str(e)}")
+            retcode = createif.RC_FAILEXC
+        if retcode != createif.RC_CANCELLED:
+            results["retcode"] = retcode
+            logResult(retcode)
+
+    changed = None
+    current = None
+    cancel = threading.Event()
+    try:
+        while True:
+            cancel = threading.Event()
+            current = \
+                threading.Thread(
+                    target=runOnce, args=(changed, cancel), daemon=True)
+            current.start()
+            newchanges = nextChanges()
+            cancelled = current.is_alive()
+            if cancelled:
+                log.info("Changes detected, cancelling the current run")
+                cancel.set()
+                processes.terminateAll()
+            current.join()
+            log.info(OUTPUT_SEPARATOR)
+            log.info(
+                "%s changed path(s): %s",
+                len(newchanges),
+                ", ".join(sorted(newchanges)[:5]) +
+                    (", ..." if len(newchanges) > 5 else ""))
+            if configChanged(newchanges):
+                # Config changed (or changes were lost), run everything
+                changed = None
+            elif cancelled and changed is None:
+                # The interrupted full run still has to complete
+                pass
+            elif cancelled:
+                changed = changed | newchanges
+            else:
+                changed = newchanges
+    except KeyboardInterrupt:
+        log.info("Stopped watching")
+        cancel.set()
+        processes.terminateAll()
+        if current:
+            current.join()
+    finally:
+        watcher.close()
+    return results["retcode"]
 
 #------------------------------------------------------------------------------
 # Main
@@ -66,95 +713,102 @@ def main(args):
     """
     Iterate through the specified configuration and execute the stages
     """
+    import threading
+    import plans
+    import scheduler
+    profiler = None
+    if getattr(args, "profile", None) is not None:
+        import profiling
+        profiler = profiling.RunProfiler()
+        profiler.start()
     retcode = createif.RC_SUCCESS
+    clearing = None
+    # Each run of the watch loop logs its own result
+    watched = False
     try:
-        createutils.startLogging()
+        createutils.startLogging(
+            queued=getattr(args, "queued_logging", False),
+            logfile=not getattr(args, "no_log_file", False))
         if args.clear_logs:
-            clearLogs()
+            # Old logs don't need to be gone before the first command runs
+            clearing = threading.Thread(target=clearLogs, daemon=True)
+            clearing.start()
         log.info(OUTPUT_SEPARATOR)
         log.info(f"Using '{args.config}' config")
-        with (open(os.path.join("configs", f"{args.config}.json")) as cf):
-            # Load the execution map from the configuration
-            execmap = json.load(cf)
-        stageorder = execmap.get(STAGE_ORDER_KEY,DEFAULT_STAGE_ORDER)
-        steporder = execmap.get(STEP_ORDER_KEY,DEFAULT_STEP_ORDER)
-        stages = \
-            execmap.get("stages", "ERROR: Stages section missing from config")
-        # Iterate the stages
-        for stage in stageorder:
-            steps = \
-                stages.get(stage, f"ERROR: {stage} missing from stages section")
-            # Iterate the steps in each stage
-            for step in steporder:
-                cmdentries = \
-                    steps.get(
-                        step,
-                        f"ERROR: {step} missing from {stage} section")
-                # Iterate the cmds in each step
-                for cmdentry in cmdentries:
-                    # Get the command if one is specified
-                    cmd = cmdentry.get("cmd", "")
-                    # Use shell by default, unless specified otherwise
-                    executeinshell = cmdentry.get("shell", True)
-                    log.info(OUTPUT_SEPARATOR)
-                    log.info(
-                        "Executing: [stage = {}] - [step = {}] - [cmd = {}]".format(
-                            stage,
-                            step,
-                            cmd if cmd else '(No cmd specified)'))
-                    cc = None
-                    if cmd:
-                        try:
-                            cc = \
-                                subprocess.run(
-                                    cmd if executeinshell else cmd.split(),
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.STDOUT,
-                                    shell=executeinshell,
-                                    cwd=cmdentry.get("cwd", None),
-                                    timeout=cmdentry.get("timeout", None),
-                                    check=cmdentry.get("check", True),
-                                    encoding=cmdentry.get("encoding", "utf-8"))
-                        except Exception as e:
-                            log.error(f"Exception on cmd=[{cmd}]: {str(e)}")
-                            retcode = createif.RC_FAILEXC
-                    if cc:
-                        log.info(f"\tFinished cmd\t: {cmd}")
-                        log.info(f"\tReturn code \t: {cc.returncode}")
-                        log.info(
-                            "\tCaptured Output\t: {}".format(
-                                cc.stdout.replace('\\n', '\n')))
+        if getattr(args, "watch", False):
+            if getattr(args, "coordinator", None):
+                raise Exception("--watch can't be used with --coordinator")
+            retcode = watchLoop(args)
+            watched = True
+        else:
+            # Load the compiled execution plan of the configuration,
+            # compiling and validating it only if its config files changed
+            plan, fromcache = \
+                plans.loadPlan(
+                    args.config, usecache=not getattr(args, "no_cache", False))
+            if fromcache:
+                log.debug("Using cached execution plan")
+            # Build the dependency graph of stages, steps and cmds, then run it
+            nodes = scheduler.buildGraph(plan, check=not fromcache)
+            retcode = executeGraph(args, nodes)
     except Exception as e:
         log.info(OUTPUT_SEPARATOR)
         log.error(
             f"Execution failed on exception: {str(e)}")
         retcode = createif.RC_FAILEXC
-    log.info(OUTPUT_SEPARATOR)
-    if retcode == createif.RC_SUCCESS:
-        log.info(f"{os.path.basename(__file__)} SUCCEEDED")
-    else:
-        log.info(
-            "{} FAILED: return code = {} ({}) -- see {}".format(
-                os.path.basename(__file__),
-                retcode,
-                createif.rc2str(retcode),
-                createutils.LOGFILEPATH))
-    log.info(OUTPUT_SEPARATOR)
+    if clearing:
+        clearing.join()
+    if profiler:
+        profiler.report(
+            profiler.stop(),
+            args.profile or profiling.defaultPath(),
+            top=args.profile_top)
+    if not watched:
+        logResult(retcode)
     # Flush console in case this is used in the context of another script
     createutils.flushconsole()
     return retcode
 
 #------------------------------------------------------------------------------
-if __name__ == '__main__':
+def helpFormatter(prog):
     """
-        Set up the CLI separately to decouple
-        main function from CLI. This allows
-        the main function to be imported in
-        other scripts as an app handler, if
-        needed
+    argparse help formatter sized to the terminal, like its default one, but
+    without argparse importing shutil (with bz2 and lzma) to size it on every
+    run
     """
-    rc = createif.RC_FAILEXC
-    parser = argparse.ArgumentParser()
+    import argparse
+    try:
+        columns = int(os.environ["COLUMNS"])
+    except (KeyError, ValueError):
+        columns = 0
+    if columns <= 0:
+        try:
+            columns = os.get_terminal_size(sys.__stdout__.fileno()).columns
+        except (AttributeError, ValueError, OSError):
+            columns = 0
+    return argparse.HelpFormatter(prog, width=(columns or 80) - 2)
+
+#------------------------------------------------------------------------------
+def positiveInt(value):
+    """
+    argparse type of the counts that must be at least 1
+    """
+    import argparse
+    try:
+        count = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if count < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {count}")
+    return count
+
+#------------------------------------------------------------------------------
+def buildParser():
+    """
+    Returns the CLI parser, shared with create-daemon.py
+    """
+    import argparse
+    parser = argparse.ArgumentParser(formatter_class=helpFormatter)
     parser.add_argument(
         "--version", action="version",
         version=f'{createutils.MODULE_NAME}-v{createutils.MODULE_VERSION}')
@@ -165,12 +819,167 @@ if __name__ == '__main__':
                         action="store",
                         help="Specify a config from the 'configs/' folder",
                         default="guidance")
+    parser.add_argument(
+        "-j", "--jobs", action="store", type=positiveInt,
+        default=createif.DEFAULT_JOBS,
+        help="Maximum number of commands to execute concurrently")
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Always compile the config and execute commands, ignoring "
+             "cached plans and results")
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="Stream command output to the log as it arrives, spooling the "
+             "full output to disk instead of holding it in memory")
+    parser.add_argument(
+        "--queued-logging", action="store_true",
+        help="Hand log records to a background thread that owns the console "
+             "and (batched) log file writes")
+    parser.add_argument(
+        "--shell-pool", action="store", type=int, default=0, metavar="N",
+        help="Run shell commands in a pool of N warm shell workers instead "
+             "of spawning a shell per command")
+    parser.add_argument(
+        "--usage", action="store_true",
+        help="Sample each command's CPU, memory and I/O usage, and summarize "
+             "it at the end of the run")
+    parser.add_argument(
+        "--trace", action="store", metavar="FILE",
+        help="Write a Chrome trace (Perfetto compatible) timeline of the run "
+             "to FILE; implies --usage")
+    parser.add_argument(
+        "--profile", action="store", nargs="?", const="", metavar="FILE",
+        help="Profile CREATE itself, writing a pstats file (to FILE, or "
+             f"under {createutils.OUTPUTDIR}/) and logging where its time "
+             "went")
+    parser.add_argument(
+        "--profile-top", action="store", type=int, default=20, metavar="N",
+        help="Functions listed by --profile (default: %(default)s)")
+    parser.add_argument(
+        "--coordinator", action="store", metavar="ADDRESS",
+        help="Run the config's commands on distributed workers connecting to "
+             "ADDRESS (host:port or unix:/path)")
+    parser.add_argument(
+        "--min-workers", action="store", type=int, default=1, metavar="N",
+        help="Workers a coordinator waits for before starting")
+    parser.add_argument(
+        "--worker", action="store", metavar="ADDRESS",
+        help="Serve as a distributed worker of the coordinator at ADDRESS")
+    parser.add_argument(
+        "--slots", action="store", type=positiveInt,
+        default=os.cpu_count() or 1,
+        help="Commands a worker runs at once")
+    parser.add_argument(
+        "--fail-fast", action="store_true",
+        help="Abort the run once a command fails, in stages that don't "
+             "declare an on_failure policy")
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="Keep running, re-executing the commands whose declared inputs "
+             "change (and those needing them)")
+    parser.add_argument(
+        "--estimate", action="store_true",
+        help="Log the run time predicted from past runs before running, and "
+             "how it compares once done")
+    parser.add_argument(
+        "--no-history", action="store_true",
+        help="Don't record the run in the run history")
+    parser.add_argument(
+        "--no-log-file", action="store_true",
+        help=f"Only log to the console, not to a {createutils.OUTPUTDIR}/ "
+             "file; the run history still records the run")
     # Set parser function to run as main
     parser.set_defaults(func=main)
+    subparsers = parser.add_subparsers(dest="subcommand", metavar="COMMAND")
+    history = \
+        subparsers.add_parser(
+            "history",
+            formatter_class=helpFormatter,
+            help="Query the run history",
+            description="Without options, lists the most recent runs")
+    history.add_argument(
+        "--run", action="store", type=int, metavar="ID",
+        help="List the commands of a run")
+    history.add_argument(
+        "--command", action="store", metavar="NAME",
+        help="List the runs of a command, by name or cmd (wildcards allowed)")
+    history.add_argument(
+        "--stage", action="store", help="Only commands of this stage")
+    history.add_argument(
+        "--step", action="store", help="Only commands of this step")
+    history.add_argument(
+        "--config", dest="config_name", action="store",
+        help="Only runs of this config")
+    history.add_argument(
+        "--failed", action="store_true", help="Only failed runs or commands")
+    history.add_argument(
+        "--since", action="store", metavar="WHEN",
+        help="Only since WHEN: 30m, 12h, 7d or YYYY-MM-DD[ HH:MM]")
+    history.add_argument(
+        "--output", action="store_true",
+        help="Also print the captured output of the listed commands")
+    history.add_argument(
+        "--stats", action="store_true",
+        help="Per command runs, failures, average and longest duration, and "
+             "last failure")
+    history.add_argument(
+        "-n", "--limit", action="store", type=int, default=20,
+        help="Rows listed (default: %(default)s)")
+    history.add_argument(
+        "--prune", action="store_true",
+        help="Apply the retention policy now and compact the store")
+    history.add_argument(
+        "--keep-days", action="store", type=int,
+        default=createif.DEFAULT_HISTORY_KEEP_DAYS,
+        help="Runs kept by --prune, in days (default: %(default)s)")
+    history.add_argument(
+        "--keep-runs", action="store", type=int,
+        default=createif.DEFAULT_HISTORY_KEEP_RUNS,
+        help="Most recent runs kept by --prune (default: %(default)s)")
+    history.add_argument(
+        "--db", action="store", default=createutils.HISTORYPATH,
+        help="Run history database (default: %(default)s)")
+    history.set_defaults(func=showHistory)
+    artifacts = \
+        subparsers.add_parser(
+            "artifacts",
+            formatter_class=helpFormatter,
+            help="Report on, verify or garbage collect the artifact store",
+            description="Without options, reports the store's size")
+    artifacts.add_argument(
+        "--verify", action="store_true",
+        help="Rehash every stored file, dropping the corrupt ones and the "
+             "snapshots using them")
+    artifacts.add_argument(
+        "--gc", action="store_true",
+        help="Evict the least recently used snapshots until the store fits "
+             "its size cap, and delete the files no snapshot uses")
+    artifacts.add_argument(
+        "--max-mb", action="store", type=int, metavar="MB",
+        help="Size cap applied by --gc, instead of the default")
+    artifacts.add_argument(
+        "--store", action="store", default=createutils.ARTIFACTPATH,
+        help="Artifact store folder (default: %(default)s)")
+    artifacts.set_defaults(func=manageArtifacts)
+    return parser
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    """
+        Set up the CLI separately to decouple
+        main function from CLI. This allows
+        the main function to be imported in
+        other scripts as an app handler, if
+        needed
+    """
+    rc = createif.RC_FAILEXC
+    parser = buildParser()
     args = parser.parse_args()
+    if args.worker:
+        args.func = runWorker
     # Go!
     try:
         rc = args.func(args)
     except Exception as e:
         sys.stderr.write("Immediate exception: " + str(e))
-    exit(rc)
\ No newline at end of file
+    exit(rc)
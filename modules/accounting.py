@@ -0,0 +1,397 @@
+"""
+ Script name: accounting.py
+
+ Author: Michael Dello
+ Description:
+    Per-command resource accounting and timeline export
+
+    While a command runs, its process tree is sampled with psutil on a
+    background thread, recording user and system CPU time, peak RSS and I/O
+    bytes. CPU times are cumulative, and a process that was waited for adds
+    its own to its parent's children times, so the CPU time of the tree is
+    the largest sum, over any sample, of the own and children times of its
+    processes: descendants that start and exit between samples are counted
+    through their parent. I/O counters have no such children counterpart,
+    the last value seen for each process of the tree is summed. Peak RSS is
+    the largest total RSS of the tree in any sample. Commands shorter than
+    the sampling interval may exit before the first sample, and only report
+    their wall time.
+
+    In a shell pool, the command runs in a subshell of a long-lived worker
+    (see shellpool.py), and only the subshell and its descendants are
+    sampled. The worker waits for the subshell, so what its short-lived
+    descendants used after the last sample is not counted.
+
+    Finding the descendants of a process walks every process of the host, so
+    the tree is only rescanned every few samples, the processes it found being
+    sampled in between, and the interval between samples grows as the command
+    keeps running.
+
+    The recorded usage is summarized in a table at the end of the run, and can
+    be exported as a Chrome trace (chrome://tracing, ui.perfetto.dev) timeline
+    of stages, steps, commands and attempts.
+"""
+import json
+import threading
+import time
+
+import psutil
+
+import createutils
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+# The interval doubles after each sample, up to the maximum
+SAMPLE_INTERVAL_IN_SECS = 0.05
+MAX_SAMPLE_INTERVAL_IN_SECS = 0.5
+# The process tree is looked up again every this many samples
+TREE_SCAN_EVERY = 2
+
+# Commands listed in the summary table, by wall time
+SUMMARY_TOP = 10
+
+# Trace lanes, commands get one lane per worker thread after these
+LANE_STAGES = 0
+LANE_STEPS = 1
+FIRST_COMMAND_LANE = 2
+
+#-------------------------------------------------------------------------------
+# Local Variables
+#-------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def formatBytes(count):
+    for unit in ("B", "KB", "MB", "GB"):
+        if count < 1024 or unit == "GB":
+            break
+        count /= 1024
+    return f"{count:.0f}{unit}" if unit == "B" else f"{count:.1f}{unit}"
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class TreeSampler(object):
+    """
+        Samples the resource usage of a process and all of its descendants
+        until stopped
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(
+            self,
+            pid,
+            includeroot=True,
+            interval=SAMPLE_INTERVAL_IN_SECS,
+            maxinterval=MAX_SAMPLE_INTERVAL_IN_SECS):
+        '''
+            With includeroot unset only the descendants are accounted for, as
+            for a long-lived shell worker running the command in a subshell
+        '''
+        self.pid = pid
+        self.includeroot = includeroot
+        self.interval = interval
+        self.maxinterval = maxinterval
+        self.root = None
+        # Processes of the tree found by the last scan
+        self.procs = []
+        self.samples = 0
+        self.user = 0.0
+        self.system = 0.0
+        # Last I/O counters seen per pid: (read bytes, write bytes)
+        self.counters = {}
+        self.peakrss = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.__loop, daemon=True)
+
+    #--------------------------------------------------------------------------
+    # Private Methods
+    #--------------------------------------------------------------------------
+    def __scan(self):
+        if self.root is None:
+            self.root = psutil.Process(self.pid)
+        self.procs = self.root.children(recursive=True)
+        if self.includeroot:
+            self.procs.append(self.root)
+
+    def __sample(self):
+        try:
+            if self.samples % TREE_SCAN_EVERY == 0:
+                self.__scan()
+        except psutil.Error:
+            return
+        self.samples += 1
+        rss = 0
+        user = system = 0.0
+        for p in self.procs:
+            try:
+                with p.oneshot():
+                    cpu = p.cpu_times()
+                    rss += p.memory_info().rss
+                    try:
+                        io = p.io_counters()
+                        readbytes, writebytes = \
+                            io.read_bytes, io.write_bytes
+                    except (AttributeError, psutil.AccessDenied):
+                        # Not available on every platform
+                        readbytes = writebytes = 0
+            except psutil.Error:
+                continue
+            # Descendants already waited for are in their parent's children
+            # times
+            user += cpu.user + cpu.children_user
+            system += cpu.system + cpu.children_system
+            self.counters[p.pid] = (readbytes, writebytes)
+        self.peakrss = max(self.peakrss, rss)
+        # A sample taken as processes exit, before they are waited for, may
+        # miss some of the time already seen
+        self.user = max(self.user, user)
+        self.system = max(self.system, system)
+
+    def __loop(self):
+        interval = self.interval
+        while True:
+            self.__sample()
+            if self.stopping.wait(interval):
+                break
+            interval = min(interval * 2, self.maxinterval)
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def totals(self):
+        '''
+            Returns (user, system, peak rss, read bytes, write bytes)
+        '''
+        readbytes = sum(c[0] for c in self.counters.values())
+        writebytes = sum(c[1] for c in self.counters.values())
+        return self.user, self.system, self.peakrss, readbytes, writebytes
+
+#------------------------------------------------------------------------------
+class CommandUsage(object):
+    """
+        Resources used by one command, over all of its attempts
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(self, name, stage, step, lane):
+        self.name = name
+        self.stage = stage
+        self.step = step
+        self.lane = lane
+        self.start = None
+        self.end = None
+        self.user = 0.0
+        self.system = 0.0
+        self.peakrss = 0
+        self.readbytes = 0
+        self.writebytes = 0
+        self.returncode = None
+        self.cached = False
+        # (start, end, returncode) of every process run for this command
+        self.attempts = []
+        self.samplers = []
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def wall(self):
+        return self.end - self.start if self.end is not None else 0.0
+
+    def track(self, process, includeroot=True):
+        '''
+            Start sampling an attempt's process tree; usable as the onstart
+            callback of processes.run() and friends
+        '''
+        sampler = TreeSampler(process.pid, includeroot)
+        self.samplers.append(sampler)
+        self.attempts.append([time.perf_counter(), None, None])
+        sampler.start()
+
+    def trackSubtree(self, process):
+        self.track(process, includeroot=False)
+
+    def attemptDone(self, returncode=None):
+        '''
+            Stop sampling the running attempt, adding up its usage
+        '''
+        if not self.samplers or self.attempts[-1][1] is not None:
+            return
+        sampler = self.samplers[-1]
+        sampler.stop()
+        self.attempts[-1][1:] = [time.perf_counter(), returncode]
+        user, system, peakrss, readbytes, writebytes = sampler.totals()
+        self.user += user
+        self.system += system
+        self.peakrss = max(self.peakrss, peakrss)
+        self.readbytes += readbytes
+        self.writebytes += writebytes
+
+    def describe(self):
+        if self.cached:
+            return f"wall {self.wall():.3f}s (cached)"
+        return "wall {:.3f}s, cpu {:.3f}s user + {:.3f}s sys, peak rss {}, " \
+               "io {} read / {} written".format(
+                   self.wall(),
+                   self.user,
+                   self.system,
+                   formatBytes(self.peakrss),
+                   formatBytes(self.readbytes),
+                   formatBytes(self.writebytes))
+
+#------------------------------------------------------------------------------
+class UsageRecorder(object):
+    """
+        Collects the CommandUsage of every command of a run, safe to use from
+        concurrent threads
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.usages = []
+        self.lanes = {}
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def begin(self, node):
+        '''
+            Start accounting for a command node, run on the calling thread
+        '''
+        with self.lock:
+            lane = \
+                self.lanes.setdefault(
+                    threading.get_ident(),
+                    FIRST_COMMAND_LANE + len(self.lanes))
+            name = \
+                f"{node.name} (retry {node.retries})" if node.retries \
+                else node.name
+            usage = CommandUsage(name, node.stage, node.step, lane)
+            self.usages.append(usage)
+        usage.start = time.perf_counter()
+        return usage
+
+    def finish(self, usage, returncode=None):
+        usage.attemptDone(returncode)
+        if returncode is None and usage.attempts:
+            # Failed attempts report their return code through an exception
+            returncode = usage.attempts[-1][2]
+        usage.returncode = returncode
+        usage.end = time.perf_counter()
+
+    def logSummary(self, logger=log, top=SUMMARY_TOP):
+        finished = [u for u in self.usages if u.end is not None]
+        if not finished:
+            return
+        header = "{:<32} {:>9} {:>9} {:>9} {:>10} {:>10} {:>10}"
+        row = "{:<32} {:>9.3f} {:>9.3f} {:>9.3f} {:>10} {:>10} {:>10}"
+        logger.info("Resource usage (top %s commands by wall time):",
+                    min(top, len(finished)))
+        logger.info(header.format(
+            "command", "wall (s)", "user (s)", "sys (s)", "peak rss",
+            "read", "written"))
+        ranked = sorted(finished, key=lambda u: u.wall(), reverse=True)
+        for u in ranked[:top]:
+            logger.info(row.format(
+                u.name[:32], u.wall(), u.user, u.system,
+                formatBytes(u.peakrss), formatBytes(u.readbytes),
+                formatBytes(u.writebytes)))
+        logger.info(row.format(
+            f"total ({len(finished)} commands)",
+            sum(u.wall() for u in finished),
+            sum(u.user for u in finished),
+            sum(u.system for u in finished),
+            formatBytes(max(u.peakrss for u in finished)),
+            formatBytes(sum(u.readbytes for u in finished)),
+            formatBytes(sum(u.writebytes for u in finished))))
+
+    def traceEvents(self):
+        '''
+            Returns the Chrome trace events of the run: one span per stage and
+            step (from its first command start to its last command end), per
+            command, and per attempt of a command
+        '''
+
+        def us(t):
+            return round((t - self.origin) * 1e6)
+
+        def span(name, cat, lane, start, end, args=None):
+            event = {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": us(start),
+                "dur": max(0, us(end) - us(start)),
+                "pid": 1,
+                "tid": lane
+            }
+            if args:
+                event["args"] = args
+            return event
+
+        finished = [u for u in self.usages if u.end is not None]
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": LANE_STAGES,
+                "args": {"name": "stages"}},
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": LANE_STEPS,
+                "args": {"name": "steps"}}]
+        for lane in sorted(set(self.lanes.values())):
+            events.append(
+                {"name": "thread_name", "ph": "M", "pid": 1, "tid": lane,
+                    "args": {"name": f"worker {lane - FIRST_COMMAND_LANE}"}})
+        groups = {}
+        for u in finished:
+            for key in ((u.stage,), (u.stage, u.step)):
+                start, end = groups.get(key, (u.start, u.end))
+                groups[key] = (min(start, u.start), max(end, u.end))
+        for key, (start, end) in groups.items():
+            if len(key) == 1:
+                events.append(span(key[0], "stage", LANE_STAGES, start, end))
+            else:
+                events.append(
+                    span(f"{key[0]}:{key[1]}", "step", LANE_STEPS, start, end))
+        for u in finished:
+            events.append(
+                span(u.name, "command", u.lane, u.start, u.end, {
+                    "stage": u.stage,
+                    "step": u.step,
+                    "returncode": u.returncode,
+                    "cached": u.cached,
+                    "user_s": round(u.user, 6),
+                    "system_s": round(u.system, 6),
+                    "peak_rss_bytes": u.peakrss,
+                    "read_bytes": u.readbytes,
+                    "write_bytes": u.writebytes}))
+            for index, (start, end, returncode) in enumerate(u.attempts):
+                if end is not None:
+                    events.append(
+                        span(f"{u.name} attempt {index + 1}", "attempt",
+                             u.lane, start, end, {"returncode": returncode}))
+        return events
+
+    def writeTrace(self, path):
+        with open(path, "w") as f:
+            json.dump(
+                {"traceEvents": self.traceEvents(), "displayTimeUnit": "ms"},
+                f)
+        log.info(f"Trace written to {path}")
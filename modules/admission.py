@@ -0,0 +1,184 @@
+"""
+ Script name: admission.py
+
+ Author: Michael Dello
+ Description:
+    Resource-aware admission of concurrently executing commands
+
+    Command entries may declare what they need to run: "cpus", "memory_mb"
+    and "tokens" (names of exclusive resources, such as a database port,
+    that only one running command may hold at a time). A ready command is
+    only started once the host has room for it, judged from live psutil
+    readings of CPU utilization and available memory, on top of what the
+    commands already admitted declared:
+
+      free cpus    cores - max(busy cores, cpus of the running commands)
+      free memory  available memory - memory of the commands that started
+                   less than SETTLE_IN_SECS ago (not allocated yet)
+
+    The scheduler offers ready commands in priority order, and the ones that
+    don't fit are held back while the smaller ones behind them are admitted
+    (first fit). A command held back for STARVATION_LIMIT_IN_SECS stops the
+    commands behind it from being admitted, so it can't starve. With nothing
+    else running, a command is always admitted, even one asking for more
+    than the host has, so a run can't stall.
+
+    Commands declaring nothing are only bounded by --jobs.
+"""
+import time
+
+import psutil
+
+import createutils
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+# Config access keys
+CAK_CPUS = "cpus"
+CAK_MEMORY = "memory_mb"
+CAK_TOKENS = "tokens"
+
+# Live readings are reused for this long
+READING_INTERVAL_IN_SECS = 0.25
+
+# Held back commands are reconsidered this often, as readings change
+POLL_INTERVAL_IN_SECS = 0.25
+
+# Memory of a command that started less than this ago is deemed not to be
+# in use yet, and is taken off the available memory
+SETTLE_IN_SECS = 5
+
+# Memory left for the rest of the host
+RESERVED_MEMORY_MB = 256
+
+STARVATION_LIMIT_IN_SECS = 30
+
+#-------------------------------------------------------------------------------
+# Local Variables
+#-------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def request(node):
+    '''
+        Returns the (cpus, memory in MB, tokens) a command node declared
+    '''
+    cmdentry = node.cmdentry or {}
+    tokens = cmdentry.get(CAK_TOKENS, [])
+    return \
+        cmdentry.get(CAK_CPUS, 0), \
+        cmdentry.get(CAK_MEMORY, 0), \
+        frozenset([tokens] if isinstance(tokens, str) else tokens)
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class Admission(object):
+    """
+        Admission control state of a run: the host's capacity, the latest
+        live readings and the resources held by the running commands. Only
+        used from the scheduler's thread.
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(self, cores=None):
+        self.cores = cores or psutil.cpu_count() or 1
+        self.pollinterval = POLL_INTERVAL_IN_SECS
+        self.totalmemory = psutil.virtual_memory().total / (1024 * 1024)
+        # Start measuring CPU utilization from now on
+        psutil.cpu_percent()
+        self.readat = None
+        self.busy = 0
+        self.available = self.totalmemory
+        # Node -> (cpus, memory, tokens, start time) of the running commands
+        self.held = {}
+        self.tokens = set()
+        self.warned = set()
+
+    #--------------------------------------------------------------------------
+    # Private Methods
+    #--------------------------------------------------------------------------
+    def __read(self):
+        now = time.monotonic()
+        if self.readat is None or \
+                now - self.readat >= READING_INTERVAL_IN_SECS:
+            # Utilization since the previous reading
+            self.busy = psutil.cpu_percent() / 100 * self.cores
+            self.available = \
+                psutil.virtual_memory().available / (1024 * 1024)
+            self.readat = now
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def admits(self, node):
+        '''
+            Returns True if the command node fits in the host's capacity
+            now, and none of its tokens is held
+        '''
+        cpus, memory, tokens = request(node)
+        if tokens & self.tokens:
+            return False
+        if not self.held:
+            if (cpus > self.cores or memory > self.totalmemory) and \
+                    node.name not in self.warned:
+                self.warned.add(node.name)
+                log.warning(
+                    f"{node.name} asks for more than the host has, running "
+                    "it alone")
+            return True
+        if not cpus and not memory:
+            return True
+        self.__read()
+        now = time.monotonic()
+        if cpus:
+            committed = sum(held[0] for held in self.held.values())
+            if cpus > self.cores - max(self.busy, committed):
+                return False
+        if memory:
+            unsettled = sum(
+                held[1] for held in self.held.values()
+                if now - held[3] < SETTLE_IN_SECS)
+            if memory > self.available - unsettled - RESERVED_MEMORY_MB:
+                return False
+        return True
+
+    def starved(self, node):
+        '''
+            Returns True once a held back node waited long enough to stop
+            the nodes behind it from being admitted
+        '''
+        return time.monotonic() - node.readyat >= STARVATION_LIMIT_IN_SECS
+
+    def acquire(self, node):
+        cpus, memory, tokens = request(node)
+        self.held[node] = (cpus, memory, tokens, time.monotonic())
+        self.tokens |= tokens
+
+    def release(self, node):
+        held = self.held.pop(node, None)
+        if held:
+            self.tokens -= held[2]
+
+    def logSummary(self, nodes, logger=log):
+        '''
+            Log how long the commands held back waited for resources
+        '''
+        waited = [node for node in nodes if node.heldback]
+        if not waited:
+            return
+        longest = max(waited, key=lambda node: node.queuewait)
+        logger.info(
+            "Admission: %s command(s) waited for resources, %s in total, "
+            "longest %s (%s)",
+            len(waited),
+            createutils.formatDuration(sum(n.queuewait for n in waited)),
+            createutils.formatDuration(longest.queuewait),
+            longest.name)
@@ -0,0 +1,574 @@
+"""
+ Script name: artifacts.py
+
+ Author: Michael Dello
+ Description:
+    Content-addressed artifact store for the output directories of commands
+
+    Command entries that declare "inputs" (globs) and "artifacts" (output
+    directories) have those directories snapshotted after they succeed.
+    Every file is stored once, as a blob named after the hash of its
+    contents, and a manifest keyed on the command's cache key (see cache.py)
+    lists the files of each directory along with the recorded result. On a
+    matching key, the directories are restored from the blobs instead of
+    running the command again: reflinked (copy-on-write) where the file
+    system supports it, copied otherwise. Every blob is rehashed before it
+    is restored, a corrupt one dropping the snapshot so the command runs.
+
+    Entries setting "hardlink_artifacts" have their files hardlinked to the
+    blobs instead where reflinks aren't supported, saving the copies. Such
+    files share their inode, and read-only mode, with the blob: whatever
+    writes to one in place (after a chmod) corrupts the blob, which is only
+    caught on the next restore or "go-create.py artifacts --verify".
+
+    The store is bounded in size: once a run that stored snapshots is done,
+    the least recently used manifests are evicted, along with the blobs no
+    other manifest references. And
+    "go-create.py artifacts --verify" rehashes every blob, dropping the
+    corrupt ones along with the manifests referencing them.
+"""
+import errno
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+
+import cache
+import createif
+import createutils
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+# Config access keys
+CAK_HARDLINK = "hardlink_artifacts"
+
+ARTIFACTDIR = createutils.ARTIFACTPATH
+BLOBDIR = "blobs"
+MANIFESTDIR = "manifests"
+
+# Bump when the manifest layout changes, older manifests are ignored
+MANIFEST_FORMAT = 1
+
+# Bound the blobs' total size, least recently used manifests are evicted
+# past this
+DEFAULT_ARTIFACT_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+# Unreferenced blobs younger than this may belong to a manifest being
+# written by a concurrent run
+ORPHAN_GRACE_IN_SECS = 3600
+
+# Linux ioctl cloning a file's extents (reflink)
+FICLONE = 0x40049409
+
+# Errors telling a way of linking files isn't available here
+UNSUPPORTED_ERRNOS = {
+    errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOTTY, errno.EOPNOTSUPP,
+    errno.EMLINK}
+
+#-------------------------------------------------------------------------------
+# Local Variables
+#-------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def artifactDirs(cmdentry):
+    '''
+        Returns [(declared directory, path)] of a command entry's artifacts
+    '''
+    cwd = cmdentry.get("cwd", None)
+    return [
+        (directory, os.path.join(cwd, directory) if cwd else directory)
+        for directory in cmdentry.get(cache.CAK_ARTIFACTS, [])]
+
+#------------------------------------------------------------------------------
+def reflink(source, target):
+    '''
+        Clone source's extents into a new target file
+
+        Raises OSError where the file system (or platform) can't
+    '''
+    import fcntl
+    with open(source, "rb") as src:
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            fcntl.ioctl(fd, FICLONE, src.fileno())
+        except OSError:
+            os.close(fd)
+            os.unlink(target)
+            raise
+        os.close(fd)
+
+#------------------------------------------------------------------------------
+def removePath(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class ArtifactStore(object):
+    """
+        Size-bounded store of command output directories, deduplicated per
+        file. Manifest recency is tracked through file modification times,
+        so it survives across runs.
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(
+            self, storedir=ARTIFACTDIR, maxbytes=DEFAULT_ARTIFACT_MAX_BYTES):
+        self.storedir = storedir
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        # Cleared once the file system turns out not to support them
+        self.canreflink = not createutils.THIS_IS_WINDOWS
+        self.canhardlink = True
+        # Blobs hashed intact by this store
+        self.verified = set()
+        # Set once a snapshot is stored, the store is collected on close()
+        self.stored = False
+
+    #--------------------------------------------------------------------------
+    # Private Methods
+    #--------------------------------------------------------------------------
+    def __blobPath(self, digest, executable):
+        # Blobs share their mode with hardlinked files, keep it in the name
+        name = f"{digest}.x" if executable else digest
+        return os.path.join(self.storedir, BLOBDIR, digest[:2], name)
+
+    def __manifestPath(self, key):
+        return os.path.join(self.storedir, MANIFESTDIR, key[:2], f"{key}.json")
+
+    def __readManifest(self, path):
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(manifest, dict) or \
+                manifest.get("format") != MANIFEST_FORMAT:
+            return None
+        return manifest
+
+    def __manifests(self):
+        '''
+            Returns [(mtime, path, manifest)] of the stored manifests
+        '''
+        manifests = []
+        root = os.path.join(self.storedir, MANIFESTDIR)
+        for dirpath, _, names in os.walk(root):
+            for name in names:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(dirpath, name)
+                manifest = self.__readManifest(path)
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    continue
+                manifests.append((mtime, path, manifest))
+        return manifests
+
+    def __blobs(self):
+        '''
+            Returns {blob path: os.stat_result} of the stored blobs
+        '''
+        blobs = {}
+        root = os.path.join(self.storedir, BLOBDIR)
+        for dirpath, _, names in os.walk(root):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                try:
+                    blobs[path] = os.stat(path)
+                except OSError:
+                    pass
+        return blobs
+
+    def __references(self, manifest):
+        return {
+            self.__blobPath(digest, executable)
+            for files in (manifest or {}).get("dirs", {}).values()
+            for _, digest, executable, _, _ in files.get("files", [])}
+
+    def __ingest(self, path, st):
+        '''
+            Store a file as a blob, unless an identical one is stored already
+
+            Returns the file's [digest, executable, size, mtime_ns]
+        '''
+        digest = cache.hashFile(path)
+        executable = bool(st.st_mode & stat.S_IXUSR)
+        blobpath = self.__blobPath(digest, executable)
+        if not os.path.exists(blobpath):
+            os.makedirs(os.path.dirname(blobpath), exist_ok=True)
+            tmppath = \
+                f"{blobpath}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                self.__copy(path, tmppath)
+                os.chmod(tmppath, 0o555 if executable else 0o444)
+                os.utime(tmppath, ns=(st.st_atime_ns, st.st_mtime_ns))
+                os.replace(tmppath, blobpath)
+            finally:
+                if os.path.lexists(tmppath):
+                    os.unlink(tmppath)
+        return [digest, executable, st.st_size, st.st_mtime_ns]
+
+    def __copy(self, source, target):
+        '''
+            Write an independent copy of source, cloning it when possible
+        '''
+        if self.canreflink:
+            try:
+                reflink(source, target)
+                return
+            except (OSError, ImportError) as e:
+                if isinstance(e, ImportError) or \
+                        e.errno in UNSUPPORTED_ERRNOS:
+                    self.canreflink = False
+                else:
+                    raise
+        shutil.copyfile(source, target)
+
+    def __restoreFile(self, blobpath, target, executable, mtime, hardlink):
+        '''
+            Returns True if the file was hardlinked to its blob
+        '''
+        if self.canreflink:
+            try:
+                reflink(blobpath, target)
+                os.chmod(target, 0o755 if executable else 0o644)
+                os.utime(target, ns=(mtime, mtime))
+                return False
+            except (OSError, ImportError) as e:
+                if not isinstance(e, ImportError) and \
+                        e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                self.canreflink = False
+        if hardlink and self.canhardlink:
+            try:
+                os.link(blobpath, target)
+                return True
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                self.canhardlink = False
+        shutil.copyfile(blobpath, target)
+        os.chmod(target, 0o755 if executable else 0o644)
+        os.utime(target, ns=(mtime, mtime))
+        return False
+
+    def __unchanged(self, path, size, mtime):
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return False
+        return stat.S_ISREG(st.st_mode) and st.st_size == size and \
+            st.st_mtime_ns == mtime
+
+    def __intact(self, blobpath, digest):
+        if blobpath in self.verified:
+            return True
+        try:
+            intact = cache.hashFile(blobpath) == digest
+        except OSError:
+            intact = False
+        if intact:
+            self.verified.add(blobpath)
+        return intact
+
+    def __restoreDir(self, root, snapshot, counts, hardlink):
+        '''
+            Make the directory at root match its snapshot, leaving the files
+            that already do alone
+        '''
+        files = {relpath: rest for relpath, *rest in snapshot["files"]}
+        links = dict(snapshot["links"])
+        dirs = set(snapshot["dirs"])
+        # Drop whatever the snapshot doesn't have, deepest paths first
+        if os.path.lexists(root) and not os.path.isdir(root):
+            os.unlink(root)
+        for dirpath, dirnames, names in os.walk(root, topdown=False):
+            for name in names + dirnames:
+                path = os.path.join(dirpath, name)
+                relpath = os.path.relpath(path, root)
+                if relpath in files or relpath in links:
+                    continue
+                if relpath in dirs and os.path.isdir(path) and \
+                        not os.path.islink(path):
+                    continue
+                removePath(path)
+                counts["removed"] += 1
+        os.makedirs(root, exist_ok=True)
+        for relpath in sorted(dirs):
+            path = os.path.join(root, relpath)
+            if os.path.lexists(path) and not os.path.isdir(path):
+                os.unlink(path)
+            os.makedirs(path, exist_ok=True)
+        for relpath, target in links.items():
+            path = os.path.join(root, relpath)
+            if os.path.islink(path) and os.readlink(path) == target:
+                continue
+            removePath(path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.symlink(target, path)
+        for relpath, (digest, executable, size, mtime) in files.items():
+            path = os.path.join(root, relpath)
+            if self.__unchanged(path, size, mtime):
+                counts["unchanged"] += 1
+                continue
+            removePath(path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if self.__restoreFile(
+                    self.__blobPath(digest, executable), path, executable,
+                    mtime, hardlink):
+                counts["linked"] += 1
+            else:
+                counts["copied"] += 1
+
+    def __collect(self, maxbytes):
+        '''
+            Evict the least recently used manifests until the blobs they
+            reference fit in maxbytes, and the blobs nothing references
+
+            Returns (manifests evicted, blobs deleted, bytes freed)
+        '''
+        blobs = self.__blobs()
+        manifests = sorted(self.__manifests())
+        references = {}
+        for _, path, manifest in manifests:
+            for blobpath in self.__references(manifest):
+                references[blobpath] = references.get(blobpath, 0) + 1
+        total = sum(
+            blobs[blobpath].st_size for blobpath in references
+            if blobpath in blobs)
+        evicted = 0
+        # Oldest (least recently used) first
+        for _, path, manifest in manifests:
+            if total <= maxbytes and manifest is not None:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            evicted += 1
+            log.debug(f"Evicted artifacts {path}")
+            for blobpath in self.__references(manifest):
+                references[blobpath] -= 1
+                if not references[blobpath] and blobpath in blobs:
+                    total -= blobs[blobpath].st_size
+        deleted = 0
+        freed = 0
+        now = time.time()
+        for blobpath, st in blobs.items():
+            if references.get(blobpath) or \
+                    now - st.st_ctime < ORPHAN_GRACE_IN_SECS:
+                continue
+            try:
+                os.remove(blobpath)
+                deleted += 1
+                freed += st.st_size
+            except OSError:
+                pass
+        return evicted, deleted, freed
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def restore(self, key, cmdentry):
+        '''
+            Restore the artifact directories of a command entry from the
+            snapshot stored under key
+
+            Returns the recorded result dict, with the restore "counts",
+            or None if there is no usable snapshot
+        '''
+        path = self.__manifestPath(key)
+        manifest = self.__readManifest(path)
+        if not manifest:
+            return None
+        snapshots = manifest.get("dirs", {})
+        if set(snapshots) != {d for d, _ in artifactDirs(cmdentry)}:
+            return None
+        # Only start replacing directories with every blob at hand, and
+        # intact for the files that need restoring
+        for blobpath in self.__references(manifest):
+            if not os.path.isfile(blobpath):
+                log.debug(f"Artifacts {key} lost blob {blobpath}")
+                return None
+        for directory, root in artifactDirs(cmdentry):
+            for relpath, digest, executable, size, mtime in \
+                    snapshots[directory]["files"]:
+                if self.__unchanged(
+                        os.path.join(root, relpath), size, mtime):
+                    continue
+                blobpath = self.__blobPath(digest, executable)
+                if not self.__intact(blobpath, digest):
+                    log.warning(
+                        f"Corrupt artifact blob {blobpath}, dropping "
+                        f"artifacts {key}")
+                    for corrupt in (blobpath, path):
+                        try:
+                            os.remove(corrupt)
+                        except OSError:
+                            pass
+                    return None
+        hardlink = cmdentry.get(CAK_HARDLINK, False)
+        counts = dict.fromkeys(("linked", "copied", "unchanged", "removed"), 0)
+        for directory, root in artifactDirs(cmdentry):
+            self.__restoreDir(root, snapshots[directory], counts, hardlink)
+        # Mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        manifest["counts"] = counts
+        return manifest
+
+    def store(self, key, cmdentry, returncode, output):
+        '''
+            Snapshot the artifact directories of a command entry under key,
+            if it succeeded. The store is only brought back under its cap on
+            close().
+        '''
+        if returncode != 0:
+            return
+        snapshots = {}
+        for directory, root in artifactDirs(cmdentry):
+            snapshot = {"files": [], "links": [], "dirs": []}
+            if not os.path.isdir(root):
+                log.warning(f"Artifact directory {root} missing, not stored")
+                return
+            for dirpath, dirnames, names in os.walk(root):
+                for name in list(dirnames):
+                    path = os.path.join(dirpath, name)
+                    relpath = os.path.relpath(path, root)
+                    if os.path.islink(path):
+                        # Not followed by os.walk, kept as a link
+                        snapshot["links"].append([relpath, os.readlink(path)])
+                    else:
+                        snapshot["dirs"].append(relpath)
+                for name in names:
+                    path = os.path.join(dirpath, name)
+                    relpath = os.path.relpath(path, root)
+                    st = os.lstat(path)
+                    if stat.S_ISLNK(st.st_mode):
+                        snapshot["links"].append([relpath, os.readlink(path)])
+                    elif stat.S_ISREG(st.st_mode):
+                        snapshot["files"].append(
+                            [relpath] + self.__ingest(path, st))
+            snapshots[directory] = snapshot
+        manifest = {
+            "format": MANIFEST_FORMAT,
+            "cmd": cmdentry.get("cmd", ""),
+            "returncode": returncode,
+            "output": output,
+            "dirs": snapshots,
+            "time": time.time()
+        }
+        path = self.__manifestPath(key)
+        with self.lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write atomically so concurrent readers never see partial entries
+            fd, tmppath = \
+                tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(manifest, f)
+            os.replace(tmppath, path)
+            self.stored = True
+
+    def collect(self, maxbytes=None):
+        '''
+            Garbage collect the store down to maxbytes (its own cap if None)
+
+            Returns (manifests evicted, blobs deleted, bytes freed)
+        '''
+        with self.lock:
+            return self.__collect(
+                self.maxbytes if maxbytes is None else maxbytes)
+
+    def close(self):
+        '''
+            Garbage collect the store once the run is done, if it stored
+            anything
+        '''
+        if self.stored:
+            self.stored = False
+            self.collect()
+
+    def verify(self):
+        '''
+            Rehash every blob, deleting the corrupt ones and the manifests
+            referencing them (or blobs gone missing)
+
+            Returns (blobs checked, corrupt blobs, manifests dropped)
+        '''
+        blobs = self.__blobs()
+        corrupt = set()
+        for blobpath, st in blobs.items():
+            name = os.path.basename(blobpath)
+            if name.endswith(".tmp"):
+                continue
+            try:
+                intact = cache.hashFile(blobpath) == name.split(".")[0]
+            except OSError:
+                intact = False
+            if not intact:
+                log.warning(f"Corrupt artifact blob {blobpath}")
+                corrupt.add(blobpath)
+                try:
+                    os.remove(blobpath)
+                except OSError:
+                    pass
+        dropped = 0
+        for _, path, manifest in self.__manifests():
+            references = self.__references(manifest)
+            if manifest is not None and not references & corrupt and \
+                    all(blobpath in blobs for blobpath in references):
+                continue
+            try:
+                os.remove(path)
+                dropped += 1
+            except OSError:
+                pass
+        return len(blobs), len(corrupt), dropped
+
+    def usage(self):
+        '''
+            Returns (manifests, blobs, bytes) of the store
+        '''
+        blobs = self.__blobs()
+        return \
+            len(self.__manifests()), len(blobs), \
+            sum(st.st_size for st in blobs.values())
+
+#------------------------------------------------------------------------------
+def show(args):
+    '''
+        Print the answer to a "go-create.py artifacts" request
+    '''
+    store = ArtifactStore(args.store)
+    if args.verify:
+        checked, corrupt, dropped = store.verify()
+        print(f"Verified {checked} blob(s): {corrupt} corrupt, {dropped} "
+              "snapshot(s) dropped")
+    if args.gc:
+        maxbytes = \
+            args.max_mb * 1024 * 1024 if args.max_mb is not None else None
+        evicted, deleted, freed = store.collect(maxbytes)
+        print(f"Evicted {evicted} snapshot(s), deleted {deleted} blob(s), "
+              f"freed {freed / (1024 * 1024):.1f}MB")
+    manifests, blobs, size = store.usage()
+    print(f"{manifests} snapshot(s), {blobs} blob(s), "
+          f"{size / (1024 * 1024):.1f}MB in {args.store}")
+    return createif.RC_SUCCESS
@@ -0,0 +1,214 @@
+"""
+ Script name: cache.py
+
+ Author: Michael Dello
+ Description:
+    Content-addressed command result cache
+
+    Command entries that declare "inputs" (globs) are keyed on the command
+    string, the shell setting, the working directory, the entry env and the
+    contents of every input file. When a command with the same key already ran
+    and its declared "outputs" are still intact, the recorded return code and
+    output are replayed instead of executing the command again. The store is
+    trimmed back to its size bound once per run, when it is closed.
+"""
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import createutils
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+CACHEDIR = "cache"
+# The result store has its own folder, next to the plans, durations and
+# artifacts kept under CACHEDIR
+RESULTCACHEDIR = os.path.join(CACHEDIR, "results")
+
+# Bound the local store, least recently used entries are evicted past this
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Config access keys
+CAK_INPUTS = "inputs"
+CAK_OUTPUTS = "outputs"
+# Output directories kept in the artifact store (see artifacts.py)
+CAK_ARTIFACTS = "artifacts"
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+#-------------------------------------------------------------------------------
+# Local Variables
+#-------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def hashFile(path):
+    '''
+        Return the sha256 hex digest of a file's contents
+    '''
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+#------------------------------------------------------------------------------
+def expandPaths(patterns, cwd=None):
+    '''
+        Expand globs (relative to cwd) into a sorted list of files, walking
+        any directories that match
+    '''
+    files = set()
+    for pattern in patterns:
+        fullpattern = os.path.join(cwd, pattern) if cwd else pattern
+        for match in glob.glob(fullpattern, recursive=True):
+            if os.path.isdir(match):
+                for root, _, names in os.walk(match):
+                    files.update(os.path.join(root, n) for n in names)
+            elif os.path.isfile(match):
+                files.add(match)
+    return sorted(files)
+
+#------------------------------------------------------------------------------
+def isCacheable(cmdentry):
+    return CAK_INPUTS in cmdentry and bool(cmdentry.get("cmd"))
+
+#------------------------------------------------------------------------------
+def computeKey(cmdentry):
+    '''
+        Compute the content-addressed key of a command entry
+    '''
+    cwd = cmdentry.get("cwd", None)
+    keydata = {
+        "cmd": cmdentry.get("cmd", ""),
+        "shell": cmdentry.get("shell", True),
+        "cwd": os.path.abspath(cwd) if cwd else os.getcwd(),
+        "env": cmdentry.get("env", {}),
+        "outputs": cmdentry.get(CAK_OUTPUTS, []),
+        "inputs": [
+            (path, hashFile(path))
+            for path in expandPaths(cmdentry.get(CAK_INPUTS, []), cwd)]
+    }
+    if CAK_ARTIFACTS in cmdentry:
+        keydata["artifacts"] = cmdentry[CAK_ARTIFACTS]
+    return hashlib.sha256(
+        json.dumps(keydata, sort_keys=True).encode("utf-8")).hexdigest()
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class ResultCache(object):
+    """
+        Size-bounded local store of command results with LRU eviction. Entry
+        recency is tracked through file modification times, so it survives
+        across runs.
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(
+            self, cachedir=RESULTCACHEDIR, maxbytes=DEFAULT_CACHE_MAX_BYTES):
+        self.cachedir = cachedir
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        # Set once an entry is stored, the store is evicted from on close()
+        self.stored = False
+
+    #--------------------------------------------------------------------------
+    # Private Methods
+    #--------------------------------------------------------------------------
+    def __entryPath(self, key):
+        return os.path.join(self.cachedir, key[:2], f"{key}.json")
+
+    def __snapshotOutputs(self, cmdentry):
+        cwd = cmdentry.get("cwd", None)
+        return {
+            path: hashFile(path)
+            for path in expandPaths(cmdentry.get(CAK_OUTPUTS, []), cwd)}
+
+    def __evict(self):
+        entries = []
+        total = 0
+        for path in glob.glob(os.path.join(self.cachedir, "*", "*.json")):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        # Oldest (least recently used) first
+        for _, size, path in sorted(entries):
+            if total <= self.maxbytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                log.debug(f"Evicted cache entry {path}")
+            except OSError:
+                pass
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def lookup(self, key, cmdentry):
+        '''
+            Returns the recorded result dict on a hit with intact outputs,
+            otherwise None
+        '''
+        path = self.__entryPath(key)
+        try:
+            with open(path) as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self.__snapshotOutputs(cmdentry) != result.get("outputs", {}):
+            log.debug(f"Cache entry {key} has stale outputs")
+            return None
+        if not result.get("outputs") and cmdentry.get(CAK_OUTPUTS):
+            # Declared outputs no longer exist
+            return None
+        # Mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return result
+
+    def store(self, key, cmdentry, returncode, output):
+        result = {
+            "cmd": cmdentry.get("cmd", ""),
+            "returncode": returncode,
+            "output": output,
+            "outputs": self.__snapshotOutputs(cmdentry),
+            "time": time.time()
+        }
+        path = self.__entryPath(key)
+        with self.lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write atomically so concurrent readers never see partial entries
+            fd, tmppath = \
+                tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(result, f)
+            os.replace(tmppath, path)
+            self.stored = True
+
+    def close(self):
+        '''
+            Evict least recently used entries past the size bound once the run
+            is done, if it stored anything
+        '''
+        with self.lock:
+            if self.stored:
+                self.stored = False
+                self.__evict()
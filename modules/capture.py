@@ -0,0 +1,283 @@
+"""
+ Script name: capture.py
+
+ Author: Michael Dello
+ Description:
+    Streaming, bounded-memory capture of command output
+
+    Output is read from the command as it arrives, forwarded line by line to a
+    callback (typically the logger), and spooled in full to a file on disk.
+    Only a bounded tail of the output is kept in memory; checks that need the
+    full output read the spool file through a memory map.
+"""
+import collections
+import contextlib
+import mmap
+import os
+import re
+import subprocess
+import threading
+
+import createutils
+import processes
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+# Amount of output kept in memory, the rest only lives in the spool file
+DEFAULT_TAIL_BYTES = 64 * 1024
+
+# How long to wait for the reader once a timed out process is killed, in case
+# a surviving descendant still holds the pipe open
+READER_GRACE_IN_SECS = 1
+
+READ_CHUNK_SIZE = 64 * 1024
+
+#-------------------------------------------------------------------------------
+# Local Variables
+#-------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+spoolcounter = 0
+spoollock = threading.Lock()
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def newSpoolPath(name):
+    '''
+        Return a unique spool file path for this run
+    '''
+    global spoolcounter
+    with spoollock:
+        spoolcounter += 1
+        count = spoolcounter
+    safename = re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+    return os.path.join(
+        createutils.SPOOLDIR,
+        createutils.SPOOLFILENAME.format(
+            createutils.RUNSTAMP, f"{count:04d}-{safename}"))
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class StreamCapture(object):
+    """
+        Consumes a binary output stream, forwarding complete lines to a
+        callback, writing everything to a spool file and retaining a bounded
+        in-memory tail
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(
+            self,
+            spoolpath=None,
+            tailbytes=DEFAULT_TAIL_BYTES,
+            online=None,
+            encoding="utf-8",
+            onchunk=None):
+        '''
+            online(line) is called for each decoded output line, and
+            onchunk(data) for each raw chunk of output as it is read
+        '''
+        self.spoolpath = spoolpath
+        self.tailbytes = tailbytes
+        self.online = online
+        self.onchunk = onchunk
+        self.encoding = encoding
+        self.tail = collections.deque()
+        self.tailsize = 0
+        self.totalbytes = 0
+        self.partial = b""
+        self.thread = None
+        self.spool = None
+        if spoolpath:
+            os.makedirs(os.path.dirname(spoolpath), exist_ok=True)
+            self.spool = open(spoolpath, "wb")
+
+    #--------------------------------------------------------------------------
+    # Private Methods
+    #--------------------------------------------------------------------------
+    def __addTail(self, data):
+        self.tail.append(data)
+        self.tailsize += len(data)
+        # Drop whole chunks from the front while over budget, and trim the
+        # front chunk so the tail never exceeds the budget
+        while self.tailsize > self.tailbytes:
+            excess = self.tailsize - self.tailbytes
+            front = self.tail[0]
+            if len(front) <= excess:
+                self.tail.popleft()
+                self.tailsize -= len(front)
+            else:
+                self.tail[0] = front[excess:]
+                self.tailsize -= excess
+
+    def __forward(self, line):
+        if self.online:
+            self.online(
+                line.rstrip(b"\r\n").decode(
+                    self.encoding, errors="backslashreplace"))
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def feed(self, data):
+        '''
+            Process a chunk of output, forwarding any lines it completes
+        '''
+        self.totalbytes += len(data)
+        if self.onchunk:
+            self.onchunk(data)
+        if self.spool:
+            self.spool.write(data)
+        self.__addTail(data)
+        if not self.online:
+            return
+        lines = (self.partial + data).split(b"\n")
+        for line in lines[:-1]:
+            self.__forward(line)
+        self.partial = lines[-1]
+        # Never hold an unbounded line in memory, forward it in pieces
+        if len(self.partial) > self.tailbytes:
+            self.__forward(self.partial)
+            self.partial = b""
+
+    def finish(self):
+        '''
+            Forward any trailing partial line and flush the spool
+        '''
+        if self.partial:
+            self.__forward(self.partial)
+            self.partial = b""
+        if self.spool:
+            self.spool.flush()
+
+    def consume(self, stream):
+        '''
+            Read the stream until EOF
+        '''
+        read = stream.read1 if hasattr(stream, "read1") else stream.read
+        for data in iter(lambda: read(READ_CHUNK_SIZE), b""):
+            self.feed(data)
+        self.finish()
+
+    def start(self, stream):
+        '''
+            Consume the stream on a background thread
+        '''
+        self.thread = \
+            threading.Thread(target=self.consume, args=(stream,), daemon=True)
+        self.thread.start()
+
+    def join(self, timeout=None):
+        if self.thread:
+            self.thread.join(timeout)
+
+    def close(self):
+        if self.spool:
+            self.spool.close()
+            self.spool = None
+
+    def text(self):
+        '''
+            Return the in-memory tail of the output as a string
+        '''
+        tail = b"".join(self.tail).decode(
+            self.encoding, errors="backslashreplace")
+        if self.totalbytes > self.tailsize:
+            tail = \
+                "... ({} earlier bytes in {}) ...\n{}".format(
+                    self.totalbytes - self.tailsize, self.spoolpath, tail)
+        return tail
+
+    @contextlib.contextmanager
+    def mapped(self):
+        '''
+            Yield a read-only memory map of the full (spooled) output, or the
+            tail bytes when no spool file is used
+        '''
+        if self.spool:
+            self.spool.flush()
+        if not self.spoolpath or not os.path.getsize(self.spoolpath):
+            yield b"".join(self.tail)
+            return
+        with open(self.spoolpath, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield mm
+
+    def contains(self, text):
+        '''
+            Search the full output for text without loading it in memory
+        '''
+        needle = text.encode(self.encoding)
+        with self.mapped() as data:
+            return data.find(needle) != -1
+
+#------------------------------------------------------------------------------
+def run(
+        cmd,
+        shell=True,
+        cwd=None,
+        env=None,
+        timeout=None,
+        check=True,
+        encoding="utf-8",
+        name="cmd",
+        online=None,
+        tailbytes=DEFAULT_TAIL_BYTES,
+        onstart=None):
+    '''
+        Streaming counterpart of subprocess.run(): output is forwarded to
+        online() line by line and spooled to disk, and the returned
+        CompletedProcess holds only the output tail in stdout, plus the
+        StreamCapture as .capture
+
+        onstart(process) is called with the Popen handle once started
+
+        Raises subprocess.TimeoutExpired and subprocess.CalledProcessError like
+        subprocess.run()
+    '''
+    capture = \
+        StreamCapture(
+            spoolpath=newSpoolPath(name),
+            tailbytes=tailbytes,
+            online=online,
+            encoding=encoding)
+    try:
+        with subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                shell=shell,
+                cwd=cwd,
+                env=env,
+                **processes.isolationArgs()) as process:
+            processes.track(process)
+            if onstart:
+                onstart(process)
+            capture.start(process.stdout)
+            try:
+                process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                processes.terminateTree(process)
+                capture.join(READER_GRACE_IN_SECS)
+                raise subprocess.TimeoutExpired(
+                    cmd, timeout, output=capture.text())
+            finally:
+                processes.untrack(process)
+            capture.join()
+        cc = \
+            subprocess.CompletedProcess(
+                cmd, process.returncode, stdout=capture.text())
+        cc.capture = capture
+        if check and process.returncode:
+            raise subprocess.CalledProcessError(
+                process.returncode, cmd, output=cc.stdout)
+        return cc
+    finally:
+        capture.close()
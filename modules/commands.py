@@ -6,12 +6,16 @@
     CREATE command abstractions
 """
 import os
-import psutil
 import subprocess
+import sys
 import time
 
+import capture
 import createif
 import createutils
+import matcher
+import processes
+import retries as retrypolicies
 
 #-------------------------------------------------------------------------------
 # Constants
@@ -24,12 +28,66 @@ DEFAULT_CMD_TIMEOUT_IN_SECS = 360
 DEFAULT_CMD_RETRIES = 0
 DEFAULT_CMD_DELAY = 8
 
+# Number of commands an async command object runs at once on its event loop
+DEFAULT_ASYNC_CONCURRENCY = 32
+
 #-------------------------------------------------------------------------------
 # Local Variables
 #-------------------------------------------------------------------------------
 
 log = createutils.logger.getChild(__name__)
 
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def stripExpected(expectedOutput, logger):
+    '''
+        Map each expected output string to its portable form, as it is
+        searched for in the output
+    '''
+    strippedOutput = {}
+    for checkstring in expectedOutput:
+        # Make output parsing portable
+        strippedcs = checkstring
+        while '\\"' in strippedcs:
+            logger.debug(
+                "Stripping extra \\ characters from %s", strippedcs)
+            strippedcs = strippedcs.replace('\\"', '\"')
+        strippedOutput[checkstring] = strippedcs
+    return strippedOutput
+
+#------------------------------------------------------------------------------
+def outputFailed(
+        outputmatcher, outputcapture, strippedOutput, failonOutput, logger):
+    '''
+        Verify the matched output against the fail and expected strings; all
+        strings were matched in one pass over the output as it arrived
+
+        Returns True if the output makes the command fail
+    '''
+    cmdfailed = False
+    for failstring in failonOutput:
+        logger.debug("Checking for (fail) [%s] in output", failstring)
+        if outputmatcher.isFound(failstring):
+            logger.debug(
+                "Unexpected string [%s] found in output", failstring)
+            cmdfailed = True
+            # Not breaking here to allow full debug information to be logged
+    for checkstring, strippedcs in strippedOutput.items():
+        logger.debug("Checking for [%s] (raw) in output", checkstring)
+        if outputcapture.totalbytes:
+            if not outputmatcher.isFound(strippedcs):
+                logger.debug(
+                    "Expected string [%s] not in output", checkstring)
+                cmdfailed = True
+                # Not breaking here to allow full debug information to be
+                # logged
+        else:
+            logger.debug("Unexpected empty output, can't check expected")
+            cmdfailed = True
+            break
+    return cmdfailed
+
 #------------------------------------------------------------------------------
 # Classes
 #------------------------------------------------------------------------------
@@ -51,6 +109,19 @@ class BaseCommand(object):
             Common init for all command objects
         '''
         self.log = logger.getChild(__name__) if logger else log
+        # Return code of the last attempt of the last executed command
+        self.returncode = None
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def execute(self, cmd, **options):
+        '''
+            Execute the command, see __executeCmd() for the options
+
+            Returns boolean success, and console output
+        '''
+        return self.__executeCmd(cmd, **options)
 
     #--------------------------------------------------------------------------
     # Private Methods
@@ -64,21 +135,49 @@ class BaseCommand(object):
             retries=DEFAULT_CMD_RETRIES,
             delay=DEFAULT_CMD_DELAY,
             timeout=DEFAULT_CMD_TIMEOUT_IN_SECS,
-            cwd=None):
+            cwd=None,
+            stream=False,
+            killonfail=False,
+            retrypolicy=None,
+            env=None,
+            online=None,
+            shell=True):
         '''
             Execute the command within current context, verify expected output
             string(s), with configurable retry and delay in-between each attempt
 
+            Without shell, the command is split on whitespace and run directly
+
+            A retries.RetryPolicy replaces the fixed retries and delay with its
+            backoff, budget and retry conditions
+
+            Output is matched against all expected and fail strings in a single
+            pass as it arrives; with killonfail set, the command's process tree
+            is killed as soon as a fail string shows up instead of waiting for
+            the command to finish
+
+            With stream set, output is logged as it arrives and spooled to
+            disk, only its tail is returned; online(line), if given, receives
+            each line instead of the log (and implies stream)
+
             Returns boolean success, and console output
         '''
-        self.log.debug("Executing command (raw): " + cmd)
+        self.log.debug("Executing command (raw): %s", cmd)
         self.log.debug(
-            "    with timeout = {}".format(
-                timeout if timeout else "NONE"))
+            "    with timeout = %s",
+            timeout if timeout else "NONE")
         success = True
         retry = True
         numretries = 0
+        if retrypolicy is None:
+            retrypolicy = retrypolicies.RetryPolicy(retries, delay)
+        if online:
+            stream = True
+        elif stream:
+            online = lambda line: self.log.debug("    | %s", line)
+        firststart = time.monotonic()
         cmdtoexecute = cmd.replace('\\"', '\"')
+        strippedOutput = stripExpected(expectedOutput, self.log)
         while retry:
             output = ""
             err = ""
@@ -86,40 +185,65 @@ class BaseCommand(object):
             success = True
             self.log.debug("About to run subprocess")
             if cwd is not None:
-                self.log.debug(f"    from folder {cwd}")
-            parentpid = os.getpid()
-            self.log.debug(f"Parent PID {parentpid}")
+                self.log.debug("    from folder %s", cwd)
             with subprocess.Popen(
-                    cmdtoexecute,
+                    cmdtoexecute if shell else cmdtoexecute.split(),
                     # Capture output
                     stdout=subprocess.PIPE,
                     # Capture errors with output
                     stderr=subprocess.STDOUT,
-                    # Encode output as string instead of binary
-                    encoding="utf-8",
-                    errors="backslashreplace",
-                    shell=True,
-                    cwd=cwd) as process:
+                    shell=shell,
+                    cwd=cwd,
+                    env=env,
+                    # Own process group, so only this command's tree is killed
+                    **processes.isolationArgs()) as process:
+                killedonfail = []
+
+                def onFail(failstring):
+                    if killonfail and not killedonfail:
+                        killedonfail.append(failstring)
+                        self.log.debug(
+                            "Killing PID %s early on [%s]",
+                            process.pid, failstring)
+                        processes.killTree(process)
+
+                outputmatcher = \
+                    matcher.OutputMatcher(
+                        expected=strippedOutput.values(),
+                        failon=failonOutput,
+                        onfail=onFail)
+                # Output is consumed as binary and decoded when reported; only
+                # streamed output is bounded in memory and spooled to disk
+                outputcapture = \
+                    capture.StreamCapture(
+                        spoolpath=capture.newSpoolPath("cmd") if stream
+                            else None,
+                        tailbytes=capture.DEFAULT_TAIL_BYTES if stream
+                            else sys.maxsize,
+                        online=online,
+                        onchunk=outputmatcher.feed)
                 try:
-                    self.log.debug(f"Running PID {process.pid}")
-                    output, err = process.communicate(timeout=timeout)
-                    output = f"(stdout): {output}; (stderr): {err}"
+                    self.log.debug("Running PID %s", process.pid)
+                    outputcapture.start(process.stdout)
+                    process.wait(timeout=timeout)
+                    outputcapture.join()
+                    output = \
+                        f"(stdout): {outputcapture.text()}; (stderr): {err}"
                 except subprocess.TimeoutExpired:
                     success = False
                     errmsg = \
                         "FAILURE: {} failed; timeout after {} seconds".format(
                             cmdtoexecute, timeout)
                     self.log.error(errmsg)
-                    # Kill the process tree under parent
+                    # Kill this command's process tree
                     # The documented Python behavior
                     # of subprocess with PIPEs and timeouts does not work
                     # (https://bugs.python.org/issue31447)
-                    # The psutil library can portably kill a "process tree"
-                    psup = psutil.Process(parentpid)
-                    psucs = psup.children(recursive=True)
-                    for c in psucs:
-                        c.kill()
-                    psutil.wait_procs(psucs, timeout=1)
+                    # The command runs in its own process group, so the whole
+                    # tree is signaled without touching other commands
+                    processes.terminateTree(process)
+                    outputcapture.join(capture.READER_GRACE_IN_SECS)
+                    output = outputcapture.text()
                     # Because of the timeout, and process is killed, output is
                     # likely lost
                     output = \
@@ -136,80 +260,306 @@ class BaseCommand(object):
                     # caller determines error condition
                     self.log.warning(errmsg)
                 finally:
+                    outputcapture.close()
                     # Output may have already been captured in some error cases,
                     # if not, capture here
                     # Always log the return output
                     if output:
                         self.log.debug(
-                            "Executed Command [{}] with Output: [{}]".format(
-                                cmd,
-                                output))
+                            "Executed Command [%s] with Output: [%s]",
+                            cmd,
+                            output)
                     else:
                         self.log.debug("No output captured")
+                    if killedonfail:
+                        self.log.debug(
+                            "Command killed early on fail string [%s]",
+                            killedonfail[0])
+                    self.returncode = process.returncode
                     # Verify the return code matched expected
                     if process.returncode == expectedreturncode:
                         self.log.debug(
-                            "Cmd finished w/ expected return code {}".format(
-                                expectedreturncode))
+                            "Cmd finished w/ expected return code %s",
+                            expectedreturncode)
                     else:
                         success = False
                         self.log.debug(
-                            "Command failed on unexpected result [{}]".format(
-                                process.returncode if process.returncode else
-                                    "NONE"))
+                            "Command failed on unexpected result [%s]",
+                            process.returncode if process.returncode else
+                                "NONE")
                     cmdfailed = not success
-                    for failstring in failonOutput:
-                        self.log.debug(
-                            "Checking for (fail) [{}] in output".format(
-                                failstring))
-                        if output and failstring in output:
-                            self.log.debug(
-                                "Unexpected string [{}] found in output".format(
-                                    failstring))
-                            cmdfailed = True
-                            # Not breaking here to allow full debug information
-                            # to be logged
-                    for checkstring in expectedOutput:
-                        self.log.debug(
-                            "Checking for [{}] (raw) in output".format(
-                                checkstring))
-                        # Make output parsing portable
-                        strippedcs = checkstring
-                        while '\\"' in strippedcs:
-                            self.log.debug(
-                                "Stripping extra \\ characters from {}".format(
-                                    strippedcs))
-                            strippedcs = strippedcs.replace('\\"', '\"')
-                        if output:
-                            if strippedcs not in output:
-                                self.log.debug(
-                                    "Expected string [{}] not in output".format(
-                                        checkstring))
-                                cmdfailed = True
-                                # Not breaking here to allow full debug
-                                # information to be logged
-                        else:
-                            self.log.debug(
-                                "Unexpected empty output, can't check expected")
-                            cmdfailed = True
-                            break
+                    if outputFailed(
+                            outputmatcher,
+                            outputcapture,
+                            strippedOutput,
+                            failonOutput,
+                            self.log):
+                        cmdfailed = True
+                    retryafter = \
+                        retrypolicy.nextDelay(
+                            numretries,
+                            process.returncode,
+                            output,
+                            time.monotonic() - firststart) \
+                        if cmdfailed else None
                     if cmdfailed:
-                        if numretries < retries:
+                        if retryafter is not None:
                             self.log.debug(
-                                "Retrying command with {} left".format(
-                                    retries - numretries))
+                                "Retrying command in %.1fs with %s left",
+                                retryafter,
+                                retrypolicy.retries - numretries)
                             numretries += 1
                             retry = True
-                            time.sleep(delay)
+                            time.sleep(retryafter)
                         else:
                             # Stop trying and fail
                             self.log.debug("No more retries, command failed")
                             success = False
         return success, output if output else ""
 
+#------------------------------------------------------------------------------
+class AsyncCommand(BaseCommand):
+    """
+        asyncio-native command, with the same options, expected output, fail
+        output, retry and timeout semantics as BaseCommand. Commands never
+        block the event loop, including while waiting between retries, so many
+        of them can be multiplexed on one loop; a shared semaphore bounds how
+        many subprocesses run at once.
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(self, config={}, logger=None, semaphore=None):
+        # asyncio is only imported once an async command is needed
+        import asyncio
+        super().__init__(config, logger)
+        self.semaphore = \
+            semaphore if semaphore else asyncio.Semaphore(
+                config.get("max_concurrency", DEFAULT_ASYNC_CONCURRENCY))
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    async def execute(self, cmd, **options):
+        '''
+            Execute the command, see __executeCmd() for the options
+
+            Returns boolean success, and console output
+        '''
+        return await self.__executeCmd(cmd, **options)
+
+    #--------------------------------------------------------------------------
+    # Private Methods
+    #--------------------------------------------------------------------------
+    async def __runOnce(
+            self, cmdtoexecute, outputmatcher, killonfail, timeout, cwd, env,
+            stream, online, shell):
+        '''
+            Run one attempt of the command
+
+            Returns the process return code, the output capture, whether the
+            command timed out, and the fail string it was killed on (if any)
+        '''
+        import asyncio
+        # Only streamed output is bounded in memory and spooled to disk
+        outputcapture = \
+            capture.StreamCapture(
+                spoolpath=capture.newSpoolPath("cmd") if stream else None,
+                tailbytes=capture.DEFAULT_TAIL_BYTES if stream
+                    else sys.maxsize,
+                online=online,
+                onchunk=outputmatcher.feed)
+        timedout = False
+        killedonfail = []
+        async with self.semaphore:
+            spawnargs = {
+                "stdout": asyncio.subprocess.PIPE,
+                "stderr": asyncio.subprocess.STDOUT,
+                "cwd": cwd,
+                "env": env,
+                **processes.isolationArgs()
+            }
+            try:
+                if shell:
+                    process = \
+                        await asyncio.create_subprocess_shell(
+                            cmdtoexecute, **spawnargs)
+                else:
+                    process = \
+                        await asyncio.create_subprocess_exec(
+                            *cmdtoexecute.split(), **spawnargs)
+            except OSError:
+                outputcapture.close()
+                raise
+            self.log.debug("Running PID %s", process.pid)
+
+            def onFail(failstring):
+                if killonfail and not killedonfail:
+                    killedonfail.append(failstring)
+                    processes.killTree(process)
+
+            outputmatcher.onfail = onFail
+
+            async def pump():
+                while True:
+                    data = await process.stdout.read(capture.READ_CHUNK_SIZE)
+                    if not data:
+                        break
+                    outputcapture.feed(data)
+                outputcapture.finish()
+
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(pump(), process.wait()), timeout)
+            except asyncio.TimeoutError:
+                timedout = True
+                await processes.terminateTreeAsync(process)
+        return process.returncode, outputcapture, timedout, killedonfail
+
+    async def __executeCmd(
+            self,
+            cmd,
+            expectedreturncode=0,
+            expectedOutput=[],
+            failonOutput=[],
+            retries=DEFAULT_CMD_RETRIES,
+            delay=DEFAULT_CMD_DELAY,
+            timeout=DEFAULT_CMD_TIMEOUT_IN_SECS,
+            cwd=None,
+            stream=False,
+            killonfail=False,
+            retrypolicy=None,
+            env=None,
+            online=None,
+            shell=True):
+        '''
+            Coroutine counterpart of BaseCommand.__executeCmd(), with the same
+            options; online(line) is called from the event loop
+
+            Returns boolean success, and console output
+        '''
+        import asyncio
+        self.log.debug("Executing command (raw, async): %s", cmd)
+        self.log.debug(
+            "    with timeout = %s",
+            timeout if timeout else "NONE")
+        success = True
+        numretries = 0
+        if retrypolicy is None:
+            retrypolicy = retrypolicies.RetryPolicy(retries, delay)
+        if online:
+            stream = True
+        elif stream:
+            online = lambda line: self.log.debug("    | %s", line)
+        firststart = time.monotonic()
+        cmdtoexecute = cmd.replace('\\"', '\"')
+        strippedOutput = stripExpected(expectedOutput, self.log)
+        while True:
+            success = True
+            outputmatcher = \
+                matcher.OutputMatcher(
+                    expected=strippedOutput.values(), failon=failonOutput)
+            try:
+                returncode, outputcapture, timedout, killedonfail = \
+                    await self.__runOnce(
+                        cmdtoexecute,
+                        outputmatcher,
+                        killonfail,
+                        timeout,
+                        cwd,
+                        env,
+                        stream,
+                        online,
+                        shell)
+            except OSError as e:
+                # Reported as a warning, the caller determines error condition
+                self.log.warning(
+                    "OS failed to execute command [%s] due to [%s]",
+                    cmd, os.strerror(e.errno))
+                return False, ""
+            text = outputcapture.text()
+            outputcapture.close()
+            if timedout:
+                # Because of the timeout, and process is killed, output is
+                # likely lost
+                output = \
+                    "(stdout): {}; (stderr): ".format(
+                        text if text else "no output, process killed")
+                success = False
+                self.log.error(
+                    "FAILURE: %s failed; timeout after %s seconds",
+                    cmdtoexecute, timeout)
+            else:
+                output = f"(stdout): {text}; (stderr): "
+            self.log.debug(
+                "Executed Command [%s] with Output: [%s]", cmd, output)
+            if killedonfail:
+                self.log.debug(
+                    "Command killed early on fail string [%s]",
+                    killedonfail[0])
+            # Verify the return code matched expected
+            if returncode == expectedreturncode:
+                self.log.debug(
+                    "Cmd finished w/ expected return code %s",
+                    expectedreturncode)
+            else:
+                success = False
+                self.log.debug(
+                    "Command failed on unexpected result [%s]",
+                    returncode if returncode else "NONE")
+            cmdfailed = not success
+            if outputFailed(
+                    outputmatcher,
+                    outputcapture,
+                    strippedOutput,
+                    failonOutput,
+                    self.log):
+                cmdfailed = True
+            if not cmdfailed:
+                break
+            retryafter = \
+                retrypolicy.nextDelay(
+                    numretries,
+                    returncode,
+                    output,
+                    time.monotonic() - firststart)
+            if retryafter is None:
+                # Stop trying and fail
+                self.log.debug("No more retries, command failed")
+                success = False
+                break
+            self.log.debug(
+                "Retrying command in %.1fs with %s left",
+                retryafter,
+                retrypolicy.retries - numretries)
+            numretries += 1
+            # Yields the event loop (and the semaphore) to other commands
+            await asyncio.sleep(retryafter)
+        return success, output
+
+#------------------------------------------------------------------------------
+async def executeConcurrently(
+        requests, limit=DEFAULT_ASYNC_CONCURRENCY, logger=None):
+    '''
+        Run many commands on the current event loop, at most 'limit' at once
+
+        requests is a list of (cmd, options) tuples, options being the keyword
+        arguments of AsyncCommand.execute()
+
+        Returns the list of (success, output) in request order
+    '''
+    import asyncio
+    command = AsyncCommand(logger=logger, semaphore=asyncio.Semaphore(limit))
+    return await asyncio.gather(
+        *(command.execute(cmd, **options) for cmd, options in requests))
+
 # -------------------------------------------------------------------------------
 def createCmd(version=createif.CV_BASIC, config={}, logger=None):
     """
-        Create a new cmd object based on specified parameters
+        Create a new cmd object based on specified parameters, for callers
+        driving commands themselves: an AsyncCommand for the async version
     """
+    if version == createif.CV_ASYNC:
+        return AsyncCommand(config, logger)
     return BaseCommand(config, logger)
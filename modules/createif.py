@@ -5,6 +5,7 @@
  Description:
     Interface used to execute the main CREATE script
 """
+import os
 
 #-------------------------------------------------------------------------------
 # Return Codes
@@ -12,10 +13,12 @@
 
 # For use in the code so hard coded values aren't used
 RC_SUCCESS = 0
+RC_CANCELLED = 130
 RC_FAILEXC = 255
 
 RCMAP = {
     0: "SUCCESS",
+    130: "CANCELLED",
     255: "FAILURE - Unknown/Unexpected"
 }
 
@@ -27,6 +30,15 @@ def rc2str(retcode):
     return RCMAP.get(retcode, f"ERROR: Unrecognized retcode {retcode}")
 
 
+#-------------------------------------------------------------------------------
+# Config versions
+#-------------------------------------------------------------------------------
+
+# Select the command object commands.createCmd() builds; go-create.py runs
+# its commands through the scheduler's runner, whatever the version
+CV_BASIC = "basic"
+CV_ASYNC = "async"
+
 #-------------------------------------------------------------------------------
 # Default config settings
 #-------------------------------------------------------------------------------
@@ -34,6 +46,7 @@ def rc2str(retcode):
 # These can be optionally overridden in a configuration file
 #
 # Config access keys
+CAK_VERSION = "version"
 CAK_STAGEORDER = "stage_order"
 CAK_STEPORDER = "step_order"
 #
@@ -49,5 +62,43 @@ DEFAULT_STEP_ORDER = [
     "cleanup"
 ]
 
+# Commands executed concurrently
+DEFAULT_JOBS = 1
+
+# Stage setting: what a command failing in the stage does to the run
+CAK_ONFAILURE = "on_failure"
+OF_CONTINUE = "continue"
+OF_SKIPSTAGE = "skip_stage"
+OF_ABORT = "abort"
+ON_FAILURE_POLICIES = (OF_CONTINUE, OF_SKIPSTAGE, OF_ABORT)
+# Policy of the stages that set none, unless the run fails fast
+DEFAULT_ON_FAILURE = OF_CONTINUE
+# Entries of this step still run when the rest of their stage is skipped
+CLEANUP_STEP = "cleanup"
+
+# Run history retention: runs kept, in days and in number of runs
+DEFAULT_HISTORY_KEEP_DAYS = 30
+DEFAULT_HISTORY_KEEP_RUNS = 1000
+# Captured output kept per command attempt in the run history, before
+# compression
+HISTORY_OUTPUT_BYTES = 256 * 1024
+
+# Resident daemon (create-daemon.py), reached by create-client.py
+DAEMON_SOCKET_ENV = "CREATE_DAEMON_SOCKET"
+DAEMON_SOCKET_NAME = "create-daemon-{}.sock"
+# Ends the output streamed back for a run: EXIT_MARKER <nonce> <retcode>\n
+EXIT_MARKER = b"\0CREATE-EXIT "
+
+
+def daemonSocketPath():
+    """
+        Path of the daemon's Unix socket: one per user, unless overridden
+        with the CREATE_DAEMON_SOCKET environment variable
+    """
+    return os.environ.get(DAEMON_SOCKET_ENV) or \
+        os.path.join(
+            os.environ.get("XDG_RUNTIME_DIR") or "/tmp",
+            DAEMON_SOCKET_NAME.format(os.getuid()))
+
 # Prettification
 OUTPUT_SEPARATOR = "-----------------------------------------------------"
@@ -6,6 +6,7 @@
     Common items needed across various CREATE scripts and modules
 """
 import logging
+import threading
 import time
 import os
 import sys
@@ -23,40 +24,223 @@ THIS_IS_WINDOWS = True if "nt" in os.name else False
 # Logging
 OUTPUTDIR   = "logs"
 LOGFILENAME = "create-{}.log"
-THISLOGFILE = LOGFILENAME.format(time.strftime("%y%m%d_%H%M%S"))
+RUNSTAMP = time.strftime("%y%m%d_%H%M%S")
+THISLOGFILE = LOGFILENAME.format(RUNSTAMP)
 LOGFILEPATH = os.path.join(OUTPUTDIR, THISLOGFILE)
+# Full command output spooled to disk by streaming capture
+SPOOLDIR = os.path.join(OUTPUTDIR, "spool")
+SPOOLFILENAME = "create-{}-{}.out"
+# Indexed run history (see history.py)
+HISTORYPATH = os.path.join(OUTPUTDIR, "history.db")
+# Artifact store (see artifacts.py), next to the other caches
+ARTIFACTPATH = os.path.join("cache", "artifacts")
+# Queued logging: the log file is flushed every LOG_BATCH_RECORDS records, or
+# LOG_BATCH_INTERVAL_IN_SECS seconds, whichever comes first
+LOG_BATCH_RECORDS = 256
+LOG_BATCH_INTERVAL_IN_SECS = 1
 
 #------------------------------------------------------------------------------
 # Logging
 #------------------------------------------------------------------------------
 
+LOGFORMAT = \
+    '%(asctime)s - [%(name)17s:%(lineno)-5s] - %(levelname)s - %(message)s'
+
 logger = logging.getLogger(MODULE_NAME)
 logger.setLevel(logging.DEBUG)
-# Console handler
-ch = logging.StreamHandler(sys.stdout)
-# Don't clutter the console
-ch.setLevel(logging.INFO)
-formatter = \
-    logging.Formatter(
-        '%(asctime)s - [%(name)17s:%(lineno)-5s] - %(levelname)s - %(message)s')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
+# Console handler and formatter, built by consoleHandler() when first needed
+ch = None
+formatter = None
 
 logstarted = False
+loglistener = None
+logfilehandler = None
+
+# Serializes emission of log blocks from concurrently executing work
+loglock = threading.Lock()
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class LogBlock(object):
+    '''
+    Collects log messages for a unit of work so they can be emitted as one
+    contiguous block, even when several units of work run concurrently.
+    Messages use lazy %-style arguments, like the logging API, and are
+    reported from where they were added rather than from emit().
+    '''
+    def __init__(self, logger):
+        self.logger = logger
+        self.records = []
+
+    def __add(self, level, msg, args):
+        # Frame of the caller of debug(), info(), ...
+        caller = sys._getframe(2)
+        self.records.append((
+            level, msg, args, caller.f_code.co_filename, caller.f_lineno,
+            caller.f_code.co_name))
+
+    def debug(self, msg, *args):
+        self.__add(logging.DEBUG, msg, args)
+
+    def info(self, msg, *args):
+        self.__add(logging.INFO, msg, args)
+
+    def warning(self, msg, *args):
+        self.__add(logging.WARNING, msg, args)
+
+    def error(self, msg, *args):
+        self.__add(logging.ERROR, msg, args)
+
+    def emit(self):
+        with loglock:
+            for level, msg, args, path, line, function in self.records:
+                if self.logger.isEnabledFor(level):
+                    self.logger.handle(
+                        self.logger.makeRecord(
+                            self.logger.name, level, path, line, msg, args,
+                            None, function))
+        self.records = []
+
+#------------------------------------------------------------------------------
+class BatchedFileHandler(logging.FileHandler):
+    '''
+    File handler that flushes in batches rather than after every record
+    '''
+    def __init__(
+            self,
+            filename,
+            batchrecords=LOG_BATCH_RECORDS,
+            batchinterval=LOG_BATCH_INTERVAL_IN_SECS):
+        super().__init__(filename)
+        self.batchrecords = batchrecords
+        self.batchinterval = batchinterval
+        self.pending = 0
+        self.lastflush = time.monotonic()
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            self.pending += 1
+            if self.pending >= self.batchrecords or \
+                    time.monotonic() - self.lastflush >= self.batchinterval:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.pending = 0
+        self.lastflush = time.monotonic()
+        super().flush()
 
 #------------------------------------------------------------------------------
 # Functions
 #------------------------------------------------------------------------------
-def startLogging():
-    global logstarted
-    # File handler
-    if not os.path.isdir(OUTPUTDIR):
-        os.mkdir(OUTPUTDIR)
-    fh = logging.FileHandler(LOGFILEPATH)
-    # Everything goes in the log file
-    fh.setLevel(logging.DEBUG)
-    fh.setFormatter(formatter)
-    logger.addHandler(fh)
+def newRun(tag=None):
+    '''
+    Start a new run stamp, naming the log and spool files of the run. A
+    resident process runs many times, and concurrent runs started within
+    the same second are told apart by their tag
+    '''
+    global RUNSTAMP, THISLOGFILE, LOGFILEPATH
+    RUNSTAMP = time.strftime("%y%m%d_%H%M%S")
+    if tag:
+        RUNSTAMP = f"{RUNSTAMP}_{tag}"
+    THISLOGFILE = LOGFILENAME.format(RUNSTAMP)
+    LOGFILEPATH = os.path.join(OUTPUTDIR, THISLOGFILE)
+
+#------------------------------------------------------------------------------
+def logLine(logger, msg, *args):
+    '''
+    Log one info message right away, between log blocks rather than in the
+    middle of one, reported from the caller
+    '''
+    with loglock:
+        logger.info(msg, *args, stacklevel=2)
+
+#------------------------------------------------------------------------------
+def formatDuration(duration):
+    '''
+    Human readable duration in seconds, "-" for None
+    '''
+    if duration is None:
+        return "-"
+    if duration < 1:
+        return f"{duration * 1000:.0f}ms"
+    if duration < 60:
+        return f"{duration:.2f}s"
+    return f"{int(duration // 60)}m{duration % 60:04.1f}s"
+
+#------------------------------------------------------------------------------
+def compressOutput(output, maxbytes):
+    '''
+    Returns the last maxbytes of a command's output, zlib compressed, None
+    if there is no output
+    '''
+    if not output:
+        return None
+    import zlib
+    data = output.encode("utf-8", errors="backslashreplace")
+    return zlib.compress(data[-maxbytes:])
+
+#------------------------------------------------------------------------------
+def consoleHandler():
+    '''
+    Returns the console handler, building it and adding it to the logger on
+    the first call. Until then, only warnings and errors reach the console,
+    through logging's last resort handler.
+    '''
+    global ch, formatter
+    if ch is None:
+        formatter = logging.Formatter(LOGFORMAT)
+        ch = logging.StreamHandler(sys.stdout)
+        # Don't clutter the console
+        ch.setLevel(logging.INFO)
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+    return ch
+
+#------------------------------------------------------------------------------
+def startLogging(queued=False, logfile=True):
+    '''
+    Start logging to the log file. In queued mode, callers only enqueue
+    records; a background listener thread owns the console and (batched)
+    file handlers, and formats and writes the records. Without a log file,
+    only the console is logged to.
+    '''
+    global logstarted, loglistener, logfilehandler
+    handlers = [consoleHandler()]
+    if logfile:
+        # File handler
+        if not os.path.isdir(OUTPUTDIR):
+            os.mkdir(OUTPUTDIR)
+        fh = BatchedFileHandler(LOGFILEPATH) if queued \
+            else logging.FileHandler(LOGFILEPATH)
+        # Everything goes in the log file
+        fh.setLevel(logging.DEBUG)
+        fh.setFormatter(formatter)
+        logfilehandler = fh
+        handlers.append(fh)
+    if queued:
+        # Only needed in queued mode, keep them off the startup path
+        import atexit
+        import queue
+        from logging.handlers import QueueHandler, QueueListener
+        logqueue = queue.SimpleQueue()
+        queuehandler = QueueHandler(logqueue)
+        # Leave message formatting to the listener thread; the queue never
+        # leaves this process, so records can be passed as they are
+        queuehandler.prepare = lambda record: record
+        logger.removeHandler(ch)
+        logger.addHandler(queuehandler)
+        loglistener = \
+            QueueListener(
+                logqueue, *handlers, respect_handler_level=True)
+        loglistener.start()
+        # Never lose queued records, even if flushconsole() isn't reached
+        atexit.register(flushconsole)
+    elif logfile:
+        logger.addHandler(fh)
     logstarted = True
 
 #------------------------------------------------------------------------------
@@ -65,8 +249,21 @@ def loggingIsStarted():
 
 #------------------------------------------------------------------------------
 def flushconsole():
+    global loglistener
     # Only need to do this if logging is started
     if logstarted:
+        if loglistener:
+            # Drain the queue and stop the listener, then log synchronously
+            listener = loglistener
+            loglistener = None
+            listener.stop()
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+            logger.addHandler(ch)
+            if logfilehandler:
+                logger.addHandler(logfilehandler)
+        if logfilehandler:
+            logfilehandler.flush()
         ch.flush()
 
 #-------------------------------------------------------------------------------
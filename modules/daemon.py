@@ -0,0 +1,318 @@
+"""
+ Script name: daemon.py
+
+ Author: Michael Dello
+ Description:
+    Resident CREATE daemon, serving runs over a Unix socket
+
+    create-daemon.py keeps the interpreter, CREATE's modules, its logging
+    setup and the execution plans it loaded resident, and create-client.py
+    hands it the go-create.py command line of each run:
+
+      client -> daemon  {"argv": [...], "cwd": ..., "env": {...},
+                         "nonce": ...}                        one JSON line
+                        {"stop": true}                        stop the daemon
+      daemon -> client  the run's console output, then
+                        EXIT_MARKER <nonce> <retcode>\\n
+
+    Each run is forked off the daemon, so concurrent runs are isolated from
+    one another (working directory, environment, log file and module state)
+    while sharing everything the daemon already loaded. The forked run's
+    stdout and stderr are the client's connection, and a client going away
+    cancels its run.
+
+    The plans of the configs run so far are revalidated against their config
+    files before every run and while idle, so an edited config is recompiled
+    by the daemon before the next run needs it.
+"""
+import contextlib
+import importlib
+import io
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+
+import createif
+import createutils
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+# Time a client has to send its request
+REQUEST_TIMEOUT_IN_SECS = 5
+MAX_REQUEST_BYTES = 1 << 20
+
+# Finished runs are reaped, and loaded plans revalidated, this often
+REAP_INTERVAL_IN_SECS = 0.5
+RELOAD_INTERVAL_IN_SECS = 2
+
+# Imported up front, so runs don't pay for them
+WARM_MODULES = (
+    "plans", "scheduler", "processes", "cache", "capture", "commands",
+    "retries", "concurrent.futures", "subprocess")
+
+#-------------------------------------------------------------------------------
+# Local Variables
+#-------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def readRequest(conn):
+    '''
+        Returns the JSON request sent by a client
+
+        Raises OSError or ValueError on an incomplete or invalid request
+    '''
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(64 * 1024)
+        if not chunk:
+            raise ValueError("incomplete request")
+        data += chunk
+        if len(data) > MAX_REQUEST_BYTES:
+            raise ValueError("request too large")
+    request = json.loads(data)
+    if not isinstance(request, dict):
+        raise ValueError("request must be an object")
+    return request
+
+#------------------------------------------------------------------------------
+def stop(path):
+    '''
+        Ask the daemon listening on path to stop
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(b'{"stop": true}\n')
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class Daemon(object):
+    """
+        Accepts run requests and forks a run of go-create.py's main for each
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(self, path, gocreate):
+        self.path = path
+        # The go-create.py module, providing the CLI parser and entry points
+        self.gocreate = gocreate
+        self.parser = gocreate.buildParser()
+        self.parser.prog = "go-create.py"
+        self.listener = None
+        # pid -> (argv, start time) of the runs in progress
+        self.children = {}
+        # (cwd, config) of the configs run so far
+        self.configs = set()
+        self.stopping = False
+
+    #--------------------------------------------------------------------------
+    # Private Methods
+    #--------------------------------------------------------------------------
+    def __listen(self):
+        if os.path.exists(self.path):
+            try:
+                with socket.socket(socket.AF_UNIX) as probe:
+                    probe.connect(self.path)
+                raise Exception(
+                    f"A daemon is already listening on {self.path}")
+            except ConnectionRefusedError:
+                # Left over by a daemon that didn't stop cleanly
+                os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only this user may connect
+        umask = os.umask(0o177)
+        try:
+            self.listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.listener.listen(64)
+
+    def __parseArgs(self, argv):
+        # Quietly, the run itself reports bad arguments to its client
+        with contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            try:
+                return self.parser.parse_args(argv)
+            except SystemExit:
+                return None
+
+    def __loadConfig(self, cwd, config):
+        '''
+            Load (or revalidate) the plan of a config, compiling it if its
+            config files changed; runs forked afterwards inherit it
+        '''
+        import plans
+        try:
+            os.chdir(cwd)
+        except OSError:
+            self.configs.discard((cwd, config))
+            return
+        try:
+            _, fromcache = plans.loadPlan(config)
+            if not fromcache:
+                log.info(f"Loaded '{config}' config of {cwd}")
+        except Exception as e:
+            # The next run of the config reports the error
+            log.debug(f"Could not load '{config}' config of {cwd}: {str(e)}")
+
+    def __reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                break
+            if not pid:
+                break
+            argv, started = self.children.pop(pid, ([], time.monotonic()))
+            log.info(
+                "Run {} [{}] finished with {} in {:.2f}s".format(
+                    pid, " ".join(argv), os.waitstatus_to_exitcode(status),
+                    time.monotonic() - started))
+
+    def __handle(self, conn):
+        conn.settimeout(REQUEST_TIMEOUT_IN_SECS)
+        try:
+            request = readRequest(conn)
+        except (OSError, ValueError) as e:
+            log.warning(f"Dropped invalid request: {str(e)}")
+            return
+        if request.get("stop"):
+            log.info("Stop requested")
+            self.stopping = True
+            return
+        argv = [str(arg) for arg in request.get("argv", [])]
+        cwd = request.get("cwd") or os.getcwd()
+        args = self.__parseArgs(argv)
+        if args and not args.no_cache:
+            self.configs.add((cwd, args.config))
+            self.__loadConfig(cwd, args.config)
+        # Don't let the run inherit (and repeat) buffered daemon output
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            rc = createif.RC_FAILEXC
+            try:
+                rc = self.__run(conn, request, argv, cwd)
+            finally:
+                os._exit(rc)
+        self.children[pid] = (argv, time.monotonic())
+        log.info(f"Run {pid} [{' '.join(argv)}] started in {cwd}")
+
+    def __run(self, conn, request, argv, cwd):
+        '''
+            Forked run of go-create.py's main, with the client's working
+            directory and environment, and the connection as its console
+        '''
+        self.listener.close()
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGCHLD):
+            signal.signal(sig, signal.SIG_DFL)
+        conn.settimeout(None)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+        os.dup2(conn.fileno(), 1)
+        os.dup2(conn.fileno(), 2)
+        os.environ.clear()
+        os.environ.update(request.get("env") or {})
+        createutils.newRun(tag=str(os.getpid()))
+        sys.argv = ["go-create.py"] + argv
+        clientgone = threading.Event()
+        threading.Thread(
+            target=self.__watchClient, args=(conn, clientgone),
+            daemon=True).start()
+        rc = createif.RC_FAILEXC
+        try:
+            os.chdir(cwd)
+            args = self.parser.parse_args(argv)
+            func = self.gocreate.runWorker if args.worker else args.func
+            rc = func(args)
+        except SystemExit as e:
+            rc = e.code if isinstance(e.code, int) else \
+                createif.RC_SUCCESS if e.code is None else createif.RC_FAILEXC
+        except Exception as e:
+            sys.stderr.write("Immediate exception: " + str(e) + "\n")
+        if clientgone.is_set():
+            return createif.RC_CANCELLED
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            conn.sendall(
+                createif.EXIT_MARKER +
+                f"{request.get('nonce', '')} {rc}\n".encode())
+        except OSError:
+            pass
+        return rc
+
+    def __watchClient(self, conn, clientgone):
+        '''
+            Cancel the run once its client goes away
+        '''
+        import processes
+        try:
+            while conn.recv(4096):
+                pass
+        except OSError:
+            pass
+        clientgone.set()
+        processes.terminateAll()
+        os._exit(createif.RC_CANCELLED)
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def serve(self):
+        '''
+            Serve run requests until stopped (by a stop request, SIGTERM or
+            SIGINT); runs in progress are left to finish
+        '''
+        for name in WARM_MODULES:
+            importlib.import_module(name)
+        self.__listen()
+
+        def stopping(signum, frame):
+            self.stopping = True
+
+        signal.signal(signal.SIGTERM, stopping)
+        signal.signal(signal.SIGINT, stopping)
+        log.info(f"CREATE daemon {os.getpid()} listening on {self.path}")
+        lastreload = time.monotonic()
+        try:
+            while not self.stopping:
+                readable, _, _ = \
+                    select.select(
+                        [self.listener], [], [], REAP_INTERVAL_IN_SECS)
+                if readable:
+                    conn, _ = self.listener.accept()
+                    try:
+                        self.__handle(conn)
+                    except Exception as e:
+                        log.error(f"Request failed on exception: {str(e)}")
+                    finally:
+                        conn.close()
+                self.__reap()
+                if time.monotonic() - lastreload >= RELOAD_INTERVAL_IN_SECS:
+                    for cwd, config in list(self.configs):
+                        self.__loadConfig(cwd, config)
+                    lastreload = time.monotonic()
+        finally:
+            self.listener.close()
+            os.unlink(self.path)
+        if self.children:
+            log.info(f"Stopped, leaving {len(self.children)} runs to finish")
+        else:
+            log.info("Stopped")
@@ -0,0 +1,512 @@
+"""
+ Script name: distributed.py
+
+ Author: Michael Dello
+ Description:
+    Distributed execution of command entries across worker processes
+
+    A coordinator (go-create.py --coordinator ADDRESS) loads the config and
+    schedules it as usual, but sends each command entry to one of the workers
+    (go-create.py --worker ADDRESS) registered with it, over TCP
+    ("host:port") or a Unix socket ("unix:/path/to/socket"). Workers run
+    entries through BaseCommand, with its timeout and retry semantics, and
+    stream output lines and the final result back.
+
+    Coordinator and workers share a secret token, read from the
+    CREATE_DISTRIBUTED_TOKEN environment variable, and prove they hold it to
+    each other before any command is sent: each side answers a random
+    challenge of the other with its HMAC-SHA256 under the token. The token
+    itself never goes over the wire.
+
+    Messages are JSON objects, one per line:
+      coordinator -> worker  {"type": "challenge", "nonce": ...}
+      worker -> coordinator  {"type": "hello", "name": ..., "slots": N,
+                                 "auth": HMAC(nonce), "nonce": ...}
+      coordinator -> worker  {"type": "welcome", "auth": HMAC(nonce)}
+      worker -> coordinator  {"type": "heartbeat", "load": L}
+                             {"type": "heartbeat", "load": L}
+                             {"type": "output", "task": ID, "line": ...}
+                             {"type": "done", "task": ID, "returncode": RC,
+                                 "success": bool, "output": ...}
+      coordinator -> worker  {"type": "run", "task": ID, "cmdentry": {...}}
+
+    Commands go to the worker with the most free slots, ties broken by the
+    host load it last reported. A worker that disconnects or stops sending
+    heartbeats is dropped, and the commands it was running are rescheduled on
+    the remaining workers.
+"""
+import hmac
+import itertools
+import json
+import os
+import secrets
+import socket
+import threading
+import time
+
+import createutils
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+UNIX_PREFIX = "unix:"
+
+# Shared secret of a coordinator and its workers
+TOKEN_ENV = "CREATE_DISTRIBUTED_TOKEN"
+
+DEFAULT_WORKER_SLOTS = os.cpu_count() or 1
+
+HEARTBEAT_INTERVAL_IN_SECS = 2
+# A worker silent for this long is considered dead
+HEARTBEAT_TIMEOUT_IN_SECS = 10
+
+# Time a command waits for a worker slot before failing
+WORKER_WAIT_IN_SECS = 60
+
+# Times a command is moved to another worker after losing its worker
+MAX_RESCHEDULES = 3
+
+# Random bytes of a handshake challenge
+NONCE_BYTES = 16
+
+#-------------------------------------------------------------------------------
+# Local Variables
+#-------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class WorkerLost(Exception):
+    pass
+
+#------------------------------------------------------------------------------
+class AuthenticationError(Exception):
+    pass
+
+#------------------------------------------------------------------------------
+class Connection(object):
+    """
+        JSON lines message stream over a connected socket, safe to send on
+        from concurrent threads
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+        self.sendlock = threading.Lock()
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def send(self, message):
+        data = (json.dumps(message) + "\n").encode()
+        with self.sendlock:
+            self.sock.sendall(data)
+
+    def receive(self):
+        '''
+            Returns the next message, None once the peer closed the connection
+
+            Raises OSError (socket.timeout included) on failure
+        '''
+        line = self.reader.readline()
+        return json.loads(line) if line else None
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.reader.close()
+        self.sock.close()
+
+#------------------------------------------------------------------------------
+class Task(object):
+    """
+        A command entry sent to a worker, and its result once done
+    """
+
+    def __init__(self, taskid, name, cmdentry, online):
+        self.id = taskid
+        self.name = name
+        self.cmdentry = cmdentry
+        self.online = online
+        self.worker = None
+        # Done message from the worker, None if the worker was lost
+        self.result = None
+        self.done = threading.Event()
+
+#------------------------------------------------------------------------------
+class RemoteWorker(object):
+    """
+        Coordinator side of a registered worker
+    """
+
+    def __init__(self, connection, name, slots):
+        self.connection = connection
+        self.name = name
+        self.slots = slots
+        self.load = 0.0
+        self.inflight = {}
+        self.alive = True
+
+    def freeSlots(self):
+        return self.slots - len(self.inflight)
+
+#------------------------------------------------------------------------------
+class Coordinator(object):
+    """
+        Accepts worker registrations and dispatches command entries to them
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(self, address, token=None):
+        self.address = address
+        self.token = token or readToken()
+        self.listener = None
+        self.workers = []
+        self.condition = threading.Condition()
+        self.taskids = itertools.count(1)
+        self.closed = False
+
+    #--------------------------------------------------------------------------
+    # Private Methods
+    #--------------------------------------------------------------------------
+    def __accept(self):
+        while not self.closed:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                break
+            threading.Thread(
+                target=self.__serve, args=(sock,), daemon=True).start()
+
+    def __serve(self, sock):
+        sock.settimeout(HEARTBEAT_TIMEOUT_IN_SECS)
+        connection = Connection(sock)
+        worker = None
+        try:
+            nonce = secrets.token_hex(NONCE_BYTES)
+            connection.send({"type": "challenge", "nonce": nonce})
+            hello = connection.receive()
+            if not hello or hello.get("type") != "hello":
+                return
+            if not hmac.compare_digest(
+                    str(hello.get("auth", "")), sign(self.token, nonce)):
+                log.warning(
+                    f"Rejected worker {hello.get('name', 'worker')}: wrong "
+                    "token")
+                return
+            connection.send({
+                "type": "welcome",
+                "auth": sign(self.token, str(hello.get("nonce", "")))})
+            worker = \
+                RemoteWorker(
+                    connection,
+                    hello.get("name", "worker"),
+                    max(1, int(hello.get("slots", 1))))
+            with self.condition:
+                self.workers.append(worker)
+                self.condition.notify_all()
+            log.info(
+                f"Worker {worker.name} registered with {worker.slots} slots")
+            while True:
+                message = connection.receive()
+                if message is None:
+                    break
+                self.__handle(worker, message)
+        except (OSError, ValueError) as e:
+            log.debug(f"Worker connection failed: {str(e)}")
+        finally:
+            if worker:
+                self.__drop(worker)
+            connection.close()
+
+    def __handle(self, worker, message):
+        kind = message.get("type")
+        if kind == "heartbeat":
+            worker.load = message.get("load", 0.0)
+        elif kind == "output":
+            task = worker.inflight.get(message.get("task"))
+            if task and task.online:
+                task.online(message.get("line", ""))
+        elif kind == "done":
+            with self.condition:
+                task = worker.inflight.pop(message.get("task"), None)
+                self.condition.notify_all()
+            if task:
+                task.result = message
+                task.done.set()
+
+    def __drop(self, worker):
+        with self.condition:
+            if not worker.alive:
+                return
+            worker.alive = False
+            if worker in self.workers:
+                self.workers.remove(worker)
+            lost = list(worker.inflight.values())
+            worker.inflight.clear()
+            self.condition.notify_all()
+        if not self.closed:
+            log.warning(
+                f"Worker {worker.name} lost with {len(lost)} command(s) "
+                "running")
+        for task in lost:
+            task.done.set()
+
+    def __pickWorker(self):
+        # Most free slots first, then the least loaded host
+        candidates = [w for w in self.workers if w.freeSlots() > 0]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda w: (w.freeSlots(), -w.load))
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def start(self):
+        family, address = parseAddress(self.address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen()
+        threading.Thread(target=self.__accept, daemon=True).start()
+        log.info(f"Coordinator listening on {self.address}")
+
+    def waitForWorkers(self, count, timeout=WORKER_WAIT_IN_SECS):
+        '''
+            Returns True once at least count workers are registered, False if
+            they didn't show up within timeout seconds
+        '''
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: len(self.workers) >= count, timeout)
+
+    def totalSlots(self):
+        with self.condition:
+            return sum(w.slots for w in self.workers)
+
+    def run(self, name, cmdentry, online=None):
+        '''
+            Run a command entry on a worker, waiting for a free slot and
+            rescheduling it if its worker is lost
+
+            online(line, worker name) receives output as it arrives
+
+            Returns (the worker's done message, worker name). Raises
+            WorkerLost when no worker could complete the command
+        '''
+        for attempt in range(MAX_RESCHEDULES + 1):
+            task = None
+            with self.condition:
+                worker = \
+                    self.condition.wait_for(
+                        self.__pickWorker, WORKER_WAIT_IN_SECS)
+                if not worker:
+                    raise WorkerLost(
+                        f"No worker slot available for {name} after "
+                        f"{WORKER_WAIT_IN_SECS}s")
+                task = \
+                    Task(
+                        next(self.taskids),
+                        name,
+                        cmdentry,
+                        (lambda line, w=worker.name: online(line, w))
+                            if online else None)
+                task.worker = worker
+                worker.inflight[task.id] = task
+            try:
+                worker.connection.send(
+                    {"type": "run", "task": task.id, "cmdentry": cmdentry})
+            except OSError:
+                self.__drop(worker)
+            task.done.wait()
+            if task.result is not None:
+                return task.result, worker.name
+            log.warning(f"Rescheduling {name}, lost worker {worker.name}")
+        raise WorkerLost(
+            f"{name} lost its worker {MAX_RESCHEDULES + 1} times")
+
+    def close(self):
+        self.closed = True
+        if self.listener:
+            self.listener.close()
+            family, address = parseAddress(self.address)
+            if family == socket.AF_UNIX and os.path.exists(address):
+                os.remove(address)
+        with self.condition:
+            workers = list(self.workers)
+        for worker in workers:
+            worker.connection.close()
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def parseAddress(address):
+    '''
+        Returns (socket family, address) for "unix:/path" or "host:port"
+    '''
+    if address.startswith(UNIX_PREFIX):
+        return socket.AF_UNIX, address[len(UNIX_PREFIX):]
+    host, sep, port = address.rpartition(":")
+    if not sep or not port.isdigit():
+        raise ValueError(
+            f"Invalid address '{address}', expected host:port or unix:/path")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+#------------------------------------------------------------------------------
+def readToken():
+    '''
+        Returns the shared token from the environment
+
+        Raises AuthenticationError if it isn't set
+    '''
+    token = os.environ.get(TOKEN_ENV)
+    if not token:
+        raise AuthenticationError(
+            f"Set {TOKEN_ENV} to the token shared by the coordinator and its "
+            "workers")
+    return token
+
+#------------------------------------------------------------------------------
+def sign(token, nonce):
+    return hmac.new(token.encode(), nonce.encode(), "sha256").hexdigest()
+
+#------------------------------------------------------------------------------
+def connect(address, timeout=WORKER_WAIT_IN_SECS):
+    '''
+        Connect to a coordinator, retrying until it is up or timeout
+    '''
+    family, address = parseAddress(address)
+    deadline = time.monotonic() + timeout
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+            return sock
+        except OSError:
+            sock.close()
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.2)
+
+#------------------------------------------------------------------------------
+def hostLoad():
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return 0.0
+
+#------------------------------------------------------------------------------
+def runTask(connection, message):
+    '''
+        Run a command entry received from the coordinator through BaseCommand
+        and send its output and result back
+    '''
+    import commands
+    import retries
+    taskid = message["task"]
+    cmdentry = message["cmdentry"]
+    command = commands.BaseCommand(logger=log)
+    result = {"type": "done", "task": taskid}
+
+    def online(line):
+        try:
+            connection.send({"type": "output", "task": taskid, "line": line})
+        except OSError:
+            pass
+
+    try:
+        env = cmdentry.get("env")
+        success, output = \
+            command.execute(
+                cmdentry.get("cmd", ""),
+                shell=cmdentry.get("shell", True),
+                timeout=cmdentry.get("timeout"),
+                cwd=cmdentry.get("cwd"),
+                env=dict(os.environ, **env) if env else None,
+                retrypolicy=retries.RetryPolicy.fromConfig(cmdentry["retry"])
+                    if "retry" in cmdentry else None,
+                online=online)
+        result.update(
+            returncode=command.returncode, success=success, output=output)
+    except Exception as e:
+        result.update(
+            returncode=None, success=False, output=f"Worker exception: {e}")
+    try:
+        connection.send(result)
+    except OSError:
+        pass
+
+#------------------------------------------------------------------------------
+def serve(address, slots=DEFAULT_WORKER_SLOTS, name=None, token=None):
+    '''
+        Run as a worker of the coordinator at address, until it disconnects
+
+        Raises AuthenticationError if the coordinator doesn't hold the token
+        (or doesn't accept this worker's)
+    '''
+    token = token or readToken()
+    connection = Connection(connect(address))
+    name = name or f"{socket.gethostname()}-{os.getpid()}"
+    try:
+        connection.sock.settimeout(HEARTBEAT_TIMEOUT_IN_SECS)
+        challenge = connection.receive()
+        if not challenge or challenge.get("type") != "challenge":
+            raise AuthenticationError(f"No challenge from {address}")
+        nonce = secrets.token_hex(NONCE_BYTES)
+        connection.send({
+            "type": "hello", "name": name, "slots": slots,
+            "auth": sign(token, str(challenge.get("nonce", ""))),
+            "nonce": nonce})
+        welcome = connection.receive()
+        if not welcome or welcome.get("type") != "welcome":
+            raise AuthenticationError(
+                f"Coordinator at {address} rejected the token")
+        if not hmac.compare_digest(
+                str(welcome.get("auth", "")), sign(token, nonce)):
+            raise AuthenticationError(
+                f"Coordinator at {address} doesn't hold the token")
+        connection.sock.settimeout(None)
+    except (AuthenticationError, OSError, ValueError):
+        connection.close()
+        raise
+    log.info(f"Worker {name} connected to {address} with {slots} slots")
+    stopping = threading.Event()
+
+    def heartbeat():
+        while not stopping.wait(HEARTBEAT_INTERVAL_IN_SECS):
+            try:
+                connection.send({"type": "heartbeat", "load": hostLoad()})
+            except OSError:
+                break
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    try:
+        while True:
+            message = connection.receive()
+            if message is None:
+                break
+            if message.get("type") == "run":
+                threading.Thread(
+                    target=runTask,
+                    args=(connection, message),
+                    daemon=True).start()
+    except OSError as e:
+        log.debug(f"Coordinator connection failed: {str(e)}")
+    finally:
+        stopping.set()
+        connection.close()
+    log.info(f"Worker {name} disconnected")
@@ -0,0 +1,124 @@
+"""
+ Script name: durations.py
+
+ Author: Michael Dello
+ Description:
+    Per command duration model, learned from past runs
+
+    The wall time of each command that succeeds (without replaying a cached
+    result) is folded into an exponentially weighted moving average, kept
+    per config in a small JSON stats file under cache/. The scheduler uses
+    the predictions to start the longest critical paths first when commands
+    run concurrently, and to predict a run's duration (--estimate).
+"""
+import json
+import os
+
+import createif
+import createutils
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+MODELPATH = os.path.join("cache", "durations.json")
+
+# Bump when the stats file layout changes, older ones are discarded
+MODEL_FORMAT = 1
+
+# Weight of the latest duration in the moving average
+ALPHA = 0.3
+
+#-------------------------------------------------------------------------------
+# Local Variables
+#-------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def readStats(path):
+    '''
+        Returns {config: {command name: [average, samples]}} from the stats
+        file, empty if there is none (or it can't be used)
+    '''
+    try:
+        with open(path) as f:
+            stats = json.load(f)
+        if stats.get("format") == MODEL_FORMAT and \
+                isinstance(stats.get("configs"), dict):
+            return stats["configs"]
+    except (OSError, ValueError, AttributeError):
+        pass
+    return {}
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class DurationModel(object):
+    """
+        Predicted command durations of a config
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(self, config, path=MODELPATH):
+        self.config = config
+        self.path = path
+        # Command name -> [average duration in seconds, samples]
+        self.commands = readStats(path).get(config, {})
+        averages = [average for average, _ in self.commands.values()]
+        # Commands without history are predicted to take the average time
+        self.default = sum(averages) / len(averages) if averages else 0
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def known(self, node):
+        return node.name in self.commands
+
+    def estimate(self, node):
+        '''
+            Returns the predicted duration of a command node, in seconds
+        '''
+        if node.isBarrier() or not node.cmdentry.get("cmd"):
+            return 0
+        stats = self.commands.get(node.name)
+        return stats[0] if stats else self.default
+
+    def update(self, nodes):
+        '''
+            Fold the durations of the commands that succeeded in a run into
+            the model, forgetting commands no longer in the config
+        '''
+        names = {node.name for node in nodes}
+        self.commands = {
+            name: stats for name, stats in self.commands.items()
+            if name in names}
+        for node in nodes:
+            if node.isBarrier() or node.duration is None or node.cached or \
+                    node.retcode != createif.RC_SUCCESS:
+                continue
+            stats = self.commands.get(node.name)
+            if stats:
+                stats[0] = ALPHA * node.duration + (1 - ALPHA) * stats[0]
+                stats[1] += 1
+            else:
+                self.commands[node.name] = [node.duration, 1]
+
+    def save(self):
+        '''
+            Write the model back, keeping the other configs' as they are now
+        '''
+        configs = readStats(self.path)
+        configs[self.config] = self.commands
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmppath = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmppath, "w") as f:
+                json.dump({"format": MODEL_FORMAT, "configs": configs}, f)
+            os.replace(tmppath, self.path)
+        except OSError as e:
+            log.debug(f"Could not save command durations: {str(e)}")
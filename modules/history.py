@@ -0,0 +1,419 @@
+"""
+ Script name: history.py
+
+ Author: Michael Dello
+ Description:
+    Indexed run history, kept in an embedded SQLite database
+
+    Every run of a config is recorded in HISTORYPATH, along with each
+    attempt of each of its commands: stage, step, return code, start time,
+    duration and the captured output (zlib compressed, at most its last
+    createif.HISTORY_OUTPUT_BYTES). The attempts are kept on the command
+    nodes while the run goes (see scheduler.Node.attempts), and the whole run
+    is written out once it is done, keeping SQLite off the run's startup.
+    Queries such as "when did this command last fail, and how long did it
+    take" go through indexes rather than log files, see
+    "go-create.py history -h".
+
+    Runs older than KEEP_DAYS, and runs beyond the KEEP_RUNS most recent, are
+    pruned as new runs finish. The database uses incremental auto-vacuum, so
+    the pages they freed are handed back to the file system once enough of
+    them accumulate. Concurrent runs (and the daemon's) share the database in
+    WAL mode.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+import createif
+import createutils
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+HISTORYPATH = createutils.HISTORYPATH
+
+# Bump when the schema changes; older databases are recreated
+SCHEMA_VERSION = 1
+
+# Retention
+KEEP_DAYS = createif.DEFAULT_HISTORY_KEEP_DAYS
+KEEP_RUNS = createif.DEFAULT_HISTORY_KEEP_RUNS
+# Compact once this share of the database's pages is free
+COMPACT_FREE_RATIO = 0.25
+
+# Time to wait on a concurrent writer
+BUSY_TIMEOUT_IN_SECS = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    config TEXT NOT NULL,
+    cwd TEXT NOT NULL,
+    argv TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    logfile TEXT,
+    started REAL NOT NULL,
+    duration REAL,
+    returncode INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE INDEX IF NOT EXISTS runs_config ON runs (config, started);
+CREATE INDEX IF NOT EXISTS runs_returncode ON runs (returncode, started);
+CREATE TABLE IF NOT EXISTS commands (
+    id INTEGER PRIMARY KEY,
+    run INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    stage TEXT,
+    step TEXT,
+    cmd TEXT NOT NULL,
+    attempt INTEGER NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    returncode INTEGER,
+    failed INTEGER NOT NULL,
+    cached INTEGER NOT NULL,
+    output BLOB
+);
+CREATE INDEX IF NOT EXISTS commands_run ON commands (run);
+CREATE INDEX IF NOT EXISTS commands_name
+    ON commands (name, started, duration, failed);
+CREATE INDEX IF NOT EXISTS commands_stage ON commands (stage, step, started);
+CREATE INDEX IF NOT EXISTS commands_returncode
+    ON commands (returncode, started);
+CREATE INDEX IF NOT EXISTS commands_failed ON commands (failed, started);
+CREATE INDEX IF NOT EXISTS commands_duration ON commands (duration);
+CREATE INDEX IF NOT EXISTS commands_started ON commands (started);
+"""
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+SINCE_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+#-------------------------------------------------------------------------------
+# Local Variables
+#-------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def decompress(blob):
+    if not blob:
+        return ""
+    return zlib.decompress(blob).decode("utf-8", errors="backslashreplace")
+
+#------------------------------------------------------------------------------
+def isGlob(pattern):
+    return any(c in pattern for c in "*?[")
+
+#------------------------------------------------------------------------------
+def parseSince(since):
+    '''
+        Returns the timestamp of "30m", "12h", "7d" ago, or of a
+        "YYYY-MM-DD[ HH:MM[:SS]]" local time
+
+        Raises ValueError on anything else
+    '''
+    match = re.fullmatch(r"(\d+)([smhdw])", since.strip())
+    if match:
+        return time.time() - int(match.group(1)) * SINCE_UNITS[match.group(2)]
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(since.strip(), fmt))
+        except ValueError:
+            continue
+    raise ValueError(
+        f"Invalid time '{since}', expected e.g. 30m, 12h, 7d or YYYY-MM-DD")
+
+#------------------------------------------------------------------------------
+def formatTime(timestamp):
+    return time.strftime(TIME_FORMAT, time.localtime(timestamp))
+
+#------------------------------------------------------------------------------
+def formatTable(header, rows):
+    '''
+        Returns rows of strings as left aligned text columns
+    '''
+    rows = [header] + [[str(v) for v in row] for row in rows]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return "\n".join(
+        "  ".join(v.ljust(w) for v, w in zip(row, widths)).rstrip()
+        for row in rows)
+
+#------------------------------------------------------------------------------
+def show(args):
+    '''
+        Print the answer to a "go-create.py history" query
+    '''
+    formatDuration = createutils.formatDuration
+    since = parseSince(args.since) if args.since else None
+    if not os.path.exists(args.db):
+        print(f"No run history yet ({args.db})")
+        return createif.RC_SUCCESS
+    history = RunHistory(args.db)
+    try:
+        if args.prune:
+            deleted = \
+                history.prune(
+                    keepdays=args.keep_days, keepruns=args.keep_runs,
+                    compact=True)
+            print(f"Pruned {deleted} run(s)")
+        elif args.stats:
+            print(formatTable(
+                ["COMMAND", "RUNS", "FAILED", "AVERAGE", "LONGEST",
+                 "LAST FAILURE"],
+                [(name, count, failures, formatDuration(average),
+                  formatDuration(longest),
+                  formatTime(lastfailure) if lastfailure else "-")
+                 for name, count, failures, average, longest, lastfailure
+                 in history.stats(args.command, since, args.limit)]))
+        elif args.run is not None or args.command or args.stage or \
+                args.step:
+            if args.run is not None:
+                info = history.runInfo(args.run)
+                if not info:
+                    print(f"No run {args.run}")
+                    return createif.RC_FAILEXC
+                run, config, cwd, argv, logfile, started, duration, rc = info
+                print(f"Run {run}: '{config}' config in {cwd}, started "
+                      f"{formatTime(started)}, took {formatDuration(duration)}"
+                      f", return code {rc if rc is not None else '-'}")
+                print(f"Arguments: {' '.join(json.loads(argv)) or '-'}, "
+                      f"log: {logfile or '-'}")
+            rows = \
+                history.commands(
+                    run=args.run, name=args.command, stage=args.stage,
+                    step=args.step, since=since, failed=args.failed,
+                    limit=args.limit, output=args.output)
+            print(formatTable(
+                ["RUN", "STARTED", "COMMAND", "STAGE", "STEP", "TRY",
+                 "DURATION", "RC", "STATUS"],
+                [(row[0], formatTime(row[6]), row[1], row[2] or "-",
+                  row[3] or "-", row[5], formatDuration(row[7]),
+                  "-" if row[8] is None else row[8],
+                  ("FAILED" if row[9] else "OK") +
+                    (" (cached)" if row[10] else ""))
+                 for row in rows]))
+            if args.output:
+                for row in rows:
+                    print(createif.OUTPUT_SEPARATOR)
+                    print(f"[run {row[0]}] {row[1]}: {row[4]}")
+                    print(row[11].rstrip("\n") or "(no output)")
+        else:
+            print(formatTable(
+                ["RUN", "STARTED", "CONFIG", "DURATION", "RC", "COMMANDS",
+                 "FAILED"],
+                [(run, formatTime(started), config, formatDuration(duration),
+                  "-" if rc is None else rc, commands, failures)
+                 for run, started, config, duration, rc, commands, failures
+                 in history.runs(
+                     args.config_name, since, args.failed, args.limit)]))
+    finally:
+        history.close()
+    return createif.RC_SUCCESS
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class RunHistory(object):
+    """
+        The run history database
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(self, path=HISTORYPATH):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.db = \
+            sqlite3.connect(
+                path,
+                timeout=BUSY_TIMEOUT_IN_SECS,
+                check_same_thread=False)
+        self.lock = threading.Lock()
+        self.__initSchema()
+
+    #--------------------------------------------------------------------------
+    # Private Methods
+    #--------------------------------------------------------------------------
+    def __initSchema(self):
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            # Only takes effect before the first table is created, or on
+            # the next VACUUM
+            self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            if version:
+                log.debug(f"Recreating run history of schema {version}")
+                self.db.executescript(
+                    "DROP TABLE IF EXISTS commands; "
+                    "DROP TABLE IF EXISTS runs;")
+                self.db.execute("VACUUM")
+            self.db.executescript(SCHEMA)
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute("PRAGMA foreign_keys = ON")
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def recordRun(self, config, argv, started, duration, returncode, nodes):
+        '''
+            Record a finished run, started at the given time, along with the
+            attempts of its command nodes, then apply the retention policy
+        '''
+        logfile = \
+            createutils.LOGFILEPATH if createutils.logfilehandler else None
+        try:
+            with self.lock:
+                with self.db:
+                    run = \
+                        self.db.execute(
+                            "INSERT INTO runs (config, cwd, argv, pid, "
+                            "logfile, started, duration, returncode) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (config, os.getcwd(), json.dumps(argv or []),
+                             os.getpid(), logfile, started, duration,
+                             returncode)).lastrowid
+                    self.db.executemany(
+                        "INSERT INTO commands (run, name, stage, step, cmd, "
+                        "attempt, started, duration, returncode, failed, "
+                        "cached, output) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(run, node.name, node.stage, node.step,
+                          node.cmdentry.get("cmd", "")) + attempt
+                         for node in nodes for attempt in node.attempts])
+            self.prune()
+        except sqlite3.Error as e:
+            # Never fail a run over its history
+            log.warning(f"Could not record run history: {str(e)}")
+
+    def prune(self, keepdays=KEEP_DAYS, keepruns=KEEP_RUNS, compact=False):
+        '''
+            Delete the runs (and their commands) older than keepdays or
+            beyond the keepruns most recent, compacting the database when
+            enough of it is free, or always if asked to
+
+            Returns the number of runs deleted
+        '''
+        with self.lock:
+            with self.db:
+                deleted = \
+                    self.db.execute(
+                        "DELETE FROM runs WHERE started < ? OR id IN "
+                        "(SELECT id FROM runs ORDER BY started DESC "
+                        "LIMIT -1 OFFSET ?)",
+                        (time.time() - keepdays * 86400, keepruns)).rowcount
+            pages = self.db.execute("PRAGMA page_count").fetchone()[0]
+            free = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+            if compact or (pages and free / pages >= COMPACT_FREE_RATIO):
+                self.db.executescript("PRAGMA incremental_vacuum;")
+                self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        if deleted:
+            log.debug(f"Pruned {deleted} run(s) from the run history")
+        return deleted
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    #--------------------------------------------------------------------------
+    # Queries
+    #--------------------------------------------------------------------------
+    def runs(self, config=None, since=None, failed=False, limit=20):
+        '''
+            Returns the most recent runs, newest first, as
+            (id, started, config, duration, returncode, commands, failures)
+        '''
+        where, params = ["1"], []
+        if config:
+            where.append("config = ?")
+            params.append(config)
+        if since is not None:
+            where.append("started >= ?")
+            params.append(since)
+        if failed:
+            where.append("returncode != ?")
+            params.append(createif.RC_SUCCESS)
+        return self.db.execute(
+            "SELECT r.id, r.started, r.config, r.duration, r.returncode, "
+            "(SELECT COUNT(*) FROM commands c WHERE c.run = r.id), "
+            "(SELECT COUNT(*) FROM commands c WHERE c.run = r.id "
+            "AND c.failed) "
+            f"FROM runs r WHERE {' AND '.join(where)} "
+            "ORDER BY r.started DESC LIMIT ?",
+            params + [limit]).fetchall()
+
+    def runInfo(self, run):
+        return self.db.execute(
+            "SELECT id, config, cwd, argv, logfile, started, duration, "
+            "returncode FROM runs WHERE id = ?", (run,)).fetchone()
+
+    def commands(
+            self, run=None, name=None, stage=None, step=None, since=None,
+            failed=False, limit=20, output=False):
+        '''
+            Returns command attempts, newest first (in execution order for a
+            run), as (run, name, stage, step, cmd, attempt, started,
+            duration, returncode, failed, cached[, output])
+
+            name is matched against command names and commands, as a glob if
+            it has wildcards
+        '''
+        where, params = ["1"], []
+        if run is not None:
+            where.append("run = ?")
+            params.append(run)
+        if name:
+            op = "GLOB" if isGlob(name) else "="
+            where.append(f"(name {op} ? OR cmd {op} ?)")
+            params.extend([name, name])
+        if stage:
+            where.append("stage = ?")
+            params.append(stage)
+        if step:
+            where.append("step = ?")
+            params.append(step)
+        if since is not None:
+            where.append("started >= ?")
+            params.append(since)
+        if failed:
+            where.append("failed")
+        order = "id" if run is not None else "started DESC"
+        rows = self.db.execute(
+            "SELECT run, name, stage, step, cmd, attempt, started, duration, "
+            f"returncode, failed, cached{', output' if output else ''} "
+            f"FROM commands WHERE {' AND '.join(where)} "
+            f"ORDER BY {order} LIMIT ?",
+            params + [limit]).fetchall()
+        if output:
+            rows = [row[:-1] + (decompress(row[-1]),) for row in rows]
+        return rows
+
+    def stats(self, name=None, since=None, limit=20):
+        '''
+            Returns per command (name, runs, failures, average duration,
+            longest duration, last failure), slowest on average first
+        '''
+        where, params = ["1"], []
+        if name:
+            where.append(f"name {'GLOB' if isGlob(name) else '='} ?")
+            params.append(name)
+        if since is not None:
+            where.append("started >= ?")
+            params.append(since)
+        return self.db.execute(
+            "SELECT name, COUNT(*), SUM(failed), AVG(duration), "
+            "MAX(duration), MAX(CASE WHEN failed THEN started END) "
+            f"FROM commands WHERE {' AND '.join(where)} "
+            "GROUP BY name ORDER BY AVG(duration) DESC LIMIT ?",
+            params + [limit]).fetchall()
@@ -0,0 +1,113 @@
+"""
+ Script name: matcher.py
+
+ Author: Michael Dello
+ Description:
+    Incremental multi-pattern matching of command output
+
+    All expected and fail patterns are searched for in a single pass over the
+    output as it arrives, using one compiled alternation of every pattern that
+    hasn't been seen yet. The tail of each chunk is carried into the next one,
+    so matches spanning chunk boundaries are found, and a callback fires as
+    soon as a fail pattern shows up.
+"""
+import re
+
+import createutils
+
+#-------------------------------------------------------------------------------
+# Local Variables
+#-------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class OutputMatcher(object):
+    """
+        Tracks which expected and fail patterns have been seen in a stream of
+        output chunks
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(
+            self, expected=[], failon=[], onfail=None, encoding="utf-8"):
+        '''
+            expected and failon are lists of literal strings; onfail(pattern)
+            is called from the feeding thread on the first fail match
+        '''
+        self.encoding = encoding
+        self.expected = set(expected)
+        self.failon = set(failon)
+        self.onfail = onfail
+        # Map the encoded form back to the configured pattern(s)
+        self.patterns = {}
+        for pattern in self.expected | self.failon:
+            if pattern:
+                self.patterns.setdefault(
+                    pattern.encode(encoding), []).append(pattern)
+        # An empty pattern is in any output, as with the "in" operator
+        self.found = {p for p in self.expected | self.failon if not p}
+        self.pending = set(self.patterns)
+        self.carry = b""
+        self.regex = None
+        self.__compile()
+
+    #--------------------------------------------------------------------------
+    # Private Methods
+    #--------------------------------------------------------------------------
+    def __compile(self):
+        # Longest first, so a pattern that is a prefix of another one doesn't
+        # hide it (the longer one is re-searched anyway once this one is found)
+        self.regex = \
+            re.compile(
+                b"|".join(
+                    re.escape(p)
+                    for p in sorted(self.pending, key=len, reverse=True))) \
+            if self.pending else None
+        self.overlap = max((len(p) for p in self.pending), default=1) - 1
+
+    def __matched(self, encoded):
+        self.pending.discard(encoded)
+        for pattern in self.patterns[encoded]:
+            self.found.add(pattern)
+            if pattern in self.failon:
+                log.debug(f"Fail pattern [{pattern}] found in output")
+                if self.onfail:
+                    self.onfail(pattern)
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def feed(self, data):
+        '''
+            Search a chunk of output (bytes)
+        '''
+        if not self.regex:
+            return
+        window = self.carry + data
+        start = 0
+        while self.regex:
+            match = self.regex.search(window, start)
+            if not match:
+                break
+            self.__matched(match.group(0))
+            self.__compile()
+            # Other patterns may start at, or overlap, this same position
+            start = match.start()
+        self.carry = window[-self.overlap:] if self.overlap else b""
+
+    def feedText(self, text):
+        self.feed(text.encode(self.encoding, errors="backslashreplace"))
+
+    def isFound(self, pattern):
+        return pattern in self.found
+
+    def failMatches(self):
+        return sorted(self.failon & self.found)
+
+    def missingExpected(self):
+        return sorted(self.expected - self.found)
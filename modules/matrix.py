@@ -0,0 +1,163 @@
+"""
+ Script name: matrix.py
+
+ Author: Michael Dello
+ Description:
+    Matrix fan-out of command entries
+
+    A command entry with a "matrix" is expanded, when the config is compiled,
+    into one instance per combination of its parameter values:
+
+      "matrix": {
+          "python": ["3.10", "3.11"],      parameters, the cartesian product
+          "target": ["x86", "arm"],        of their values is expanded
+          "include": [{"python": "3.12", "target": "x86"}],
+          "exclude": [{"python": "3.10", "target": "arm"}],
+          "shards": 4,                     adds "shard" (0 to 3) and "shards"
+          "max_parallel": 2                instances running at once
+      }
+
+    "include" adds combinations, "exclude" removes every combination matching
+    all of the values it lists. ${matrix.<name>} is substituted into the
+    instance's "cmd", "cwd" and "env" values, and every value is also exported
+    to its environment as MATRIX_<NAME>, so a sharded test runner can pick its
+    deterministic slice of the suite from MATRIX_SHARD and MATRIX_SHARDS.
+"""
+import itertools
+import re
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+# Config access keys
+MAK_MATRIX = "matrix"
+MAK_INCLUDE = "include"
+MAK_EXCLUDE = "exclude"
+MAK_SHARDS = "shards"
+MAK_SHARD = "shard"
+MAK_MAXPARALLEL = "max_parallel"
+
+RESERVED = (MAK_INCLUDE, MAK_EXCLUDE, MAK_SHARDS, MAK_MAXPARALLEL)
+
+SUBSTITUTION = re.compile(r"\$\{matrix\.(\w+)\}")
+
+ENV_PREFIX = "MATRIX_"
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def isScalar(value):
+    return isinstance(value, (str, int, float, bool))
+
+#------------------------------------------------------------------------------
+def combinations(matrix):
+    '''
+        Returns the list of parameter value dicts a matrix expands to, in a
+        stable order
+
+        Raises ValueError describing the first invalid setting
+    '''
+    if not isinstance(matrix, dict):
+        raise ValueError("must be an object")
+    axes = {}
+    for name, values in matrix.items():
+        if name in RESERVED:
+            continue
+        if not re.fullmatch(r"\w+", name):
+            raise ValueError(f"invalid parameter name '{name}'")
+        if not isinstance(values, list) or not values or \
+                not all(isScalar(v) for v in values):
+            raise ValueError(f"{name} must be a non-empty list of values")
+        axes[name] = values
+    shards = matrix.get(MAK_SHARDS)
+    if shards is not None:
+        if isinstance(shards, bool) or not isinstance(shards, int) or \
+                shards < 1:
+            raise ValueError(f"{MAK_SHARDS} must be a positive number")
+        if MAK_SHARD in axes:
+            raise ValueError(f"{MAK_SHARD} is set by {MAK_SHARDS}")
+        axes[MAK_SHARD] = list(range(shards))
+    names = list(axes)
+    combos = [
+        dict(zip(names, values))
+        for values in itertools.product(*axes.values())] if names else []
+    for rule, key in ((matrix.get(MAK_EXCLUDE, []), MAK_EXCLUDE),
+                      (matrix.get(MAK_INCLUDE, []), MAK_INCLUDE)):
+        if not isinstance(rule, list) or \
+                not all(isinstance(r, dict) and r and
+                        all(isScalar(v) for v in r.values()) for r in rule):
+            raise ValueError(f"{key} must list parameter value objects")
+    for exclude in matrix.get(MAK_EXCLUDE, []):
+        combos = [
+            c for c in combos
+            if any(c.get(k) != v for k, v in exclude.items())]
+    for include in matrix.get(MAK_INCLUDE, []):
+        if include not in combos:
+            combos.append(dict(include))
+    if shards is not None:
+        for combo in combos:
+            combo[MAK_SHARDS] = shards
+    return combos
+
+#------------------------------------------------------------------------------
+def maxParallel(matrix):
+    '''
+        Returns the number of instances allowed to run at once, None if
+        unbounded
+    '''
+    limit = matrix.get(MAK_MAXPARALLEL)
+    if limit is not None and \
+            (isinstance(limit, bool) or not isinstance(limit, int) or
+                limit < 1):
+        raise ValueError(f"{MAK_MAXPARALLEL} must be a positive number")
+    return limit
+
+#------------------------------------------------------------------------------
+def substitute(text, values):
+    '''
+        Replace ${matrix.<name>} references in text
+
+        Raises ValueError on a reference to an unknown parameter
+    '''
+
+    def replace(match):
+        if match.group(1) not in values:
+            raise ValueError(f"unknown parameter in '{match.group(0)}'")
+        return str(values[match.group(1)])
+
+    return SUBSTITUTION.sub(replace, text)
+
+#------------------------------------------------------------------------------
+def instanceSuffix(values):
+    return "[{}]".format(
+        ",".join(f"{k}={v}" for k, v in values.items() if k != MAK_SHARDS))
+
+#------------------------------------------------------------------------------
+def expand(cmdentry):
+    '''
+        Expand a command entry with a matrix
+
+        Returns (instances, max parallel), instances being a list of
+        (name suffix, command entry) tuples. Raises ValueError on an invalid
+        matrix
+    '''
+    matrix = cmdentry[MAK_MATRIX]
+    combos = combinations(matrix)
+    if not combos:
+        raise ValueError("expands to no instances")
+    limit = maxParallel(matrix)
+    instances = []
+    for values in combos:
+        entry = {k: v for k, v in cmdentry.items() if k != MAK_MATRIX}
+        for key in ("cmd", "cwd"):
+            if isinstance(entry.get(key), str):
+                entry[key] = substitute(entry[key], values)
+        env = {
+            k: substitute(v, values) if isinstance(v, str) else v
+            for k, v in (entry.get("env") or {}).items()}
+        for name, value in values.items():
+            env.setdefault(ENV_PREFIX + name.upper(), str(value))
+        entry["env"] = env
+        instances.append((instanceSuffix(values), entry))
+    return instances, limit
@@ -0,0 +1,470 @@
+"""
+ Script name: plans.py
+
+ Author: Michael Dello
+ Description:
+    Configuration compiler and execution plan cache
+
+    A configuration under configs/ may be split across files:
+      - "extends": "<config>" starts from another config, with this config's
+        top-level keys, stages and steps overriding the base ones
+      - "include": ["<config>", ...] appends the command entries of the
+        included configs' stages/steps ahead of this config's own
+
+    Command entries with a "matrix" are expanded into one record per instance
+    (see matrix.py); needing the entry's id means needing all of them.
+
+    The resolved configuration is validated up front, then flattened into an
+    ExecutionPlan: an array of CommandRecords in execution order. Plans are
+    cached on disk, keyed on the modification times and hashes of every
+    contributing file, so repeated runs skip parsing and validation entirely.
+"""
+import marshal
+import os
+import zlib
+
+import createif
+import createutils
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+CONFIGDIR = "configs"
+PLANCACHEDIR = os.path.join("cache", "plans")
+
+# Bump when the plan layout changes, so stale cached plans are recompiled
+PLAN_FORMAT = 5
+
+# Config access keys
+CAK_EXTENDS = "extends"
+CAK_INCLUDE = "include"
+CAK_STAGES = "stages"
+
+# Expected types of the known command entry keys
+CMDENTRY_TYPES = {
+    "id": str,
+    "cmd": str,
+    "shell": bool,
+    "cwd": str,
+    "env": dict,
+    "timeout": (int, float),
+    "check": bool,
+    "encoding": str,
+    "stream": bool,
+    "tail_bytes": int,
+    "isolated": bool,
+    "inputs": list,
+    "outputs": list,
+    "artifacts": list,
+    "hardlink_artifacts": bool,
+    "needs": (str, list),
+    "after": (str, list),
+    "retry": (int, dict),
+    "matrix": dict,
+    "cpus": (int, float),
+    "memory_mb": (int, float),
+    "tokens": (str, list)
+}
+
+#-------------------------------------------------------------------------------
+# Local Variables
+#-------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+# Plans already loaded by this process, by plan cache path; a resident
+# process revalidates their sources instead of reading the cache again
+loaded = {}
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class ConfigError(Exception):
+    pass
+
+#------------------------------------------------------------------------------
+class CommandRecord(object):
+    """
+        One command entry of a compiled plan
+    """
+    __slots__ = (
+        "name", "stage", "step", "index", "needs", "entry", "retry", "group",
+        "maxparallel")
+
+    def __init__(
+            self, name, stage, step, index, needs, entry, retry=None,
+            group=None, maxparallel=None):
+        self.name = name
+        self.stage = stage
+        self.step = step
+        self.index = index
+        # Declared command dependencies, None when nothing was declared
+        self.needs = needs
+        self.entry = entry
+        # retries.RetryPolicy, None when the command is never retried
+        self.retry = retry
+        # Matrix entry this record is an instance of, and how many of its
+        # instances may run at once (None for unbounded)
+        self.group = group
+        self.maxparallel = maxparallel
+
+#------------------------------------------------------------------------------
+class ExecutionPlan(object):
+    """
+        Flattened, validated form of a configuration
+    """
+    __slots__ = (
+        "config", "version", "stageorder", "steporder", "stageneeds",
+        "stagefailure", "records", "sources")
+
+    def __init__(
+            self, config, version, stageorder, steporder, stageneeds,
+            stagefailure, records, sources):
+        self.config = config
+        self.version = version
+        self.stageorder = stageorder
+        self.steporder = steporder
+        # Declared stage dependencies, None for stages declaring nothing
+        self.stageneeds = stageneeds
+        # Declared stage on_failure policies, None for stages declaring none
+        self.stagefailure = stagefailure
+        self.records = records
+        # (path, mtime_ns, size, sha256) of every contributing file
+        self.sources = sources
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def configPath(name, configdir=CONFIGDIR):
+    return os.path.join(configdir, f"{name}.json")
+
+#------------------------------------------------------------------------------
+def declaredNeeds(entry):
+    '''
+        Return the list of dependencies declared by a stage or command entry,
+        merging the "needs" and "after" aliases. None means nothing declared.
+    '''
+    if "needs" not in entry and "after" not in entry:
+        return None
+    needs = []
+    for key in ("needs", "after"):
+        value = entry.get(key, [])
+        needs.extend([value] if isinstance(value, str) else value)
+    return needs
+
+#------------------------------------------------------------------------------
+def fileSignature(path):
+    # Deferred, cached plans are only rehashed once their sources' stats
+    # change
+    import hashlib
+    st = os.stat(path)
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return (path, st.st_mtime_ns, st.st_size, digest)
+
+#------------------------------------------------------------------------------
+def resolveConfig(name, configdir=CONFIGDIR, sources=None, chain=()):
+    '''
+        Load a configuration, resolving its "extends" and "include"
+        references; every file read is recorded in sources
+
+        Returns the merged configuration dict
+    '''
+    if name in chain:
+        raise ConfigError(
+            "Config include cycle: {}".format(" -> ".join(chain + (name,))))
+    chain = chain + (name,)
+    # Deferred, this is only needed to compile a plan
+    import json
+    path = configPath(name, configdir)
+    try:
+        with open(path) as cf:
+            config = json.load(cf)
+    except FileNotFoundError:
+        raise ConfigError(f"Config '{name}' not found ({path})")
+    except ValueError as e:
+        raise ConfigError(f"Config '{name}' is not valid JSON: {str(e)}")
+    if sources is not None:
+        sources.append(fileSignature(path))
+    if not isinstance(config, dict):
+        raise ConfigError(f"Config '{name}' must be a JSON object")
+    merged = {}
+    base = config.get(CAK_EXTENDS)
+    if base:
+        merged = resolveConfig(base, configdir, sources, chain)
+    for key, value in config.items():
+        if key in (CAK_EXTENDS, CAK_INCLUDE):
+            continue
+        if key == CAK_STAGES and isinstance(value, dict):
+            overrideStages(merged, value)
+        else:
+            merged[key] = value
+    includes = config.get(CAK_INCLUDE, [])
+    if isinstance(includes, str):
+        includes = [includes]
+    included = {}
+    for include in includes:
+        appendStages(
+            included,
+            resolveConfig(include, configdir, sources, chain).get(
+                CAK_STAGES, {}))
+    if included:
+        # Included entries run ahead of this config's own
+        appendStages(included, merged.get(CAK_STAGES, {}))
+        merged[CAK_STAGES] = included[CAK_STAGES]
+    return merged
+
+#------------------------------------------------------------------------------
+def appendStages(config, stages):
+    '''
+        Append the command entries of every stage/step to config
+    '''
+    target = config.setdefault(CAK_STAGES, {})
+    for stage, steps in stages.items():
+        if not isinstance(steps, dict):
+            continue
+        targetsteps = target.setdefault(stage, {})
+        for step, value in steps.items():
+            if step in ("needs", "after", createif.CAK_ONFAILURE):
+                # Stage settings, the latest one wins
+                targetsteps[step] = value
+            elif isinstance(value, list):
+                targetsteps[step] = list(targetsteps.get(step, [])) + value
+            else:
+                targetsteps.setdefault(step, value)
+
+#------------------------------------------------------------------------------
+def overrideStages(config, stages):
+    '''
+        Override config's stages step by step
+    '''
+    target = config.setdefault(CAK_STAGES, {})
+    for stage, steps in stages.items():
+        if not isinstance(steps, dict):
+            target[stage] = steps
+            continue
+        targetsteps = target.setdefault(stage, {})
+        for step, value in steps.items():
+            targetsteps[step] = value
+
+#------------------------------------------------------------------------------
+def validateCmdEntry(where, cmdentry, errors):
+    if not isinstance(cmdentry, dict):
+        errors.append(f"{where}: command entry must be an object")
+        return
+    for key, expected in CMDENTRY_TYPES.items():
+        if key in cmdentry and not isinstance(cmdentry[key], expected):
+            errors.append(f"{where}.{key}: unexpected type "
+                          f"{type(cmdentry[key]).__name__}")
+    for key in ("needs", "after"):
+        value = cmdentry.get(key)
+        if isinstance(value, list) and \
+                not all(isinstance(v, str) for v in value):
+            errors.append(f"{where}.{key}: must list command ids")
+    if cmdentry.get("artifacts") and "inputs" not in cmdentry:
+        errors.append(f"{where}.artifacts: needs inputs to be keyed on")
+    if isinstance(cmdentry.get("env"), dict) and \
+            not all(isinstance(v, str) for v in cmdentry["env"].values()):
+        errors.append(f"{where}.env: values must be strings")
+
+#------------------------------------------------------------------------------
+def compileRetry(where, cmdentry, errors):
+    '''
+        Returns the command entry's retries.RetryPolicy, None if it never
+        retries
+    '''
+    if "retry" not in cmdentry:
+        return None
+    import retries
+    try:
+        policy = retries.RetryPolicy.fromConfig(cmdentry["retry"])
+    except ValueError as e:
+        errors.append(f"{where}.retry: {str(e)}")
+        return None
+    return policy if policy.retries else None
+
+#------------------------------------------------------------------------------
+def compileConfig(name, configdir=CONFIGDIR):
+    '''
+        Resolve, validate and flatten a configuration
+
+        Raises ConfigError listing every problem found
+    '''
+    sources = []
+    config = resolveConfig(name, configdir, sources)
+    errors = []
+    stageorder = \
+        config.get(createif.CAK_STAGEORDER, createif.DEFAULT_STAGE_ORDER)
+    steporder = config.get(createif.CAK_STEPORDER, createif.DEFAULT_STEP_ORDER)
+    stages = config.get(CAK_STAGES)
+    if not isinstance(stages, dict):
+        raise ConfigError("Stages section missing from config")
+    records = []
+    stageneeds = {}
+    stagefailure = {}
+    names = set()
+    # Instance names of every matrix entry
+    groups = {}
+    for stage in stageorder:
+        steps = stages.get(stage)
+        if not isinstance(steps, dict):
+            errors.append(f"{stage} missing from stages section")
+            continue
+        stageneeds[stage] = declaredNeeds(steps)
+        for need in stageneeds[stage] or []:
+            if need not in stageorder:
+                errors.append(f"{stage} needs unknown stage '{need}'")
+        stagefailure[stage] = steps.get(createif.CAK_ONFAILURE)
+        if stagefailure[stage] not in (None,) + createif.ON_FAILURE_POLICIES:
+            errors.append(
+                f"{stage}: {createif.CAK_ONFAILURE} must be one of "
+                f"{', '.join(createif.ON_FAILURE_POLICIES)}")
+        for step in steporder:
+            cmdentries = steps.get(step)
+            if not isinstance(cmdentries, list):
+                errors.append(f"{step} missing from {stage} section")
+                continue
+            for index, cmdentry in enumerate(cmdentries):
+                where = f"stages.{stage}.{step}[{index}]"
+                validateCmdEntry(where, cmdentry, errors)
+                if not isinstance(cmdentry, dict):
+                    continue
+                recordname = cmdentry.get("id", f"{stage}.{step}.{index}")
+                if recordname in names:
+                    errors.append(f"{where}: duplicate command id "
+                                  f"'{recordname}'")
+                names.add(recordname)
+                instances = [("", cmdentry)]
+                group = None
+                maxparallel = None
+                if isinstance(cmdentry.get("matrix"), dict):
+                    import matrix
+                    try:
+                        instances, maxparallel = matrix.expand(cmdentry)
+                        group = recordname
+                    except ValueError as e:
+                        errors.append(f"{where}.matrix: {str(e)}")
+                        continue
+                retry = compileRetry(where, cmdentry, errors)
+                for suffix, entry in instances:
+                    records.append(
+                        CommandRecord(
+                            recordname + suffix,
+                            stage,
+                            step,
+                            index,
+                            declaredNeeds(cmdentry),
+                            entry,
+                            retry,
+                            group,
+                            maxparallel))
+                    if group:
+                        groups.setdefault(group, []).append(
+                            recordname + suffix)
+    for record in records:
+        if record.needs is None:
+            continue
+        needs = []
+        for need in record.needs:
+            if need not in names:
+                errors.append(
+                    f"{record.name} needs unknown command '{need}'")
+            needs.extend(groups.get(need, [need]))
+        record.needs = needs
+    if errors:
+        raise ConfigError(
+            "Invalid config '{}':\n    {}".format(name, "\n    ".join(errors)))
+    return ExecutionPlan(
+        name,
+        config.get(createif.CAK_VERSION, createif.CV_BASIC),
+        stageorder,
+        steporder,
+        stageneeds,
+        stagefailure,
+        records,
+        sources)
+
+#------------------------------------------------------------------------------
+def sourcesUnchanged(sources):
+    '''
+        Returns True if every contributing file is unchanged; the hash is only
+        computed when a file's modification time or size moved
+    '''
+    for path, mtime, size, digest in sources:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if st.st_mtime_ns == mtime and st.st_size == size:
+            continue
+        if fileSignature(path)[3] != digest:
+            return False
+    return True
+
+#------------------------------------------------------------------------------
+def planToData(plan):
+    '''
+        Returns the plan as built-in types, for marshal: it is built in,
+        where importing pickle would add to every run's startup
+    '''
+    records = []
+    for record in plan.records:
+        data = {slot: getattr(record, slot) for slot in record.__slots__}
+        if record.retry:
+            data["retry"] = vars(record.retry)
+        records.append(data)
+    data = {slot: getattr(plan, slot) for slot in plan.__slots__}
+    data["records"] = records
+    return data
+
+#------------------------------------------------------------------------------
+def planFromData(data):
+    records = []
+    for recorddata in data["records"]:
+        if recorddata["retry"]:
+            import retries
+            recorddata["retry"] = retries.RetryPolicy(**recorddata["retry"])
+        records.append(CommandRecord(**recorddata))
+    data["records"] = records
+    return ExecutionPlan(**data)
+
+#------------------------------------------------------------------------------
+def loadPlan(name, configdir=CONFIGDIR, usecache=True):
+    '''
+        Returns (plan, fromcache) for the named configuration, compiling it
+        only when no cached plan with unchanged sources exists
+    '''
+    cachepath = \
+        os.path.join(
+            os.path.abspath(PLANCACHEDIR),
+            "{:08x}-{}.plan".format(
+                zlib.crc32(os.path.abspath(configdir).encode()), name))
+    if usecache:
+        plan = loaded.get(cachepath)
+        if plan is not None and sourcesUnchanged(plan.sources):
+            log.debug(f"Using loaded plan {cachepath}")
+            return plan, True
+        try:
+            with open(cachepath, "rb") as f:
+                planformat, data = marshal.load(f)
+            plan = planFromData(data) if planformat == PLAN_FORMAT else None
+            if plan and sourcesUnchanged(plan.sources):
+                log.debug(f"Using cached plan {cachepath}")
+                loaded[cachepath] = plan
+                return plan, True
+        except (OSError, EOFError, ValueError, KeyError, AttributeError,
+                TypeError):
+            pass
+    plan = compileConfig(name, configdir)
+    if usecache:
+        try:
+            os.makedirs(PLANCACHEDIR, exist_ok=True)
+            tmppath = f"{cachepath}.{os.getpid()}.tmp"
+            with open(tmppath, "wb") as f:
+                marshal.dump((PLAN_FORMAT, planToData(plan)), f)
+            os.replace(tmppath, cachepath)
+        except (OSError, ValueError) as e:
+            log.debug(f"Could not cache plan: {str(e)}")
+        loaded[cachepath] = plan
+    return plan, False
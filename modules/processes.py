@@ -0,0 +1,256 @@
+"""
+ Script name: processes.py
+
+ Author: Michael Dello
+ Description:
+    Per-command process isolation
+
+    Every command is launched in its own process group (its own session on
+    POSIX), and tracked through its Popen handle. Terminating a command only
+    signals that group: SIGTERM first, escalating to SIGKILL after a grace
+    period, so concurrently running commands in the same CREATE process can
+    time out independently without affecting each other.
+
+    Commands started through this module (and the other run helpers) are
+    registered while they run, so a whole run can be cancelled at once.
+"""
+import os
+import signal
+import subprocess
+import threading
+import time
+
+import createutils
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+# Time a command gets to exit on SIGTERM before it is killed
+DEFAULT_KILL_GRACE_IN_SECS = 2
+
+POLL_INTERVAL_IN_SECS = 0.05
+
+#-------------------------------------------------------------------------------
+# Local Variables
+#-------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+# Processes of the commands currently running, and the threads that run them
+running = {}
+runninglock = threading.Lock()
+
+# Threads whose commands were terminated: a process they start afterwards (the
+# termination raced with its start) is terminated as soon as it is tracked
+cancelledthreads = set()
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def isolationArgs():
+    '''
+        Popen keyword arguments that start a command in its own process group
+    '''
+    if createutils.THIS_IS_WINDOWS:
+        return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {"start_new_session": True}
+
+#------------------------------------------------------------------------------
+def track(process):
+    with runninglock:
+        thread = threading.get_ident()
+        running[process] = thread
+        cancelled = thread in cancelledthreads
+    if cancelled:
+        startTermination(process)
+
+#------------------------------------------------------------------------------
+def untrack(process):
+    with runninglock:
+        running.pop(process, None)
+
+#------------------------------------------------------------------------------
+def terminateAll(grace=DEFAULT_KILL_GRACE_IN_SECS, threads=None):
+    '''
+        Terminate every running command's process tree, escalating to SIGKILL
+        for whatever is left after grace seconds. The commands' own run
+        helpers see them exit and reap them.
+
+        With threads (thread idents), only the commands run by those threads
+        are terminated, along with any they start until releaseThreads() is
+        called for them.
+    '''
+    with runninglock:
+        if threads is not None:
+            cancelledthreads.update(threads)
+        processes = [
+            process for process, thread in running.items()
+            if threads is None or thread in threads]
+    if not processes:
+        return
+    log.debug(f"Terminating {len(processes)} running command(s)")
+    for process in processes:
+        startTermination(process)
+    deadline = time.monotonic() + grace
+    while time.monotonic() < deadline:
+        if createutils.THIS_IS_WINDOWS or \
+                not any(groupAlive(p.pid) for p in processes):
+            return
+        time.sleep(POLL_INTERVAL_IN_SECS)
+    for process in processes:
+        killTree(process)
+
+#------------------------------------------------------------------------------
+def releaseThreads(threads):
+    '''
+        Let the threads given to terminateAll() run commands again
+    '''
+    with runninglock:
+        cancelledthreads.difference_update(threads)
+
+#------------------------------------------------------------------------------
+def signalGroup(pid, sig):
+    '''
+        Signal every process in the group led by pid
+
+        Returns False once the group has no members left
+    '''
+    try:
+        os.killpg(pid, sig)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Members left that can't be signaled aren't ours to wait for
+        return False
+
+#------------------------------------------------------------------------------
+def groupAlive(pid):
+    return signalGroup(pid, 0)
+
+#------------------------------------------------------------------------------
+def killTreeWindows(pid):
+    # No process groups to signal, walk this command's tree instead
+    import psutil
+    try:
+        root = psutil.Process(pid)
+        procs = root.children(recursive=True) + [root]
+    except psutil.NoSuchProcess:
+        return
+    for p in procs:
+        try:
+            p.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+#------------------------------------------------------------------------------
+def startTermination(process):
+    '''
+        Ask the command's process group to terminate, without waiting
+    '''
+    if createutils.THIS_IS_WINDOWS:
+        killTreeWindows(process.pid)
+    else:
+        signalGroup(process.pid, signal.SIGTERM)
+
+#------------------------------------------------------------------------------
+def killTree(process):
+    '''
+        Kill the command's process group right away, without waiting
+
+        Returns True if anything was left to kill
+    '''
+    if createutils.THIS_IS_WINDOWS:
+        killTreeWindows(process.pid)
+        return True
+    return signalGroup(process.pid, signal.SIGKILL)
+
+#------------------------------------------------------------------------------
+def finishTermination(process):
+    '''
+        Kill whatever is left of the command's process group
+    '''
+    if killTree(process):
+        log.debug(f"Killed process group {process.pid} after grace period")
+
+#------------------------------------------------------------------------------
+def terminateTree(process, grace=DEFAULT_KILL_GRACE_IN_SECS):
+    '''
+        Terminate a command started with isolationArgs() and everything it
+        spawned, escalating from SIGTERM to SIGKILL after grace seconds. Only
+        this command's own process is reaped, polling without blocking.
+    '''
+    startTermination(process)
+    deadline = time.monotonic() + grace
+    while time.monotonic() < deadline:
+        process.poll()
+        if process.returncode is not None and \
+                (createutils.THIS_IS_WINDOWS or not groupAlive(process.pid)):
+            break
+        time.sleep(POLL_INTERVAL_IN_SECS)
+    finishTermination(process)
+    process.wait()
+
+#------------------------------------------------------------------------------
+async def terminateTreeAsync(process, grace=DEFAULT_KILL_GRACE_IN_SECS):
+    '''
+        terminateTree() for asyncio subprocesses, yielding the event loop
+        while waiting out the grace period
+    '''
+    import asyncio
+    startTermination(process)
+    deadline = time.monotonic() + grace
+    while time.monotonic() < deadline:
+        if process.returncode is not None and \
+                (createutils.THIS_IS_WINDOWS or not groupAlive(process.pid)):
+            break
+        await asyncio.sleep(POLL_INTERVAL_IN_SECS)
+    finishTermination(process)
+    await process.wait()
+
+#------------------------------------------------------------------------------
+def run(
+        cmd,
+        shell=True,
+        cwd=None,
+        env=None,
+        timeout=None,
+        check=True,
+        encoding="utf-8",
+        onstart=None):
+    '''
+        Counterpart of subprocess.run() with output captured (stderr merged
+        into stdout), where a timeout terminates the command's whole process
+        tree rather than only the process that was started
+
+        onstart(process) is called with the Popen handle once started
+
+        Raises subprocess.TimeoutExpired and subprocess.CalledProcessError like
+        subprocess.run()
+    '''
+    with subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            shell=shell,
+            cwd=cwd,
+            env=env,
+            encoding=encoding,
+            **isolationArgs()) as process:
+        track(process)
+        if onstart:
+            onstart(process)
+        try:
+            output, _ = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            terminateTree(process)
+            # The pipe closes with the group, collect what was written
+            output, _ = process.communicate()
+            raise subprocess.TimeoutExpired(cmd, timeout, output=output)
+        finally:
+            untrack(process)
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(
+            process.returncode, cmd, output=output)
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout=output)
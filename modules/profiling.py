@@ -0,0 +1,240 @@
+"""
+ Script name: profiling.py
+
+ Author: Michael Dello
+ Description:
+    Profiling of CREATE's own overhead (--profile)
+
+    The run is profiled with cProfile in every thread it starts (the
+    scheduler's workers included), and the merged profile is written out as
+    a pstats file for snakeviz, gprof2dot or "python -m pstats". Before
+    Python 3.12 each thread gets a profiler of its own; from 3.12 on cProfile
+    sits on sys.monitoring, which sees every thread but takes a single
+    profiler at a time, so that one profiler covers the whole run.
+
+    The report logged at the end of the run splits the time the profiled
+    threads spent between waiting on commands (blocking on child process
+    output and exits), idling (threads waiting for work or for each other)
+    and actual work, in CREATE's own code or in the Python code it calls.
+    The work is what the framework costs, and its top functions by own time
+    show where to optimize. Times are summed over threads, so they add up to
+    more than the run's wall time once commands run concurrently.
+"""
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+
+import createif
+import createutils
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+PROFILEFILENAME = "create-{}.prof"
+
+# Functions listed in the report
+DEFAULT_TOP = 20
+
+# CREATE's own code lives under this folder
+CREATE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Built-ins that block, by what they wait on (pstats names them
+# "<built-in method posix.waitpid>", "<method 'poll' of 'select.poll'
+# objects>", ...)
+CHILD_WAITS = (
+    "posix.waitpid", "posix.wait4", "posix.read", "select.select",
+    "'poll' of 'select.", "'select' of 'select.", "_posixsubprocess.fork_exec")
+# Reads that wait on a command's output when they are made by these
+PIPE_READS = (
+    "'read' of '_io.", "'read1' of '_io.", "'readline' of '_io.",
+    "'readinto' of '_io.")
+PIPE_READERS = (
+    "subprocess.py", "processes.py", "capture.py", "shellpool.py",
+    "commands.py")
+IDLE_WAITS = (
+    "'acquire' of '_thread.", "time.sleep", "'get' of '_queue.",
+    "'accept' of '_socket.", "'recv' of '_socket.", "'recv_into' of '_socket.")
+
+# Report categories
+CATEGORY_CHILD = "waiting on commands"
+CATEGORY_IDLE = "idle"
+CATEGORY_CREATE = "CREATE"
+CATEGORY_OTHER = "Python and libraries"
+
+# cProfile profiles every thread, through sys.monitoring, and a second
+# profiler can't be enabled beside it
+PROFILES_ALL_THREADS = sys.version_info >= (3, 12)
+
+#-------------------------------------------------------------------------------
+# Local Variables
+#-------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def defaultPath():
+    return os.path.join(
+        createutils.OUTPUTDIR,
+        PROFILEFILENAME.format(createutils.RUNSTAMP))
+
+#------------------------------------------------------------------------------
+def categorize(function, caller=None):
+    '''
+        Returns the report category of the time spent in a pstats function
+        key (filename, line, name), when called by caller (another key)
+    '''
+    filename, _, name = function
+    if filename == "~":
+        if any(wait in name for wait in CHILD_WAITS):
+            return CATEGORY_CHILD
+        if caller and any(read in name for read in PIPE_READS) and \
+                os.path.basename(caller[0]) in PIPE_READERS:
+            return CATEGORY_CHILD
+        if any(wait in name for wait in IDLE_WAITS):
+            return CATEGORY_IDLE
+        return CATEGORY_OTHER
+    if filename.startswith(CREATE_ROOT) and "site-packages" not in filename:
+        return CATEGORY_CREATE
+    return CATEGORY_OTHER
+
+#------------------------------------------------------------------------------
+def describe(function):
+    filename, line, name = function
+    if filename == "~":
+        return name
+    if filename.startswith(CREATE_ROOT):
+        filename = os.path.relpath(filename, CREATE_ROOT)
+    else:
+        filename = os.path.basename(filename)
+    return f"{filename}:{line}({name})"
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class Snapshot(object):
+    """
+        Profile data taken off a profiler that may still be running, in the
+        form pstats.Stats loads
+    """
+    def __init__(self, profile):
+        profile.snapshot_stats()
+        self.stats = profile.stats
+
+    def create_stats(self):
+        pass
+
+#------------------------------------------------------------------------------
+class RunProfiler(object):
+    """
+        cProfile profiler of the calling thread and of every thread started
+        while it runs
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.profile = None
+        self.started = None
+        self.wall = None
+
+    #--------------------------------------------------------------------------
+    # Private Methods
+    #--------------------------------------------------------------------------
+    def __enable(self):
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+        return profile
+
+    def __threadStarted(self, frame, event, arg):
+        # First profiling event of a new thread: replace this hook with a
+        # profiler of the thread's own
+        self.__enable()
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def start(self):
+        self.started = time.perf_counter()
+        if not PROFILES_ALL_THREADS:
+            threading.setprofile(self.__threadStarted)
+        self.profile = self.__enable()
+
+    def stop(self):
+        '''
+            Returns the merged pstats.Stats of every profiled thread
+        '''
+        self.profile.disable()
+        if not PROFILES_ALL_THREADS:
+            threading.setprofile(None)
+        self.wall = time.perf_counter() - self.started
+        # Threads still running can't be stopped from here, take what they
+        # have so far
+        with self.lock:
+            snapshots = [Snapshot(profile) for profile in self.profiles]
+        stats = pstats.Stats(snapshots[0])
+        for snapshot in snapshots[1:]:
+            stats.add(snapshot)
+        return stats
+
+    def report(self, stats, path, top=DEFAULT_TOP, logger=log):
+        '''
+            Write the pstats file, and log where the time went
+        '''
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            stats.dump_stats(path)
+        except OSError as e:
+            logger.warning(f"Could not write the profile: {str(e)}")
+            path = None
+        categories = dict.fromkeys(
+            (CATEGORY_CHILD, CATEGORY_IDLE, CATEGORY_CREATE, CATEGORY_OTHER),
+            0)
+        work = []
+        for function, (_, calls, tottime, cumtime, callers) in \
+                stats.stats.items():
+            # Built-ins may wait or work, depending on who calls them
+            own = {}
+            for caller, (_, _, seconds, _) in (callers or {None: (
+                    0, 0, tottime, 0)}).items():
+                category = categorize(function, caller)
+                own[category] = own.get(category, 0) + seconds
+            for category, seconds in own.items():
+                categories[category] += seconds
+                if category in (CATEGORY_CREATE, CATEGORY_OTHER):
+                    work.append((seconds, cumtime, calls, category, function))
+        formatDuration = createutils.formatDuration
+        logger.info(createif.OUTPUT_SEPARATOR)
+        logger.info(
+            "Profile of %s in %s%s:",
+            formatDuration(self.wall),
+            "all threads" if PROFILES_ALL_THREADS else
+                f"{len(self.profiles)} thread(s)",
+            f", written to {path}" if path else "")
+        for category, seconds in categories.items():
+            logger.info("  %-22s %9s", category, formatDuration(seconds))
+        logger.info(
+            "Top %s functions by own time, outside of waits:",
+            min(top, len(work)))
+        logger.info(
+            "  %10s %10s %9s  %-6s %s",
+            "own (ms)", "cumul (ms)", "calls", "in", "function")
+        for tottime, cumtime, calls, category, function in \
+                sorted(work, reverse=True)[:top]:
+            logger.info(
+                "  %10.1f %10.1f %9s  %-6s %s",
+                tottime * 1000,
+                cumtime * 1000,
+                calls,
+                "CREATE" if category == CATEGORY_CREATE else "Python",
+                describe(function))
@@ -0,0 +1,186 @@
+"""
+ Script name: retries.py
+
+ Author: Michael Dello
+ Description:
+    Retry policies for command entries
+
+    A command entry can declare when and how often it is retried:
+
+      "retry": {
+          "retries": 3,               maximum number of retries
+          "delay": 2,                 delay before the first retry (seconds)
+          "backoff": "exponential",   "fixed" (default) or "exponential"
+          "factor": 2,                exponential growth factor
+          "max_delay": 60,            cap on any single delay
+          "jitter": 0.5,              randomize up to this fraction of a delay
+          "budget": 300,              no retry starts this long after the
+                                      first attempt started
+          "on_returncodes": [1, 75],  only retry on these return codes...
+          "on_output": ["timed out"]  ...or when output has these strings
+      }
+
+    "retry": N is short for {"retries": N}. A policy only decides whether and
+    when a failed command runs again; the scheduler re-queues the command
+    with that wake-up time, leaving its worker free in the meantime.
+"""
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+DEFAULT_RETRIES = 0
+DEFAULT_DELAY_IN_SECS = 8
+DEFAULT_FACTOR = 2
+
+BACKOFF_FIXED = "fixed"
+BACKOFF_EXPONENTIAL = "exponential"
+
+# Config access keys
+RAK_RETRIES = "retries"
+RAK_DELAY = "delay"
+RAK_BACKOFF = "backoff"
+RAK_FACTOR = "factor"
+RAK_MAXDELAY = "max_delay"
+RAK_JITTER = "jitter"
+RAK_BUDGET = "budget"
+RAK_ONRETURNCODES = "on_returncodes"
+RAK_ONOUTPUT = "on_output"
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class RetryPolicy(object):
+    """
+        Decides if and when a failed command is attempted again
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(
+            self,
+            retries=DEFAULT_RETRIES,
+            delay=DEFAULT_DELAY_IN_SECS,
+            backoff=BACKOFF_FIXED,
+            factor=DEFAULT_FACTOR,
+            maxdelay=None,
+            jitter=0.0,
+            budget=None,
+            onreturncodes=None,
+            onoutput=None):
+        self.retries = retries
+        self.delay = delay
+        self.backoff = backoff
+        self.factor = factor
+        self.maxdelay = maxdelay
+        self.jitter = jitter
+        self.budget = budget
+        self.onreturncodes = onreturncodes
+        self.onoutput = onoutput
+
+    def __repr__(self):
+        return f"RetryPolicy({self.retries} retries, {self.backoff})"
+
+    #--------------------------------------------------------------------------
+    # Class Methods
+    #--------------------------------------------------------------------------
+    @classmethod
+    def fromConfig(cls, config):
+        '''
+            Build a policy from the "retry" value of a command entry
+
+            Raises ValueError describing the first invalid setting, which
+            plans.compileConfig reports in its ConfigError
+        '''
+        if isinstance(config, bool) or not isinstance(config, (int, dict)):
+            raise ValueError("must be a number of retries or an object")
+        if isinstance(config, int):
+            config = {RAK_RETRIES: config}
+        unknown = \
+            set(config) - {
+                RAK_RETRIES, RAK_DELAY, RAK_BACKOFF, RAK_FACTOR, RAK_MAXDELAY,
+                RAK_JITTER, RAK_BUDGET, RAK_ONRETURNCODES, RAK_ONOUTPUT}
+        if unknown:
+            raise ValueError(f"unknown setting(s) {sorted(unknown)}")
+
+        def number(key, default, integer=False):
+            value = config.get(key, default)
+            types = int if integer else (int, float)
+            if value is not None and \
+                    (isinstance(value, bool) or not isinstance(value, types)
+                        or value < 0):
+                raise ValueError(f"{key} must be a non-negative number")
+            return value
+
+        policy = \
+            cls(retries=number(RAK_RETRIES, DEFAULT_RETRIES, integer=True),
+                delay=number(RAK_DELAY, DEFAULT_DELAY_IN_SECS),
+                backoff=config.get(RAK_BACKOFF, BACKOFF_FIXED),
+                factor=number(RAK_FACTOR, DEFAULT_FACTOR),
+                maxdelay=number(RAK_MAXDELAY, None),
+                jitter=number(RAK_JITTER, 0.0),
+                budget=number(RAK_BUDGET, None),
+                onreturncodes=config.get(RAK_ONRETURNCODES),
+                onoutput=config.get(RAK_ONOUTPUT))
+        if policy.backoff not in (BACKOFF_FIXED, BACKOFF_EXPONENTIAL):
+            raise ValueError(f"unknown backoff '{policy.backoff}'")
+        if policy.jitter > 1:
+            raise ValueError(f"{RAK_JITTER} must be a fraction, 0 to 1")
+        # A bare string would match its characters, a bare number nothing
+        if policy.onreturncodes is not None and (
+                not isinstance(policy.onreturncodes, list) or
+                not all(isinstance(rc, int) and not isinstance(rc, bool)
+                        for rc in policy.onreturncodes)):
+            raise ValueError(f"{RAK_ONRETURNCODES} must list return codes")
+        if policy.onoutput is not None and (
+                not isinstance(policy.onoutput, list) or
+                not all(isinstance(s, str) for s in policy.onoutput)):
+            raise ValueError(f"{RAK_ONOUTPUT} must list strings")
+        return policy
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def retriesOn(self, returncode, output):
+        '''
+            Returns True if a failure with this return code (None when the
+            command didn't exit on its own) and output may be retried
+        '''
+        if self.onreturncodes is None and self.onoutput is None:
+            return True
+        if returncode is not None and returncode in (self.onreturncodes or []):
+            return True
+        return bool(output) and \
+            any(s in output for s in self.onoutput or [])
+
+    def backoffDelay(self, retry):
+        '''
+            Returns the delay before the given retry (0 for the first one),
+            without jitter
+        '''
+        delay = self.delay
+        if self.backoff == BACKOFF_EXPONENTIAL:
+            delay *= self.factor ** retry
+        if self.maxdelay is not None:
+            delay = min(delay, self.maxdelay)
+        return delay
+
+    def nextDelay(self, retry, returncode=None, output=None, elapsed=0.0):
+        '''
+            retry is the number of retries already made, elapsed the time
+            since the first attempt started
+
+            Returns the delay in seconds before retrying, or None if the
+            command should not be retried
+        '''
+        if retry >= self.retries or not self.retriesOn(returncode, output):
+            return None
+        delay = self.backoffDelay(retry)
+        if self.jitter:
+            # Deferred, plans are loaded on every run but rarely jittered
+            import random
+            delay -= delay * self.jitter * random.random()
+        if self.budget is not None and elapsed + delay > self.budget:
+            return None
+        return delay
@@ -0,0 +1,591 @@
+"""
+ Script name: scheduler.py
+
+ Author: Michael Dello
+ Description:
+    Dependency-aware scheduling of CREATE stages, steps and commands
+
+    The compiled execution plan is turned into a DAG of nodes. By default,
+    stages run in stage order and steps run in step order, while the commands
+    within a step are independent of each other. Stages and command entries
+    can declare "needs" (or "after") to replace/extend the implicit ordering,
+    and ready nodes are executed concurrently on a bounded worker pool.
+
+    Ready nodes start in configuration order, unless they were prioritized
+    with the predicted length of their critical path (the longest chain of
+    work from their start to the end of the run), in which case the longest
+    independent work starts first.
+
+    A failed command that is to be retried is re-queued with a wake-up time,
+    rather than holding on to its worker while it waits. The instances of a
+    matrix entry run concurrently, up to the entry's max_parallel, and
+    commands declaring resources wait until the host has room for them (see
+    admission.py).
+
+    A command that fails for good applies the on_failure policy of its stage:
+    the run continues, skips the rest of the stage, or aborts, cancelling the
+    commands in flight and skipping everything left. Either way, the cleanup
+    step of the stages that started still runs.
+"""
+import heapq
+import threading
+import time
+
+import createif
+import createutils
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+DEFAULT_JOBS = createif.DEFAULT_JOBS
+
+# Final state of a command node
+STATE_RAN = "ran"
+STATE_SKIPPED = "skipped"
+STATE_CANCELLED = "cancelled"
+
+#-------------------------------------------------------------------------------
+# Local Variables
+#-------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class Node(object):
+    """
+        A single unit of work in the execution graph. Nodes without a command
+        entry are barriers, used to join stages and steps together.
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(
+            self, name, order, stage=None, step=None, cmdentry=None,
+            retry=None, group=None, maxparallel=None, onfailure=None):
+        self.name = name
+        # Position in configuration order, used to keep scheduling stable
+        self.order = order
+        self.stage = stage
+        self.step = step
+        self.cmdentry = cmdentry
+        # retries.RetryPolicy of the command, if it can be retried
+        self.retry = retry
+        # Retries made so far, and when the first attempt started
+        self.retries = 0
+        self.firststart = None
+        # Matrix entry of the node, and its cap on concurrent instances
+        self.group = group
+        self.maxparallel = maxparallel
+        # on_failure policy of the node's stage, None for the run's default
+        self.onfailure = onfailure
+        # Predicted critical path length from this node, orders ready nodes
+        self.priority = 0
+        # Wall time of the last attempt, and whether it replayed a cached
+        # result
+        self.attemptstart = None
+        self.duration = None
+        self.cached = False
+        # (attempt, start time, duration, return code, failed, cached,
+        # compressed output) of each attempt, for the run history
+        self.attempts = []
+        # When the node last became ready, how long it waited to start in
+        # all, and whether admission control held it back
+        self.readyat = None
+        self.queuewait = 0
+        self.heldback = False
+        # Final return code and state, once the node ran (or didn't), and
+        # the thread running it
+        self.retcode = None
+        self.state = None
+        self.thread = None
+        self.deps = set()
+        self.dependents = []
+
+    def __lt__(self, other):
+        return (-self.priority, self.order) < (-other.priority, other.order)
+
+    def __repr__(self):
+        return f"Node({self.name})"
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def isBarrier(self):
+        return self.cmdentry is None
+
+    def addDependency(self, node):
+        if node is not self and node not in self.deps:
+            self.deps.add(node)
+            node.dependents.append(self)
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def buildGraph(plan, check=True):
+    '''
+        Build the execution DAG from a compiled plans.ExecutionPlan; the plan
+        is already validated, so only acyclicity is left to check
+
+        Returns the list of nodes in configuration order
+    '''
+    nodes = []
+    cmdnodes = {}
+    stagestarts = {}
+    stageends = {}
+
+    def newNode(name, **kwargs):
+        node = Node(name, len(nodes), **kwargs)
+        nodes.append(node)
+        return node
+
+    records = iter(plan.records)
+    record = next(records, None)
+    previousend = None
+    for stage in plan.stageorder:
+        start = newNode(f"{stage}:start", stage=stage)
+        stagestarts[stage] = start
+        # Implicitly run after the previous stage, unless declared otherwise
+        if previousend and plan.stageneeds.get(stage) is None:
+            start.addDependency(previousend)
+        stepend = start
+        for step in plan.steporder:
+            end = newNode(f"{stage}:{step}:end", stage=stage, step=step)
+            end.addDependency(stepend)
+            # Records are flattened in stage, then step order
+            while record and record.stage == stage and record.step == step:
+                node = \
+                    newNode(
+                        record.name,
+                        stage=stage,
+                        step=step,
+                        cmdentry=record.entry,
+                        retry=record.retry,
+                        group=record.group,
+                        maxparallel=record.maxparallel,
+                        onfailure=plan.stagefailure.get(stage))
+                cmdnodes[record.name] = node
+                node.addDependency(stepend)
+                end.addDependency(node)
+                record = next(records, None)
+            stepend = end
+        stageends[stage] = stepend
+        previousend = stepend
+    # Resolve declared dependencies now that all names are known
+    for stage in plan.stageorder:
+        for need in plan.stageneeds.get(stage) or []:
+            stagestarts[stage].addDependency(stageends[need])
+    for record in plan.records:
+        for need in record.needs or []:
+            cmdnodes[record.name].addDependency(cmdnodes[need])
+    if check:
+        checkAcyclic(nodes)
+    return nodes
+
+#------------------------------------------------------------------------------
+def usesKey(nodes, key):
+    '''
+        Returns True if any command entry in the graph sets the config key
+    '''
+    return any(
+        key in node.cmdentry for node in nodes if not node.isBarrier())
+
+#------------------------------------------------------------------------------
+def selectNodes(nodes, names):
+    '''
+        Keep only the named command nodes; the others become barriers, so the
+        ordering between the selected ones is unchanged
+    '''
+    for node in nodes:
+        if not node.isBarrier() and node.name not in names:
+            node.cmdentry = None
+
+#------------------------------------------------------------------------------
+def dependentsOf(nodes, names):
+    '''
+        Returns the names of the command nodes that declared a dependency on
+        any of the named ones, directly or not
+    '''
+    found = set()
+    pending = [node for node in nodes if node.name in names]
+    while pending:
+        node = pending.pop()
+        for dependent in node.dependents:
+            # Barriers carry the implicit stage/step ordering, not a need
+            if not dependent.isBarrier() and dependent.name not in found:
+                found.add(dependent.name)
+                pending.append(dependent)
+    return found
+
+#------------------------------------------------------------------------------
+def groupResults(nodes):
+    '''
+        Returns {matrix entry: [(instance name, retcode), ...]} for every
+        matrix entry in the graph
+    '''
+    groups = {}
+    for node in nodes:
+        if node.group:
+            groups.setdefault(node.group, []).append((node.name, node.retcode))
+    return groups
+
+#------------------------------------------------------------------------------
+def stateCounts(nodes):
+    '''
+        Returns {state: number of command nodes} of a finished run
+    '''
+    counts = {}
+    for node in nodes:
+        if not node.isBarrier() and node.state:
+            counts[node.state] = counts.get(node.state, 0) + 1
+    return counts
+
+#------------------------------------------------------------------------------
+def checkAcyclic(nodes):
+    '''
+        Raise an exception if the graph contains a dependency cycle
+    '''
+    remaining = {node: len(node.deps) for node in nodes}
+    ready = [node for node in nodes if not node.deps]
+    visited = 0
+    while ready:
+        node = ready.pop()
+        visited += 1
+        for dependent in node.dependents:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                ready.append(dependent)
+    if visited != len(nodes):
+        cycle = sorted(
+            node.name for node in nodes
+            if remaining[node] and not node.isBarrier())
+        raise Exception(f"Dependency cycle detected among {cycle}")
+
+#------------------------------------------------------------------------------
+def topologicalOrder(nodes):
+    '''
+        Returns the nodes ordered so each one comes after its dependencies
+    '''
+    remaining = {node: len(node.deps) for node in nodes}
+    ready = [node for node in reversed(nodes) if not node.deps]
+    ordered = []
+    while ready:
+        node = ready.pop()
+        ordered.append(node)
+        for dependent in reversed(node.dependents):
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                ready.append(dependent)
+    return ordered
+
+#------------------------------------------------------------------------------
+def prioritize(nodes, estimate):
+    '''
+        Set the priority of every node to the predicted length of its
+        critical path: its own predicted duration (estimate(node), seconds)
+        plus the longest critical path among its dependents
+
+        Returns the predicted critical path length of the whole run
+    '''
+    longest = 0
+    for node in reversed(topologicalOrder(nodes)):
+        node.priority = \
+            (0 if node.isBarrier() else estimate(node)) + \
+            max((d.priority for d in node.dependents), default=0)
+        longest = max(longest, node.priority)
+    return longest
+
+#------------------------------------------------------------------------------
+def simulate(nodes, estimate, jobs=DEFAULT_JOBS):
+    '''
+        Predict the run time of the graph on 'jobs' workers, scheduling ready
+        nodes the way runGraph does, with estimate(node) seconds per command
+
+        Returns the predicted run time, in seconds
+    '''
+    remaining = {node: len(node.deps) for node in nodes}
+    ready = [node for node in nodes if not node.deps]
+    heapq.heapify(ready)
+    # (finish time, order, node) of the commands running
+    running = []
+    active = {}
+    now = 0
+
+    def complete(node):
+        for dependent in node.dependents:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                heapq.heappush(ready, dependent)
+
+    while ready or running:
+        capped = []
+        while ready and (ready[0].isBarrier() or len(running) < jobs):
+            node = heapq.heappop(ready)
+            if node.isBarrier():
+                complete(node)
+            elif node.maxparallel and \
+                    active.get(node.group, 0) >= node.maxparallel:
+                capped.append(node)
+            else:
+                if node.group:
+                    active[node.group] = active.get(node.group, 0) + 1
+                heapq.heappush(
+                    running, (now + estimate(node), node.order, node))
+        for node in capped:
+            heapq.heappush(ready, node)
+        if not running:
+            break
+        now, _, node = heapq.heappop(running)
+        if node.group:
+            active[node.group] -= 1
+        complete(node)
+    return now
+
+#------------------------------------------------------------------------------
+def runGraph(
+        nodes, runner, jobs=DEFAULT_JOBS, cancel=None, failfast=False,
+        admission=None):
+    '''
+        Execute the graph, running ready command nodes concurrently on at most
+        'jobs' workers. The runner is called with a command node and must
+        return (retcode, block, retryafter), where block is a
+        createutils.LogBlock that is emitted as one contiguous block once the
+        node finishes. Unless retryafter is None, the node is run again once
+        that many seconds have passed, and its retcode is disregarded.
+
+        Once the cancel event (a threading.Event) is set, no further node is
+        started; the run returns RC_CANCELLED after the running ones finish,
+        cancelled. Whoever cancels is expected to stop those, e.g. with
+        processes.terminateAll(), and the run terminates whatever they start
+        afterwards.
+
+        A command failing for good applies its stage's on_failure policy, or
+        aborts the run if failfast is set (continues otherwise). Aborting
+        terminates the process trees of the commands in flight, which end up
+        cancelled, and skips the commands left, except for the cleanup step
+        of the stages that started. Every command node's final state is set
+        (STATE_RAN, STATE_SKIPPED or STATE_CANCELLED).
+
+        With an admission.Admission, ready commands only start once they fit
+        in the host's capacity, the ones that don't being held back while
+        the others behind them start.
+
+        Raises ValueError unless jobs is at least 1
+
+        Returns the aggregated return code
+    '''
+    if jobs < 1:
+        # No command could ever start
+        raise ValueError(f"jobs must be at least 1, not {jobs}")
+    # Deferred, this is only needed once there is work to run
+    import concurrent.futures
+    defaultpolicy = \
+        createif.OF_ABORT if failfast else createif.DEFAULT_ON_FAILURE
+    aborted = False
+    cancelled = False
+    # Threads whose commands were terminated
+    terminated = set()
+    # Stages that started, and stages skipped by their on_failure policy
+    started = set()
+    skipping = set()
+    retcode = createif.RC_SUCCESS
+    remaining = {node: len(node.deps) for node in nodes}
+    ready = [node for node in nodes if not node.deps]
+    heapq.heapify(ready)
+    for node in ready:
+        node.readyat = time.monotonic()
+    running = {}
+    # (wake-up time, node) of the commands waiting to be retried
+    waiting = []
+    # Running instances per matrix entry
+    active = {}
+
+    def complete(node):
+        for dependent in node.dependents:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0 and not cancelled:
+                dependent.readyat = time.monotonic()
+                heapq.heappush(ready, dependent)
+
+    def skips(node):
+        if node.isBarrier():
+            return False
+        # Whatever else happens, a stage that started gets cleaned up
+        if node.step == createif.CLEANUP_STEP:
+            return aborted and node.stage not in started
+        return aborted or node.stage in skipping
+
+    def run(node):
+        import processes
+        thread = threading.get_ident()
+        # Drop a termination aimed at the node this thread ran before
+        processes.releaseThreads({thread})
+        # Set before the state is checked, while cancelling sets the state
+        # before reading the thread: either the command is terminated, or it
+        # doesn't start
+        node.thread = thread
+        if node.state == STATE_CANCELLED:
+            return createif.RC_CANCELLED, createutils.LogBlock(log), None
+        return runner(node)
+
+    def terminate(inflight):
+        for n in inflight:
+            n.state = STATE_CANCELLED
+        threads = {n.thread for n in inflight if n.thread is not None}
+        if threads:
+            import processes
+            terminated.update(threads)
+            processes.terminateAll(threads=threads)
+
+    def cancelRun():
+        nonlocal cancelled, ready, waiting, retcode
+        cancelled = True
+        terminate([n for n in running.values() if n.state is None])
+        for _, n in waiting:
+            n.state = STATE_CANCELLED
+            n.retcode = createif.RC_CANCELLED
+        # Running nodes were marked above
+        for n in nodes:
+            if n.state is None and not n.isBarrier():
+                n.state = STATE_SKIPPED
+        ready = []
+        waiting = []
+        retcode = createif.RC_CANCELLED
+
+    def abort(node):
+        nonlocal aborted, waiting
+        aborted = True
+        log.error(f"{node.name} failed, aborting the run")
+        terminate([
+            n for f, n in running.items()
+            if not f.done() and n.step != createif.CLEANUP_STEP])
+        for _, n in waiting:
+            if n.step != createif.CLEANUP_STEP:
+                n.state = STATE_CANCELLED
+                n.retcode = createif.RC_CANCELLED
+                complete(n)
+        waiting = [
+            entry for entry in waiting
+            if entry[1].step == createif.CLEANUP_STEP]
+        heapq.heapify(waiting)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, jobs)) as executor:
+        while ready or running or waiting:
+            if cancel and cancel.is_set() and not cancelled:
+                cancelRun()
+            now = time.monotonic()
+            while waiting and waiting[0][0] <= now:
+                node = heapq.heappop(waiting)[1]
+                node.readyat = now
+                heapq.heappush(ready, node)
+            # Barriers are resolved inline, commands fill the free workers
+            capped = []
+            heldback = False
+            while ready and (
+                    ready[0].isBarrier() or skips(ready[0]) or
+                    len(running) < jobs):
+                node = heapq.heappop(ready)
+                if node.isBarrier():
+                    # Only a stage's start barrier has no step
+                    if node.step is None and not aborted:
+                        started.add(node.stage)
+                    complete(node)
+                elif skips(node):
+                    node.state = STATE_SKIPPED
+                    complete(node)
+                elif node.maxparallel and \
+                        active.get(node.group, 0) >= node.maxparallel:
+                    # Held back until an instance of its matrix finishes
+                    capped.append(node)
+                elif admission and not admission.admits(node):
+                    # Held back until the host has room for it, unless it
+                    # waited too long already, letting smaller ones start
+                    node.heldback = True
+                    heldback = True
+                    capped.append(node)
+                    if admission.starved(node):
+                        break
+                else:
+                    if node.firststart is None:
+                        node.firststart = time.monotonic()
+                    if node.group:
+                        active[node.group] = active.get(node.group, 0) + 1
+                    if admission:
+                        admission.acquire(node)
+                    node.attemptstart = time.monotonic()
+                    node.queuewait += node.attemptstart - node.readyat
+                    running[executor.submit(run, node)] = node
+            for node in capped:
+                heapq.heappush(ready, node)
+            wakeup = \
+                max(0, waiting[0][0] - time.monotonic()) if waiting else None
+            if heldback:
+                # Live readings change, even without commands finishing
+                wakeup = min(
+                    admission.pollinterval,
+                    wakeup if wakeup is not None else admission.pollinterval)
+            if not running:
+                if wakeup:
+                    if cancel:
+                        cancel.wait(wakeup)
+                    else:
+                        time.sleep(wakeup)
+                continue
+            done, _ = \
+                concurrent.futures.wait(
+                    running,
+                    timeout=wakeup,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+            # Commands finishing as the run is cancelled were interrupted
+            if cancel and cancel.is_set() and not cancelled:
+                cancelRun()
+            # Keep completion handling in configuration order
+            for future in sorted(done, key=lambda f: running[f].order):
+                node = running.pop(future)
+                # A retry may run on another thread
+                node.thread = None
+                node.duration = time.monotonic() - node.attemptstart
+                if node.group:
+                    active[node.group] -= 1
+                if admission:
+                    admission.release(node)
+                retryafter = None
+                try:
+                    noderc, block, retryafter = future.result()
+                    block.emit()
+                except Exception as e:
+                    log.error(f"Exception running {node.name}: {str(e)}")
+                    noderc = createif.RC_FAILEXC
+                if node.state == STATE_CANCELLED:
+                    # Terminated by an abort, its own result doesn't count
+                    node.retcode = createif.RC_CANCELLED
+                    complete(node)
+                    continue
+                if retryafter is not None:
+                    node.retries += 1
+                    heapq.heappush(
+                        waiting, (time.monotonic() + retryafter, node))
+                    continue
+                node.retcode = noderc
+                node.state = STATE_RAN
+                if noderc != createif.RC_SUCCESS:
+                    if retcode != createif.RC_CANCELLED:
+                        retcode = noderc
+                    policy = node.onfailure or defaultpolicy
+                    if policy == createif.OF_ABORT and not aborted:
+                        abort(node)
+                    elif policy == createif.OF_SKIPSTAGE and \
+                            node.stage not in skipping:
+                        log.warning(
+                            f"{node.name} failed, skipping the rest of "
+                            f"stage {node.stage}")
+                        skipping.add(node.stage)
+                complete(node)
+    if terminated:
+        import processes
+        processes.releaseThreads(terminated)
+    return retcode
@@ -0,0 +1,240 @@
+"""
+ Script name: shellpool.py
+
+ Author: Michael Dello
+ Description:
+    Pool of persistent, warm shell workers
+
+    Spawning a fresh /bin/sh for every tiny command (echo, test -f, small
+    greps, ...) costs more than the command itself. Workers in this pool are
+    long-lived shells fed over a pipe: each command runs in a subshell of the
+    worker, with stdin detached, and its output and return code are recovered
+    through a per-worker sentinel line written after it completes.
+"""
+import os
+import queue
+import selectors
+import shlex
+import signal
+import subprocess
+import threading
+import time
+import uuid
+
+import createutils
+import processes
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+DEFAULT_POOL_SIZE = 4
+
+SHELL = "/bin/sh"
+
+READ_CHUNK_SIZE = 64 * 1024
+
+#-------------------------------------------------------------------------------
+# Local Variables
+#-------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def isSupported():
+    return not createutils.THIS_IS_WINDOWS and os.path.exists(SHELL)
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class WorkerDied(Exception):
+    pass
+
+#------------------------------------------------------------------------------
+class ShellWorker(object):
+    """
+        A single long-lived shell, running one command at a time
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(self):
+        self.sentinel = f"__CREATE_{uuid.uuid4().hex}__".encode()
+        # Own session, so a timed out command can be killed with its worker
+        # without touching anything else
+        self.process = \
+            subprocess.Popen(
+                [SHELL],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                start_new_session=True)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.process.stdout, selectors.EVENT_READ)
+
+    #--------------------------------------------------------------------------
+    # Private Methods
+    #--------------------------------------------------------------------------
+    def __frame(self, cmd, cwd, env):
+        lines = ["("]
+        if cwd:
+            lines.append(f"cd -- {shlex.quote(cwd)} || exit 1")
+        for key, value in (env or {}).items():
+            lines.append(f"export {key}={shlex.quote(str(value))}")
+        lines.append(cmd)
+        # Detach stdin, so the command can't consume the rest of the stream
+        lines.append(") </dev/null 2>&1")
+        # Leading newline guarantees the sentinel starts a line
+        lines.append(
+            f"printf '\\n%s %d\\n' '{self.sentinel.decode()}' \"$?\"")
+        return ("\n".join(lines) + "\n").encode()
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def isAlive(self):
+        return self.process.poll() is None
+
+    def run(self, cmd, cwd=None, env=None, timeout=None):
+        '''
+            Run a shell command in the worker
+
+            Returns the return code and the raw (bytes) output. Raises
+            subprocess.TimeoutExpired (after killing the worker) on timeout and
+            WorkerDied if the worker exited underneath the command.
+        '''
+        try:
+            self.process.stdin.write(self.__frame(cmd, cwd, env))
+            self.process.stdin.flush()
+        except OSError:
+            raise WorkerDied(f"Shell worker {self.process.pid} died")
+        marker = b"\n" + self.sentinel + b" "
+        fd = self.process.stdout.fileno()
+        buffer = bytearray()
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            index = buffer.find(marker)
+            if index != -1 and buffer.endswith(b"\n"):
+                returncode = int(buffer[index + len(marker):].strip())
+                return returncode, bytes(buffer[:index])
+            remaining = deadline - time.monotonic() if deadline else None
+            if remaining is not None and remaining <= 0:
+                self.close()
+                raise subprocess.TimeoutExpired(
+                    cmd, timeout, output=bytes(buffer))
+            if not self.selector.select(remaining):
+                continue
+            data = os.read(fd, READ_CHUNK_SIZE)
+            if not data:
+                raise WorkerDied(f"Shell worker {self.process.pid} died")
+            buffer += data
+
+    def close(self):
+        '''
+            Terminate the worker and anything it is still running
+        '''
+        self.selector.close()
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.process.wait()
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+#------------------------------------------------------------------------------
+class ShellPool(object):
+    """
+        Bounded pool of ShellWorkers, safe to use from concurrent threads
+    """
+
+    #--------------------------------------------------------------------------
+    # Built-in Methods
+    #--------------------------------------------------------------------------
+    def __init__(self, size=DEFAULT_POOL_SIZE):
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.started = 0
+        self.closed = False
+
+    #--------------------------------------------------------------------------
+    # Private Methods
+    #--------------------------------------------------------------------------
+    def __acquire(self):
+        # Reuse an idle worker, grow lazily up to size, otherwise wait
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.started < self.size:
+                self.started += 1
+                log.debug(f"Starting shell worker {self.started}/{self.size}")
+                return ShellWorker()
+        return self.idle.get()
+
+    def __release(self, worker):
+        if worker.isAlive() and not self.closed:
+            self.idle.put(worker)
+        else:
+            worker.close()
+            # Let a replacement start on demand
+            with self.lock:
+                self.started -= 1
+
+    #--------------------------------------------------------------------------
+    # Public Methods
+    #--------------------------------------------------------------------------
+    def run(
+            self,
+            cmd,
+            cwd=None,
+            env=None,
+            timeout=None,
+            check=True,
+            encoding="utf-8",
+            onstart=None):
+        '''
+            Pool counterpart of subprocess.run(cmd, shell=True, ...) with
+            output captured and stderr merged into stdout
+
+            onstart(process) is called with the worker shell's Popen handle;
+            the command runs in a subshell, a child of that process
+
+            Returns a subprocess.CompletedProcess; raises TimeoutExpired and
+            CalledProcessError like subprocess.run()
+        '''
+        worker = self.__acquire()
+        # Cancelling the command takes its worker down with it
+        processes.track(worker.process)
+        if onstart:
+            onstart(worker.process)
+        try:
+            returncode, output = worker.run(cmd, cwd, env, timeout)
+        finally:
+            processes.untrack(worker.process)
+            self.__release(worker)
+        cc = \
+            subprocess.CompletedProcess(
+                cmd,
+                returncode,
+                stdout=output.decode(encoding, errors="backslashreplace"))
+        if check and returncode:
+            raise subprocess.CalledProcessError(
+                returncode, cmd, output=cc.stdout)
+        return cc
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
@@ -0,0 +1,313 @@
+"""
+ Script name: watch.py
+
+ Author: Michael Dello
+ Description:
+    Source tree watching for go-create.py --watch
+
+    Changes are picked up with inotify on Linux (through ctypes, no extra
+    dependency), and otherwise with a polling scanner that only stats the
+    tree, keeping each file's modification time and size between scans.
+    Bursts of changes are debounced into a single set of changed paths.
+
+    Commands declare the paths they depend on with "inputs" (the globs the
+    result cache uses); a change re-runs the commands whose inputs match it,
+    and the commands that declared "needs" on those. A change to a config
+    file re-runs everything. Changes matching no command's inputs, or
+    matching what the commands write (their "outputs" and "artifacts"), are
+    ignored.
+"""
+import abc
+import fnmatch
+import os
+import select
+import struct
+import time
+
+import createutils
+
+#------------------------------------------------------------------------------
+# Constants
+#------------------------------------------------------------------------------
+
+# Quiet time closing a burst of changes, and the longest a burst is held
+DEBOUNCE_IN_SECS = 0.3
+MAX_DEBOUNCE_IN_SECS = 2
+
+POLL_INTERVAL_IN_SECS = 0.5
+
+# Folders never watched: CREATE's own output, VCS and bytecode
+IGNORED_DIRS = {
+    createutils.OUTPUTDIR, "cache", ".git", ".hg", ".svn", "__pycache__"}
+
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_ISDIR = 0x40000000
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = \
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+#-------------------------------------------------------------------------------
+# Local Variables
+#-------------------------------------------------------------------------------
+
+log = createutils.logger.getChild(__name__)
+
+#------------------------------------------------------------------------------
+# Functions
+#------------------------------------------------------------------------------
+def walkDirs(root):
+    '''
+        Yield root and every directory below it that isn't ignored
+    '''
+    yield root
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False) and \
+                entry.name not in IGNORED_DIRS:
+            yield from walkDirs(entry.path)
+
+#------------------------------------------------------------------------------
+def matchesInputs(path, patterns, cwd=None):
+    '''
+        Returns True if the path (relative to the watched root) is one of,
+        or under one of, the input globs of a command entry
+    '''
+    path = os.path.normpath(path)
+    for pattern in patterns:
+        pattern = os.path.normpath(
+            os.path.join(cwd, pattern) if cwd else pattern)
+        if fnmatch.fnmatch(path, pattern) or \
+                path.startswith(pattern.rstrip(os.sep) + os.sep):
+            return True
+    return False
+
+#------------------------------------------------------------------------------
+def affectedCommands(nodes, changed):
+    '''
+        Returns the names of the command nodes whose declared inputs match
+        any of the changed paths
+    '''
+    affected = set()
+    for node in nodes:
+        if node.isBarrier() or "inputs" not in node.cmdentry:
+            continue
+        if any(matchesInputs(
+                path, node.cmdentry["inputs"], node.cmdentry.get("cwd"))
+                for path in changed):
+            affected.add(node.name)
+    return affected
+
+#------------------------------------------------------------------------------
+def relevantChanges(nodes, changed):
+    '''
+        Returns the changed paths matching the declared inputs of a command,
+        leaving out those the commands write themselves (their declared
+        outputs and artifacts)
+    '''
+    cmdentries = [node.cmdentry for node in nodes if not node.isBarrier()]
+    written = [
+        (cmdentry.get("outputs", []) + cmdentry.get("artifacts", []),
+         cmdentry.get("cwd"))
+        for cmdentry in cmdentries
+        if "outputs" in cmdentry or "artifacts" in cmdentry]
+    inputs = [
+        (cmdentry["inputs"], cmdentry.get("cwd"))
+        for cmdentry in cmdentries if "inputs" in cmdentry]
+    return {
+        path for path in changed
+        if not any(matchesInputs(path, patterns, cwd)
+                   for patterns, cwd in written) and
+        any(matchesInputs(path, patterns, cwd) for patterns, cwd in inputs)}
+
+#------------------------------------------------------------------------------
+def newWatcher(root="."):
+    '''
+        Returns an inotify watcher where supported, a polling one otherwise
+    '''
+    if not createutils.THIS_IS_WINDOWS:
+        try:
+            return InotifyWatcher(root)
+        except OSError as e:
+            log.debug(f"inotify unavailable ({str(e)}), polling instead")
+    return PollingWatcher(root)
+
+#------------------------------------------------------------------------------
+# Classes
+#------------------------------------------------------------------------------
+class Watcher(abc.ABC):
+    """
+        Base of the watchers: changes() debounces what poll() reports
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    @abc.abstractmethod
+    def poll(self, timeout):
+        '''
+            Returns the paths changed since the last call, waiting up to
+            timeout seconds for one
+        '''
+
+    def changes(self, timeout=None):
+        '''
+            Wait (up to timeout, forever if None) for a change, then collect
+            changes until they stop for DEBOUNCE_IN_SECS
+
+            Returns the set of changed paths, relative to the root
+        '''
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        changed = set()
+        while not changed:
+            remaining = \
+                max(0, deadline - time.monotonic()) if deadline else None
+            changed = self.poll(remaining)
+            if deadline and time.monotonic() >= deadline:
+                return changed
+        burstend = time.monotonic() + MAX_DEBOUNCE_IN_SECS
+        while time.monotonic() < burstend:
+            more = self.poll(DEBOUNCE_IN_SECS)
+            if not more:
+                break
+            changed |= more
+        return {os.path.relpath(path, self.root) for path in changed}
+
+    def close(self):
+        pass
+
+#------------------------------------------------------------------------------
+class PollingWatcher(Watcher):
+    """
+        Scans the tree every POLL_INTERVAL_IN_SECS, comparing modification
+        times and sizes
+    """
+
+    def __init__(self, root, interval=POLL_INTERVAL_IN_SECS):
+        super().__init__(root)
+        self.interval = interval
+        self.snapshot = self.__scan()
+        self.nextscan = time.monotonic() + interval
+
+    def __scan(self):
+        snapshot = {}
+        for folder in walkDirs(self.root):
+            try:
+                entries = list(os.scandir(folder))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        snapshot[entry.path] = (st.st_mtime_ns, st.st_size)
+                except OSError:
+                    continue
+        return snapshot
+
+    def poll(self, timeout):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            wait = self.nextscan - time.monotonic()
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+            if wait > 0:
+                time.sleep(wait)
+            if time.monotonic() >= self.nextscan:
+                self.nextscan = time.monotonic() + self.interval
+                snapshot = self.__scan()
+                changed = {
+                    path for path in snapshot.keys() | self.snapshot.keys()
+                    if snapshot.get(path) != self.snapshot.get(path)}
+                self.snapshot = snapshot
+                if changed:
+                    return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+
+#------------------------------------------------------------------------------
+class InotifyWatcher(Watcher):
+    """
+        Linux inotify watches on every directory of the tree, added as
+        directories get created
+    """
+
+    def __init__(self, root):
+        import ctypes
+        import ctypes.util
+        super().__init__(root)
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("no inotify support in libc")
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+        for folder in walkDirs(root):
+            self.__addWatch(folder)
+
+    def __addWatch(self, folder):
+        wd = \
+            self.libc.inotify_add_watch(
+                self.fd, os.fsencode(folder), WATCH_MASK)
+        if wd >= 0:
+            self.dirs[wd] = folder
+
+    def poll(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, report the whole tree as changed
+                changed.add(self.root)
+                continue
+            folder = self.dirs.get(wd)
+            if folder is None:
+                continue
+            if mask & IN_DELETE_SELF:
+                del self.dirs[wd]
+                continue
+            path = os.path.join(folder, os.fsdecode(name)) if name else folder
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and \
+                        os.path.basename(path) not in IGNORED_DIRS:
+                    # Watch the new directory, and report what is already in
+                    for sub in walkDirs(path):
+                        self.__addWatch(sub)
+                        try:
+                            changed.update(
+                                e.path for e in os.scandir(sub) if e.is_file())
+                        except OSError:
+                            pass
+                continue
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)